@@ -13,7 +13,12 @@ setup(
     packages=find_packages('src'),
     package_dir={'': 'src'},
 
-    install_requires=['setuptools', 'requests', 'django'],
+    install_requires=['setuptools', 'requests', 'django', 'orjson', 'pandas', 'pyroaring'],
+    extras_require={
+        'zstd': ['zstandard>=0.15'],  # zstd bodies of the stream apis
+        'xlsx': ['openpyxl'],  # streaming xlsx imports
+        'kafka': ['kafka-python'],  # consumer.KafkaBroker
+    },
 
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,136 @@
+import contextlib
+import datetime
+import threading
+
+import pandas as pd
+
+from importly.formatters import format_datetime
+
+DATETIME_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y/%m/%d %H:%M:%S',
+    '%Y-%m-%d',
+    '%Y/%m/%d',
+]
+
+_local = threading.local()
+
+
+def format_price_column(values, scalar):
+    '''
+    whole column version of format_price, cells pandas can not convert go through scalar
+    '''
+    series = pd.Series(values, dtype=object)
+    result = pd.to_numeric(series, errors='coerce').astype(float)
+    failed = result.isna()
+    if failed.any():
+        result[failed] = series[failed].map(scalar)
+    return result.tolist()
+
+
+class DatetimeFormatterState:
+    def __init__(self):
+        self.format = None
+        self.tzinfo = None
+        self.samples = []
+        self.misses = 0
+
+
+@contextlib.contextmanager
+def datetime_formats():
+    '''
+    scope of one run of an importer: the formats inferred by DatetimeFormatter inside it are forgotten at its end,
+    so they are never shared between teams, imports or threads
+    '''
+    previous = getattr(_local, 'states', None)
+    _local.states = {}
+    try:
+        yield
+    finally:
+        _local.states = previous
+
+
+class DatetimeFormatter:
+    '''
+    format_datetime with a fast path: the format is inferred from the first SAMPLE_SIZE cells and kept
+    for the rest of the run, it is only used once it gives the same result as format_datetime on those cells.
+    cells the inferred format does not match go through format_datetime.
+
+    meant to be used per field, as Formatted(DatetimeFormatter(), key). the formatter itself is stateless,
+    what it inferred lives in the datetime_formats() scope of the run; outside of one every cell goes through format_datetime.
+    '''
+    SAMPLE_SIZE = 5
+
+    def __init__(self, scalar=format_datetime):
+        self.scalar = scalar
+
+    def get_state(self):
+        states = getattr(_local, 'states', None)
+        if states is None:
+            return None
+        return states.setdefault(id(self), DatetimeFormatterState())
+
+    @staticmethod
+    def localize(tzinfo, value):
+        if tzinfo is None:
+            return value
+        if hasattr(tzinfo, 'localize'):  # pytz
+            return tzinfo.localize(value)
+        return value.replace(tzinfo=tzinfo)
+
+    def infer(self, state):
+        '''
+        pick the first format which parses every sample cell exactly like format_datetime does
+        '''
+        samples, expected = zip(*state.samples)
+        if any(not isinstance(value, datetime.datetime) for value in expected):
+            return
+        state.tzinfo = expected[0].tzinfo
+        for fmt in DATETIME_FORMATS:
+            try:
+                parsed = [self.localize(state.tzinfo, datetime.datetime.strptime(value.strip(), fmt)) for value in samples]
+            except ValueError:
+                continue
+            if parsed == list(expected):
+                state.format = fmt
+                return
+
+    def __call__(self, value):
+        state = self.get_state()
+        if state is None:
+            return self.scalar(value)
+
+        if state.format and isinstance(value, str):
+            try:
+                parsed = self.localize(state.tzinfo, datetime.datetime.strptime(value.strip(), state.format))
+                state.misses = 0
+                return parsed
+            except ValueError:
+                state.misses += 1
+                if state.misses >= self.SAMPLE_SIZE:  # the data changed its format, infer it again
+                    state.__init__()
+
+        result = self.scalar(value)
+        if state.format is None and len(state.samples) < self.SAMPLE_SIZE and isinstance(value, str) and value.strip():
+            state.samples.append((value, result))
+            if len(state.samples) == self.SAMPLE_SIZE:
+                self.infer(state)
+        return result
+
+
+def format_columns(rows, column_formatters):
+    '''
+    rows: list of dicts, column_formatters: { key: function taking and returning a list of values }
+    replaces the values of each key in place, a whole column at once
+    '''
+    for key, format_column in column_formatters.items():
+        keys = [index for index, row in enumerate(rows) if key in row]
+        if not keys:
+            continue
+        values = format_column([rows[index][key] for index in keys])
+        for index, value in zip(keys, values):
+            rows[index][key] = value
+    return rows
@@ -0,0 +1,294 @@
+import collections
+import logging
+import threading
+import time
+
+import orjson
+
+from django.conf import settings
+
+from datahub.models import DataSource
+from team.models import Team
+
+from .datasources.streaming import import_rows
+from .retail_importly.importers import LineItemOrderImporter
+from .wish_importly.importers import LevelLogImporter, EventLogImporter, PointLogImporter
+
+logger = logging.getLogger(__name__)
+
+# message value: {'type': one of IMPORTERS, 'team': team slug, 'datasource': datasource uuid, 'data': one row}
+IMPORTERS = {
+    'order': LineItemOrderImporter,
+    'levellog': LevelLogImporter,
+    'eventlog': EventLogImporter,
+    'pointlog': PointLogImporter,
+}
+
+Message = collections.namedtuple('Message', ['partition', 'offset', 'value'])
+
+
+class UndeliverableMessage(Exception):
+    pass
+
+
+def raw_value(message):
+    '''
+    the message value as read from the stream, dead letters carry the raw value of messages which do not parse
+    '''
+    if isinstance(message.value, bytes):
+        return message.value
+    return orjson.dumps(message.value)
+
+
+class LocalBroker:
+    '''
+    in memory stand in for the message stream, one partition per name, for tests and local runs
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.partitions = collections.defaultdict(list)
+        self.positions = collections.defaultdict(int)
+        self.committed = collections.defaultdict(int)
+        self.dead_letters = []
+
+    def publish(self, value, partition='default'):
+        with self.lock:
+            self.partitions[partition].append(orjson.dumps(value))
+
+    def poll(self, max_records, timeout):
+        with self.lock:
+            messages = []
+            for partition, values in self.partitions.items():
+                start = self.positions[partition]
+                end = min(len(values), start + max_records - len(messages))
+                messages.extend(Message(partition, offset, values[offset]) for offset in range(start, end))
+                self.positions[partition] = end
+        if not messages:
+            time.sleep(timeout)
+        return messages
+
+    def commit(self, offsets):
+        '''
+        offsets: { partition: offset of the next message to read }
+        '''
+        with self.lock:
+            self.committed.update(offsets)
+
+    def dead_letter(self, messages, error):
+        with self.lock:
+            self.dead_letters.extend((message, error) for message in messages)
+        return True
+
+    def close(self):
+        pass
+
+    def lag(self):
+        with self.lock:
+            return sum(len(values) - self.committed[partition] for partition, values in self.partitions.items())
+
+
+class KafkaBroker:
+    '''
+    kafka topics read with a consumer group, offsets are only committed through commit().
+    message values are the raw bytes, MicroBatchConsumer.add parses them so a bad message can be dead lettered
+    '''
+
+    def __init__(self, topics, dead_letter_topic=None, **config):
+        from kafka import KafkaConsumer  # only needed when consuming from kafka
+
+        self.consumer = KafkaConsumer(
+            *topics, enable_auto_commit=False, **config
+        )
+        self.dead_letter_topic = dead_letter_topic
+        self.producer = None
+        if dead_letter_topic:
+            from kafka import KafkaProducer
+
+            self.producer = KafkaProducer(bootstrap_servers=config.get('bootstrap_servers', 'localhost'))
+
+    def poll(self, max_records, timeout):
+        records = self.consumer.poll(timeout_ms=int(timeout * 1000), max_records=max_records)
+        return [
+            Message(partition, record.offset, record.value)
+            for partition, partition_records in records.items() for record in partition_records
+        ]
+
+    def commit(self, offsets):
+        from kafka.structs import OffsetAndMetadata
+
+        fields = len(OffsetAndMetadata._fields)  # leader_epoch was added in kafka-python 2.1
+        self.consumer.commit({
+            partition: OffsetAndMetadata(offset, '', -1) if fields == 3 else OffsetAndMetadata(offset, '')
+            for partition, offset in offsets.items()
+        })
+
+    def dead_letter(self, messages, error):
+        '''
+        the messages of a batch which could not be imported, with the error, to settings.WISH_STREAM_DEAD_LETTER_TOPIC,
+        False if there is no dead letter topic
+        '''
+        if not self.producer:
+            return False
+        for message in messages:
+            self.producer.send(self.dead_letter_topic, orjson.dumps({
+                'topic': message.partition.topic,
+                'partition': message.partition.partition,
+                'offset': message.offset,
+                'error': error,
+                'value': raw_value(message).decode('utf-8', 'replace'),
+            }))
+        self.producer.flush()
+        return True
+
+    def close(self):
+        self.consumer.close(autocommit=False)
+        if self.producer:
+            self.producer.close()
+
+    def lag(self):
+        partitions = self.consumer.assignment()
+        if not partitions:
+            return 0
+        end_offsets = self.consumer.end_offsets(list(partitions))
+        return sum(end_offsets[partition] - self.consumer.position(partition) for partition in partitions)
+
+
+def get_broker():
+    '''
+    settings.WISH_STREAM_TOPICS: kafka topics to consume, WISH_STREAM_KAFKA: KafkaConsumer config (bootstrap_servers, group_id, ...),
+    WISH_STREAM_DEAD_LETTER_TOPIC: where batches which can not be imported go, without it the consumer stops at them
+    '''
+    topics = getattr(settings, 'WISH_STREAM_TOPICS', None)
+    if not topics:
+        return None
+    return KafkaBroker(
+        topics, getattr(settings, 'WISH_STREAM_DEAD_LETTER_TOPIC', None), **getattr(settings, 'WISH_STREAM_KAFKA', {})
+    )
+
+
+class MicroBatchConsumer:
+    '''
+    groups stream messages per (type, team, datasource) into batches of max_size rows or max_wait seconds,
+    each batch is imported like an api call. offsets are committed only once every message before them is imported,
+    a crash replays the uncommitted messages, which the upserts of the importers absorb.
+    a failing batch is retried after retry_backoff seconds, doubled on every attempt, one still failing after max_attempts
+    goes to the dead letters and is committed, so it does not block its partitions. without a dead letter sink the error
+    is raised and nothing of the batch is committed, the next run starts from it again.
+    messages which are not a json object of a known type go to the dead letters the same way.
+    '''
+
+    def __init__(self, broker, max_size=None, max_wait=60, max_attempts=3, retry_backoff=1):
+        self.broker = broker
+        self.max_size = max_size or settings.BATCH_SIZE_L
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.buffers = {}     # key: (started_at, [messages])
+        self.processed = {}   # partition: offset of the next message not imported yet
+        self.stats = {'rows': 0, 'batches': 0, 'failed_batches': 0, 'rejected_messages': 0, 'seconds': 0.0}
+
+    def metrics(self):
+        seconds = self.stats['seconds']
+        return {
+            **self.stats,
+            'rows_per_second': round(self.stats['rows'] / seconds, 2) if seconds else 0,
+            'buffered': sum(len(messages) for started_at, messages in self.buffers.values()),
+            'lag': self.broker.lag(),
+        }
+
+    def add(self, message):
+        try:
+            value = orjson.loads(message.value)
+        except orjson.JSONDecodeError as e:
+            self.reject(message, repr(e))
+            return
+        if not isinstance(value, dict) or value.get('type') not in IMPORTERS or not value.get('data'):
+            self.reject(message, 'not a message of IMPORTERS')
+            return
+        key = (value['type'], value.get('team'), value.get('datasource'))
+        started_at, messages = self.buffers.setdefault(key, (time.monotonic(), []))
+        messages.append(message._replace(value=value))
+        if len(messages) >= self.max_size:
+            self.flush(key)
+
+    def reject(self, message, error):
+        '''
+        a message which can never be imported, to the dead letters
+        '''
+        logger.warning('rejected message %s %s: %s', message.partition, message.offset, error)
+        if not self.broker.dead_letter([message], error):
+            raise UndeliverableMessage(f'message {message.partition} {message.offset} can not be imported and there is no dead letter sink: {error}')
+        self.stats['rejected_messages'] += 1
+        self.processed[message.partition] = max(self.processed.get(message.partition, 0), message.offset + 1)
+
+    def flush(self, key):
+        started_at, messages = self.buffers.pop(key)
+        kind, team_slug, datasource_uuid = key
+        rows = [message.value['data'] for message in messages]
+        if kind == 'order':
+            # orders without line items were never imported
+            rows = [row for row in rows if row.get('items')]
+
+        started = time.monotonic()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if rows:
+                    team = Team.objects.get(slug=team_slug)
+                    datasource = DataSource.objects.filter(uuid=datasource_uuid).only('id').first()
+                    import_rows(IMPORTERS[kind], team, datasource, rows)
+                break
+            except Exception as e:
+                logger.exception('%s batch of %s failed, attempt %s of %s', kind, team_slug, attempt, self.max_attempts)
+                if attempt == self.max_attempts:
+                    error = e
+                else:
+                    time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        else:
+            rows = []
+            self.stats['failed_batches'] += 1
+            if not self.broker.dead_letter(messages, repr(error)):
+                # nothing of the batch is committed, the next run replays it
+                raise error
+            logger.error(
+                'dead lettered %s batch of %s: %s', kind, team_slug,
+                [(str(message.partition), message.offset) for message in messages]
+            )
+        self.stats['rows'] += len(rows)
+        self.stats['batches'] += 1
+        self.stats['seconds'] += time.monotonic() - started
+
+        for message in messages:
+            self.processed[message.partition] = max(self.processed.get(message.partition, 0), message.offset + 1)
+        self.commit()
+        logger.info('%s batch of %s %s', kind, team_slug, self.metrics())
+
+    def commit(self):
+        # a partition is only committed up to its oldest message still waiting in a buffer
+        pending = {}
+        for started_at, messages in self.buffers.values():
+            for message in messages:
+                pending[message.partition] = min(pending.get(message.partition, message.offset), message.offset)
+        offsets = {
+            partition: min(offset, pending.get(partition, offset))
+            for partition, offset in self.processed.items()
+        }
+        if offsets:
+            self.broker.commit(offsets)
+
+    def flush_expired(self, force=False):
+        now = time.monotonic()
+        for key in [key for key, (started_at, messages) in self.buffers.items() if force or now - started_at >= self.max_wait]:
+            self.flush(key)
+
+    def run(self, time_budget=None, poll_timeout=1):
+        '''
+        consume until time_budget seconds have passed, forever if not given, whatever is buffered is imported before returning
+        '''
+        started = time.monotonic()
+        while not time_budget or time.monotonic() - started < time_budget:
+            for message in self.broker.poll(self.max_size, poll_timeout):
+                self.add(message)
+            self.flush_expired()
+        self.flush_expired(force=True)
+        return self.metrics()
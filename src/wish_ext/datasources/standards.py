@@ -1,3 +1,5 @@
+import math
+
 from importly.importers import FileImporter
 
 from orderly_core.team.importers import ClientImporter
@@ -6,13 +8,40 @@ from ..wish_importly.importers import (
     LevelImporter, EventImporter, PointLogImporter, LevelLogImporter, EventLogImporter
 )
 
+from ..columnar import format_price_column
 from ..extension import wish_ext
+from ..retail_importly.formatters import format_price
+from .streaming import StreamingFileImporter
+
 
+def price_column(values):
+    # the chunk is stored as json before the importer runs, nan / inf stay as they are for format_price
+    formatted = format_price_column(values, format_price)
+    return [price if math.isfinite(price) else value for value, price in zip(values, formatted)]
 
 
 @wish_ext.datasource('威許訂單格式')
-class OrderFileImporter(FileImporter):
+class OrderFileImporter(StreamingFileImporter):
     data_importer = OrderImporter
+    field_map = {
+        '訂單編號': 'id',
+        '會員編號': 'client_id',
+        '交易時間': 'datetime',
+        '產品唯一碼': 'product_id',
+        '產品名稱': 'product_name',
+        '產品原價': 'price',
+        '折扣後單價': 'sale_price',
+        '購買數量': 'quantity',
+        '品項小計': 'total_price',
+    }
+    # one row per line item, create_orderproducts replaces the lines of an order with those of its datalist
+    chunk_key = 'id'
+    column_formatters = {
+        'price': price_column,
+        'sale_price': price_column,
+        'quantity': price_column,
+        'total_price': price_column,
+    }
 
     @staticmethod
     def get_required_headers():
@@ -43,8 +72,13 @@ class ClientFileImporter(FileImporter):
 
 
 @wish_ext.datasource('威許等級格式')
-class LevelFileImporter(FileImporter):
+class LevelFileImporter(StreamingFileImporter):
     data_importer = LevelImporter
+    field_map = {
+        '對應代碼': 'id',
+        '等級名稱': 'name',
+        '位階（數字越大，等級越高）': 'rank',
+    }
 
     @staticmethod
     def get_required_headers():
@@ -59,8 +93,17 @@ class LevelFileImporter(FileImporter):
 
 
 @wish_ext.datasource('威許等級記錄格式')
-class LevelLogFileImporter(FileImporter):
+class LevelLogFileImporter(StreamingFileImporter):
     data_importer = LevelLogImporter
+    field_map = {
+        'id': 'id',
+        '會員編號': 'member_id',
+        '原始等級': 'from_level_id',
+        '後來等級': 'to_level_id',
+        '等級起始時間': 'from_datetime',
+        '等級到期時間': 'to_datetime',
+        '建立時間': 'datetime',
+    }
 
     @staticmethod
     def get_required_headers():
@@ -75,8 +118,15 @@ class LevelLogFileImporter(FileImporter):
 
 
 @wish_ext.datasource('威許點數記錄格式')
-class PointLogFileImporter(FileImporter):
+class PointLogFileImporter(StreamingFileImporter):
     data_importer = PointLogImporter
+    field_map = {
+        'id': 'id',
+        '會員編號': 'member_id',
+        '幣別名稱': 'point_name',
+        '點數數量': 'amount',
+        '建立時間': 'datetime',
+    }
 
     @staticmethod
     def get_required_headers():
@@ -91,8 +141,15 @@ class PointLogFileImporter(FileImporter):
 
 
 @wish_ext.datasource('威許活動格式')
-class EventFileImporter(FileImporter):
+class EventFileImporter(StreamingFileImporter):
     data_importer = EventImporter
+    field_map = {
+        '活動id': 'id',
+        '活動名稱': 'name',
+        '票券類型（共七種票券類型）': 'ticket_type',
+        '票券名稱': 'ticket_name',
+        '免費/點數/兌換碼': 'cost_type',
+    }
 
     @staticmethod
     def get_required_headers():
@@ -107,8 +164,15 @@ class EventFileImporter(FileImporter):
 
 
 @wish_ext.datasource('威許活動記錄格式')
-class EventLogFileImporter(FileImporter):
+class EventLogFileImporter(StreamingFileImporter):
     data_importer = EventLogImporter
+    field_map = {
+        '記錄ID': 'id',
+        '活動ID': 'event_id',
+        '會員編號': 'member_id',
+        '日期': 'datetime',
+        '動作 / 兌換': 'action',
+    }
 
     @staticmethod
     def get_required_headers():
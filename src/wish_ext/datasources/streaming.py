@@ -0,0 +1,142 @@
+import csv
+import io
+import itertools
+import os
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from importly.exceptions import EssentialDataMissing
+from importly.importers import FileImporter
+from importly.models import DataList
+
+from ..columnar import format_columns
+from ..instrumentation import log_slow_import
+from ..segments import invalidate_segments
+from ..staging import stage_rows
+from ..wish_importly.models import StreamingImport
+
+
+def import_rows(importer_cls, team, datasource, rows):
+    '''
+    one chunk through the same steps as an api import, returns the datalist
+    '''
+    importer = importer_cls(team, datasource)
+
+    datalist = stage_rows(importer, rows)
+
+    importer.process_raw_records()
+    datalist.set_step(DataList.STEP_DONE)
+    log_slow_import(datalist)
+    invalidate_segments(team.id)
+    return datalist
+
+
+def iter_row_chunks(rows, chunk_size, key=None):
+    '''
+    lists of at least chunk_size rows (but the last), with key a chunk is only cut where row[key] changes,
+    so the consecutive rows of one key (the line items of an order) are always imported together
+    '''
+    chunk = []
+    for row in rows:
+        if len(chunk) >= chunk_size and (key is None or row.get(key) != chunk[-1].get(key)):
+            yield chunk
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+
+def iter_csv(path):
+    with default_storage.open(path, 'rb') as f:
+        reader = csv.reader(io.TextIOWrapper(f, newline='', encoding='utf-8-sig'))
+        for values in reader:
+            yield values
+
+
+def iter_xlsx(path):
+    from openpyxl import load_workbook  # only needed for xlsx files
+
+    with default_storage.open(path, 'rb') as f:
+        workbook = load_workbook(f, read_only=True, data_only=True)
+        try:
+            for values in workbook.active.iter_rows(values_only=True):
+                yield ['' if value is None else value for value in values]
+        finally:
+            workbook.close()
+
+
+class StreamingFileImporter(FileImporter):
+    '''
+    FileImporter which can also import a file chunk by chunk, with bounded memory, see stream().
+
+    field_map: { file header: key expected by data_importer },
+    columns in get_headers_array but not in field_map are kept in the row attributions.
+    column_formatters: { key: function formatting a whole column of a chunk }, see columnar.format_columns
+    chunk_key: key of the rows which must not be split between chunks, see iter_row_chunks
+    '''
+    field_map = {}
+    column_formatters = {}
+    chunk_key = None
+
+    @classmethod
+    def read_rows(cls, path):
+        ext = os.path.splitext(path)[1].lower()
+        values_iter = iter_xlsx(path) if ext in ('.xlsx', '.xlsm') else iter_csv(path)
+
+        try:
+            headers = [str(header).strip() for header in next(values_iter)]
+        except StopIteration:
+            return
+        for header in cls.get_required_headers():
+            if header not in headers:
+                raise EssentialDataMissing(header)
+        known_headers = set(cls.get_headers_array())
+
+        for values in values_iter:
+            row = {'attributions': {}}
+            for header, value in zip(headers, values):
+                if header not in known_headers:
+                    continue
+                if header in cls.field_map:
+                    row[cls.field_map[header]] = value
+                else:
+                    row['attributions'][header] = value
+            yield row
+
+    @classmethod
+    def stream(cls, streaming_import, chunk_size=None, time_budget=None):
+        '''
+        import the file of streaming_import chunk by chunk, each chunk is a datalist of its own.
+        progress is saved after every chunk, calling it again resumes after the last finished chunk.
+        stops after time_budget seconds if given, returns True once the whole file is imported.
+        '''
+        chunk_size = chunk_size or settings.BATCH_SIZE_L
+        started = time.monotonic()
+        rows = itertools.islice(cls.read_rows(streaming_import.path), streaming_import.rows_done, None)
+        chunks = iter_row_chunks(rows, chunk_size, cls.chunk_key)
+
+        try:
+            while True:
+                if time_budget and time.monotonic() - started > time_budget:
+                    return False
+                chunk = next(chunks, None)
+                if not chunk:
+                    break
+                format_columns(chunk, cls.column_formatters)
+                datalist = import_rows(cls.data_importer, streaming_import.team, streaming_import.datasource, chunk)
+
+                streaming_import.rows_done += len(chunk)
+                streaming_import.chunks_done += 1
+                streaming_import.datalist = datalist
+                streaming_import.save(update_fields=['rows_done', 'chunks_done', 'datalist', 'u_at'])
+        except Exception as e:
+            streaming_import.status = StreamingImport.STATUS_FAILED
+            streaming_import.error = repr(e)
+            streaming_import.save(update_fields=['status', 'error', 'u_at'])
+            raise
+
+        streaming_import.status = StreamingImport.STATUS_DONE
+        streaming_import.save(update_fields=['status', 'u_at'])
+        return True
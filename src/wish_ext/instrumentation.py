@@ -0,0 +1,103 @@
+import contextlib
+import functools
+import logging
+import resource
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def count_rows(read=0, written=0):
+    '''
+    rows read / written outside of cursor.execute (server side cursors, COPY), added to the running stages
+    '''
+    for stats in getattr(_local, 'stages', []):
+        stats['rows_read'] += read
+        stats['rows_written'] += written
+
+
+def count_changes(inserted=0, updated=0, unchanged=0):
+    '''
+    rows an upsert inserted, updated, or left untouched because nothing changed
+    '''
+    for stats in getattr(_local, 'stages', []):
+        stats['rows_inserted'] += inserted
+        stats['rows_updated'] += updated
+        stats['rows_unchanged'] += unchanged
+
+
+@contextlib.contextmanager
+def import_stage(importer, name):
+    '''
+    records wall time, query count, rows read / written and peak memory of one stage of importer as an ImportStage
+    '''
+    stats = {
+        'queries': 0, 'rows_read': 0, 'rows_written': 0,
+        'rows_inserted': 0, 'rows_updated': 0, 'rows_unchanged': 0,
+    }
+    stages = _local.__dict__.setdefault('stages', [])
+
+    def count_queries(execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        rowcount = max(context['cursor'].rowcount, 0)
+        stats['queries'] += 1
+        if sql.lstrip()[:6].upper() == 'SELECT':
+            stats['rows_read'] += rowcount
+        else:
+            stats['rows_written'] += rowcount
+        return result
+
+    started = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stages.append(stats)
+    try:
+        with connection.execute_wrapper(count_queries):
+            yield stats
+    finally:
+        stages.remove(stats)
+
+    from .wish_importly.models import ImportStage  # wish_importly.models imports staging, which reports here
+
+    peak_memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # high water mark of the process, kB on linux
+    ImportStage.objects.create(
+        datalist_id=importer.datalist.id,
+        importer=type(importer).__name__,
+        name=name,
+        shard=getattr(importer, 'shard', None),
+        seconds=time.perf_counter() - started,
+        peak_memory_kb=peak_memory_kb,
+        memory_growth_kb=peak_memory_kb - peak,
+        **stats
+    )
+
+
+def instrumented(method):
+    '''
+    records every call of an importer method as a stage named after it
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with import_stage(self, method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def log_slow_import(datalist):
+    '''
+    logs the stages of datalist when they took longer than settings.WISH_SLOW_IMPORT_SECONDS together
+    '''
+    from .wish_importly.models import ImportStage
+
+    stages = list(ImportStage.objects.filter(datalist=datalist).order_by('c_at').values(
+        'name', 'shard', 'seconds', 'queries', 'rows_read', 'rows_written',
+        'rows_inserted', 'rows_updated', 'rows_unchanged', 'peak_memory_kb'
+    ))
+    seconds = sum(stage['seconds'] for stage in stages)
+    if seconds >= getattr(settings, 'WISH_SLOW_IMPORT_SECONDS', 60):
+        logger.warning('slow import of datalist %s: %.1fs %s', datalist.id, seconds, stages)
@@ -0,0 +1,225 @@
+import types
+import zlib
+
+import orjson
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework import status
+
+from datahub.models import DataSource
+from external_app.models import ExternalAppApiKey
+
+from .payloads import batch_key, claim_batch
+from .sharding import process_staged_datalist
+from .staging import stage_rows
+
+READ_SIZE = 64 * 1024
+MAX_LINE_SIZE = 4 * 1024 * 1024
+
+
+class InvalidLine(Exception):
+    def __init__(self, line_number, text):
+        super().__init__(f'line {line_number}: {text}')
+        self.line_number = line_number
+        self.text = text
+
+
+def iter_decompressed(read, content_encoding, max_size=None):
+    '''
+    read: read(size) of the request body, yields decompressed bytes as they arrive, READ_SIZE at most at a time.
+    max_size: bytes the body may decompress to, settings.WISH_STREAM_MAX_BODY_SIZE by default
+    '''
+    content_encoding = (content_encoding or '').strip().lower()
+    max_size = max_size or getattr(settings, 'WISH_STREAM_MAX_BODY_SIZE', 2 * 1024 ** 3)
+    total = 0
+
+    def check(block):
+        nonlocal total
+        total += len(block)
+        if total > max_size:
+            raise InvalidLine(0, f'Body is larger than {max_size} bytes once decompressed.')
+        return block
+
+    if content_encoding == 'zstd':
+        import zstandard  # only needed for zstd bodies
+        source = types.SimpleNamespace(read=read)
+        reader = zstandard.ZstdDecompressor().stream_reader(source, read_size=READ_SIZE, read_across_frames=True)
+        try:
+            while True:
+                block = reader.read(READ_SIZE)
+                if not block:
+                    return
+                yield check(block)
+        except zstandard.ZstdError as e:
+            raise InvalidLine(0, f'Body is not valid zstd: {e}')
+
+    elif content_encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            while True:
+                data = read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    yield check(decompressor.decompress(data, READ_SIZE))
+                    if decompressor.eof:
+                        # concatenated gzip members
+                        data = decompressor.unused_data
+                        if data:
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    else:
+                        data = decompressor.unconsumed_tail
+            yield check(decompressor.flush())
+        except zlib.error as e:
+            raise InvalidLine(0, f'Body is not valid gzip: {e}')
+
+    elif content_encoding in ('', 'identity'):
+        while True:
+            data = read(READ_SIZE)
+            if not data:
+                return
+            yield check(data)
+
+    else:
+        raise InvalidLine(0, f'Content-Encoding {content_encoding} is not supported.')
+
+
+def iter_ndjson(blocks):
+    '''
+    blocks of bytes -> one dict per non empty line
+    '''
+    buffer = b''
+    line_number = 0
+    for block in blocks:
+        buffer += block
+        *lines, buffer = buffer.split(b'\n')
+        if len(buffer) > MAX_LINE_SIZE:
+            raise InvalidLine(line_number + len(lines) + 1, 'Line is too long.')
+        for line in lines:
+            line_number += 1
+            row = parse_line(line, line_number)
+            if row is not None:
+                yield row
+    row = parse_line(buffer, line_number + 1)
+    if row is not None:
+        yield row
+
+
+def parse_line(line, line_number):
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        row = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        raise InvalidLine(line_number, 'Data is not valid or is not well formated.')
+    if not isinstance(row, dict):
+        raise InvalidLine(line_number, 'Each line should be a json object.')
+    return row
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class APIStreamImportBaseView(View):
+    '''
+    NDJSON body, optionally gzip / zstd compressed (Content-Encoding), any number of rows.
+    the datasource uuid is given as ?datasource=.
+    rows are staged as raw records every BATCH_SIZE_L rows, the task only gets the datalist.
+    each chunk is claimed with payloads.claim_batch, by the Idempotency-Key header and its index, or by its rows.
+    a plain django view, so the body is read as it arrives instead of being loaded by the rest framework parsers.
+    '''
+    importer = None
+
+    def clean_rows(self, rows):
+        return rows
+
+    def stage(self, team, datasource, rows, key):
+        '''
+        key: idempotency key of the chunk, returns False when the chunk was already received
+        '''
+        batch = claim_batch(team, key)
+        if not batch:
+            return False
+
+        datalist = stage_rows(self.importer(team, datasource), rows)
+        batch.datalist = datalist
+        batch.save(update_fields=['datalist', 'u_at'])
+
+        args = (f'{self.importer.__module__}.{self.importer.__name__}', team.id, datasource.id, datalist.id)
+        if settings.DEBUG is True:
+            process_staged_datalist(*args)
+        else:
+            process_staged_datalist.delay(*args)
+        return True
+
+    def post(self, request, *args, **kwargs):
+
+        signature = kwargs.get('signature')
+        api_key = request.headers.get('X-Api-Key')
+
+        if not any([signature, api_key]):
+            return JsonResponse({'result': False, 'msg': {'title': 'Value Missing', 'text': 'Signature or api_key is missing.'}}, status=status.HTTP_400_BAD_REQUEST)
+
+        team = ExternalAppApiKey.get_team(signature, api_key)
+
+        if not team:
+            return JsonResponse({'result': False, 'msg': {'title': 'Not Valid', 'text': 'api_key is not valid or is expired.'}}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            datasource = DataSource.objects.filter(uuid=request.GET.get('datasource')).only('id').first()
+        except ValidationError:
+            datasource = None
+
+        if not datasource:
+            return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': 'Datasource is missing.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        # every chunk is claimed on its own, a replayed body only stages the chunks which were not received yet
+        idempotency_key = request.headers.get('Idempotency-Key')
+        count_rows = 0
+        count_datalists = 0
+        count_duplicates = 0
+        chunks = 0
+        rows = []
+
+        def flush(rows):
+            nonlocal count_rows, count_datalists, count_duplicates, chunks
+            chunks += 1
+            rows = self.clean_rows(rows)
+            if not rows:
+                return
+            key = batch_key(request.path, orjson.dumps(rows), idempotency_key and f'{idempotency_key}:{chunks}')
+            if self.stage(team, datasource, rows, key):
+                count_datalists += 1
+            else:
+                count_duplicates += 1
+            count_rows += len(rows)
+
+        try:
+            for row in iter_ndjson(iter_decompressed(request.read, request.headers.get('Content-Encoding'))):
+                rows.append(row)
+                if len(rows) >= settings.BATCH_SIZE_L:
+                    flush(rows)
+                    rows = []
+            flush(rows)
+        except InvalidLine as e:
+            # the chunks before the invalid line are already staged
+            return JsonResponse({
+                'result': False,
+                'msg': {'title': 'Invalid data', 'text': str(e)},
+                'rows': count_rows,
+                'datalists': count_datalists,
+                'duplicates': count_duplicates,
+            }, status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        return JsonResponse({
+            'result': True,
+            'msg': {'title': 'OK', 'text': 'Data is recived'},
+            'rows': count_rows,
+            'datalists': count_datalists,
+            'duplicates': count_duplicates,
+        }, status=status.HTTP_200_OK)
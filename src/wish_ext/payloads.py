@@ -0,0 +1,73 @@
+import datetime
+import hashlib
+import zlib
+
+import orjson
+
+from django.conf import settings
+from django.utils import timezone
+
+from importly.models import DataList
+
+from .wish_importly.models import DataListFailure, ImportBatch, ImportPayload
+
+
+def batch_key(path, body, idempotency_key=None):
+    '''
+    the Idempotency-Key header if the partner sends one, the body otherwise, scoped to the endpoint
+    '''
+    key = hashlib.sha256(path.encode('utf8'))
+    key.update(idempotency_key.encode('utf8') if idempotency_key else body)
+    return key.hexdigest()
+
+
+def claim_batch(team, key):
+    '''
+    returns the ImportBatch to import with, or None when the same batch is already done or still running.
+    a batch whose datalist failed, or which did not reach STEP_DONE within APP_TASK_TIME_LIMIT_SM, can be replayed.
+    '''
+    batch, created = ImportBatch.objects.select_related('datalist').get_or_create(team=team, key=key)
+    if created:
+        return batch
+    failed = batch.datalist_id and DataListFailure.objects.filter(datalist_id=batch.datalist_id).exists()
+    if batch.datalist and batch.datalist.step == DataList.STEP_DONE:
+        return None
+    if not failed and batch.u_at > timezone.now() - datetime.timedelta(seconds=settings.APP_TASK_TIME_LIMIT_SM):
+        return None
+    batch.save(update_fields=['u_at'])
+    return batch
+
+
+def store_payload(team, data, batch=None):
+    '''
+    returns the ImportPayload to hand to a task instead of data
+    '''
+    raw = orjson.dumps(data)
+    return ImportPayload.objects.create(team=team, data=zlib.compress(raw), size=len(raw), batch=batch)
+
+
+def load_payload(payload_id):
+    payload = ImportPayload.objects.only('data').get(id=payload_id)
+    return orjson.loads(zlib.decompress(bytes(payload.data)))
+
+
+def attach_datalist(payload_id, datalist):
+    ImportPayload.objects.filter(id=payload_id).update(datalist=datalist)
+    ImportBatch.objects.filter(importpayload=payload_id).update(datalist=datalist)
+
+
+def delete_payload(payload_id):
+    ImportPayload.objects.filter(id=payload_id).delete()
+
+
+def collect_payloads():
+    '''
+    payloads of finished datalists are deleted,
+    payloads which never got a datalist are kept settings.WISH_PAYLOAD_RETENTION_DAYS for debugging,
+    batch keys are kept as long, replays older than that are imported again.
+    '''
+    ImportPayload.objects.filter(datalist__step=DataList.STEP_DONE).delete()
+
+    expired_at = timezone.now() - datetime.timedelta(days=getattr(settings, 'WISH_PAYLOAD_RETENTION_DAYS', 7))
+    ImportPayload.objects.filter(datalist__isnull=True, c_at__lt=expired_at).delete()
+    ImportBatch.objects.filter(c_at__lt=expired_at).delete()
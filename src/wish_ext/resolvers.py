@@ -0,0 +1,183 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+
+from team.models import ClientBase
+
+from .wish.models import Brand, MemberLevelBase, EventBase
+
+
+def chunked(items, chunk_size=None):
+    chunk_size = chunk_size or settings.BATCH_SIZE_M
+    items = list(items)
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def resolve_external_ids(queryset, external_ids, *fields, key='external_id', chunk_size=None):
+    '''
+    look up only the given external_ids in queryset, in chunks.
+    returns { external_id: id }, or { external_id: { field: value } } if fields are given.
+    '''
+    external_ids = set(external_id for external_id in external_ids if external_id not in (None, ''))
+
+    data = {}
+    for chunk in chunked(external_ids, chunk_size):
+        if fields:
+            rows = queryset.filter(**{f'{key}__in': chunk}).values(key, *fields)
+            for row in rows:
+                data[row[key]] = row
+        else:
+            rows = queryset.filter(**{f'{key}__in': chunk}).values_list(key, 'id')
+            for external_id, id in rows:
+                data[external_id] = id
+    return data
+
+
+class LocalResolverBackend:
+    '''
+    in-process LRU over the hot keys, for single-worker deployments only (settings.WISH_RESOLVER_BACKEND = 'local')
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.versions = dict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    self.data.move_to_end(key)
+                    found[key] = self.data[key]
+        return found
+
+    def set_many(self, mapping):
+        with self.lock:
+            for key, value in mapping.items():
+                self.data[key] = value
+                self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def get_version(self, team_id):
+        return self.versions.get(team_id, 0)
+
+    def incr_version(self, team_id):
+        with self.lock:
+            self.versions[team_id] = self.versions.get(team_id, 0) + 1
+
+
+class SharedResolverBackend:
+    '''
+    django cache (redis / memcached) shared by all the workers, the cache evicts on its own
+    '''
+
+    def __init__(self, alias, timeout):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get_many(self, keys):
+        return self.cache.get_many(list(keys))
+
+    def set_many(self, mapping):
+        self.cache.set_many(mapping, timeout=self.timeout)
+
+    def version_key(self, team_id):
+        return f'wish_ext:resolver:version:{team_id}'
+
+    def get_version(self, team_id):
+        return self.cache.get(self.version_key(team_id), 0)
+
+    def incr_version(self, team_id):
+        key = self.version_key(team_id)
+        self.cache.add(key, 0, timeout=None)
+        self.cache.incr(key)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        # the local backend only sees the invalidations of its own process, it is opt-in for single-worker deployments
+        if getattr(settings, 'WISH_RESOLVER_BACKEND', 'shared') == 'local':
+            _backend = LocalResolverBackend(getattr(settings, 'WISH_RESOLVER_MAX_SIZE', 200000))
+        else:
+            _backend = SharedResolverBackend(
+                getattr(settings, 'WISH_RESOLVER_CACHE_ALIAS', 'default'),
+                getattr(settings, 'WISH_RESOLVER_TIMEOUT', 60 * 60 * 24),
+            )
+    return _backend
+
+
+def invalidate_team(team_id):
+    '''
+    bump the data version of the team, every cached mapping of the team is dropped at once.
+    removing rows with queryset.update(removed=True) sends no signal, whoever does it calls this afterwards
+    '''
+    get_backend().incr_version(team_id)
+
+
+class Resolver:
+    '''
+    cached external_id -> id of one kind of rows of a team.
+    only found ids are cached, external_ids which are not there yet are looked up again next time.
+    '''
+
+    def __init__(self, name, team_id, queryset, key='external_id'):
+        self.name = name
+        self.team_id = team_id
+        self.queryset = queryset
+        self.key = key
+        self.backend = get_backend()
+        self.version = self.backend.get_version(team_id)
+
+    def cache_key(self, external_id):
+        # external_ids may be long or contain characters memcached does not accept in keys
+        digest = hashlib.md5(str(external_id).encode('utf8')).hexdigest()
+        return f'wish_ext:resolver:{self.team_id}:{self.version}:{self.name}:{digest}'
+
+    def resolve(self, external_ids):
+        external_ids = set(external_id for external_id in external_ids if external_id not in (None, ''))
+        cache_keys = {self.cache_key(external_id): external_id for external_id in external_ids}
+
+        data = {cache_keys[cache_key]: id for cache_key, id in self.backend.get_many(cache_keys).items()}
+
+        missing = external_ids - set(data)
+        if missing:
+            found = resolve_external_ids(self.queryset, missing, key=self.key)
+            self.add(found)
+            data.update(found)
+        return data
+
+    def add(self, mapping):
+        '''
+        populate the cache with rows the importer has just created
+        '''
+        if mapping:
+            self.backend.set_many({self.cache_key(external_id): id for external_id, id in mapping.items()})
+
+
+def invalidate_on_remove(sender, instance, signal, **kwargs):
+    '''
+    removed rows must not be resolved from the cache anymore
+    '''
+    if signal is post_delete or getattr(instance, 'removed', False):
+        invalidate_team(instance.team_id)
+
+
+def connect_signals():
+    '''
+    called from WishConfig.ready, so the receivers are there in every process and not only where this module was imported
+    '''
+    for model in (ClientBase, Brand, MemberLevelBase, EventBase):
+        post_save.connect(invalidate_on_remove, sender=model, dispatch_uid=f'resolver_{model.__name__}_save')
+        post_delete.connect(invalidate_on_remove, sender=model, dispatch_uid=f'resolver_{model.__name__}_delete')
@@ -5,7 +5,7 @@ from dateutil.relativedelta import relativedelta
 from django.utils import timezone
 from django.db.models.query import Q
 from django.db.models.functions import Coalesce, Cast
-from django.db.models import QuerySet, Count, Avg, F, IntegerField, OuterRef, Subquery, Sum, CharField, TextField, Min, Max
+from django.db.models import QuerySet, Count, Avg, F, IntegerField, OuterRef, Subquery, Sum, CharField, TextField, Min, Max, Exists
 from django.contrib.postgres.aggregates import ArrayAgg
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.fields.jsonb import KeyTextTransform
@@ -17,9 +17,13 @@ from filtration.exceptions import UseIdList
 from tag_assigner.models import ValueTag
 
 from cerem.tasks import aggregate_from_cerem
-from .models import PurchaseBase
+
+from ..segments import bitmap_condition
+from .models import PurchaseBase, NESLInterval
+from .nesl import STATE_NEW, STATE_EXISTING, STATE_SLEEPING, STATE_LOST
 
 @condition('品牌名稱', tab='訂單記錄')
+@bitmap_condition
 class Brands(SelectCondition):
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
         client_qs = client_qs.annotate(
@@ -87,6 +91,7 @@ class PurchaseValuesConditionBase(RangeCondition):
 
 
 @condition('營業額', tab='訂單記錄')
+@bitmap_condition
 class TotalSales(PurchaseValuesConditionBase):
 
     def filter(self, client_qs: QuerySet, value_range: Any) -> Tuple[QuerySet, Q]:
@@ -98,6 +103,7 @@ class TotalSales(PurchaseValuesConditionBase):
 
 
 @condition('平均金額', tab='訂單記錄')
+@bitmap_condition
 class AvgAmount(PurchaseValuesConditionBase):
     minimum = 0
     maximum = 1000
@@ -111,6 +117,7 @@ class AvgAmount(PurchaseValuesConditionBase):
 
 
 @condition('交易單數', tab='訂單記錄')
+@bitmap_condition
 class OrderCount(PurchaseValuesConditionBase):
     minimum = 0
     maximum = 50
@@ -124,6 +131,7 @@ class OrderCount(PurchaseValuesConditionBase):
 
 
 @condition('門市名稱', tab='訂單記錄')
+@bitmap_condition
 class Shops(SelectCondition):
     ATTRIBUTION_KEY = '門市名稱'
 
@@ -173,6 +181,7 @@ class Shops(SelectCondition):
 
 
 @condition('單筆金額', tab='訂單記錄')
+@bitmap_condition
 class AnyOrderPriceRange(PurchaseValuesConditionBase):
     minimum = 0
     maximum = 5000
@@ -187,6 +196,7 @@ class AnyOrderPriceRange(PurchaseValuesConditionBase):
 
 
 @condition('RFM', tab='訂單記錄')
+@bitmap_condition
 class RFM(Condition):
     class LEVEL:
         HIGH = 'high'
@@ -245,20 +255,29 @@ class RFM(Condition):
 
 
 @condition('NESL', tab='訂單記錄')
+@bitmap_condition
 class NESL(MultiCheckBoxCondition):
     class TYPE:
         NO_ORDER = 'no_order'
         LOST = 'lost'
         SLEEPING = 'sleeping'
         ACTIVE = 'active'
+        EXISTING = 'existing'
         NEW = 'new'
         CHOICES = {
             NO_ORDER: '未購會員',
             LOST: '流失會員',
             SLEEPING: '瞌睡會員',
             ACTIVE: '主力會員',
+            EXISTING: '既有會員',
             NEW: '新會員'
         }
+        STATES = {
+            NEW: STATE_NEW,
+            EXISTING: STATE_EXISTING,
+            SLEEPING: STATE_SLEEPING,
+            LOST: STATE_LOST,
+        }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -268,24 +287,27 @@ class NESL(MultiCheckBoxCondition):
         self.choice(*choices)
 
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
-        now = timezone.now()
-        recent_datetime = now - relativedelta(months=3)
-        period_datetime = now - relativedelta(months=6)
-        order_filter = Q(purchasebase__removed=False, purchasebase__status=PurchaseBase.STATUS_CONFIRMED)
-        client_qs = client_qs.annotate(
-            first_purchase=Min('purchasebase__datetime', filter=order_filter), purchase_count=Count('purchasebase', filter=order_filter),
-            last_purchase=Max('purchasebase__datetime', filter=order_filter)
-        )
+        today = timezone.localtime(timezone.now()).date()
         q = Q()
         if self.TYPE.NO_ORDER in choices:
-            q |= Q(purchase_count=0)
-        if self.TYPE.NEW in choices:
-            q |= Q(first_purchase__gte=recent_datetime, purchase_count=1)
-        if self.TYPE.SLEEPING in choices:
-            q |= Q(last_purchase__lt=recent_datetime, purchase_count__gt=1)
+            client_qs = client_qs.annotate(
+                has_purchase=Exists(
+                    PurchaseBase.objects.filter(clientbase_id=OuterRef('id'), removed=False, status=PurchaseBase.STATUS_CONFIRMED)
+                )
+            )
+            q |= Q(has_purchase=False)
         if self.TYPE.ACTIVE in choices:
             q |= Q(rfm_percentile__gt=8)
-        if self.TYPE.LOST in choices:
-            q |= Q(last_purchase__lt=period_datetime, purchase_count__gt=1)
+
+        states = [state for choice, state in self.TYPE.STATES.items() if choice in choices]
+        if states:
+            client_qs = client_qs.annotate(
+                nesl_matched=Exists(
+                    NESLInterval.objects.filter(
+                        clientbase_id=OuterRef('id'), state__in=states, date_from__lte=today, date_to__gt=today
+                    )
+                )
+            )
+            q |= Q(nesl_matched=True)
 
         return client_qs, q
@@ -1,9 +1,13 @@
 import re
 
 from datahub.models import DataType, data_type
-from django.db.models import Min, Max, F
+from django.conf import settings
+from django.urls import reverse
+from django.db.models import Min, Max, F, Q, Func, Value, CharField
+from django.db.models.functions import Coalesce
 
 from ..extension import wish_ext
+from ..wish_importly.models import DataListTimeBounds
 
 @data_type
 class DataTypeOrder(DataType):
@@ -27,28 +31,64 @@ class DataTypeOrder(DataType):
 
     @staticmethod
     def get_datetime_min(datalist):
-        aggregation = datalist.order_set.aggregate(min_datetime=Min('datetime'))
-        return aggregation['min_datetime']
+        return DataListTimeBounds.get(datalist, datalist.order_set).datetime_min
 
     @staticmethod
     def get_datetime_max(datalist):
-        aggregation = datalist.order_set.aggregate(max_datetime=Max('datetime'))
-        return aggregation['max_datetime']
+        return DataListTimeBounds.get(datalist, datalist.order_set).datetime_max
+
+    # rows rendered with the detail page, the others are fetched page by page from get_records_url
+    RECORDS_PAGE_SIZE = 50
+
+    # sortable columns of get_records_fields_display
+    RECORDS_ORDERING = {
+        '_id': 'order__external_id',
+        'datetime': 'order__datetime',
+        'total_price': 'order__purchasebase__total_price',
+        'client_id': 'client__external_id',
+    }
 
     @staticmethod
-    def get_records(datalist):
-        records = list(datalist.datalistrow_set.values(
+    def get_records_queryset(datalist, search=None, order_by=None):
+        '''
+        search: part of the order or client external id, order_by: a key of RECORDS_ORDERING, - for descending
+        '''
+        records = datalist.datalistrow_set.all()
+        if search:
+            records = records.filter(Q(order__external_id__icontains=search) | Q(client__external_id__icontains=search))
+
+        field = DataTypeOrder.RECORDS_ORDERING.get((order_by or '').lstrip('-'))
+        if field:
+            records = records.order_by(F(field).desc(nulls_last=True) if order_by.startswith('-') else F(field).asc(nulls_last=True), 'id')
+        else:
+            records = records.order_by('id')
+
+        return records.values(
             _id=F('order__external_id'),
-            datetime=F('order__datetime'),
+            datetime=Coalesce(Func(F('order__datetime'), Value('YYYY/MM/DD HH24:MI:SS'), function='to_char', output_field=CharField()), Value('-')),
             total_price=F('order__purchasebase__total_price'),
             client_id=F('client__external_id')
-        ))
-        for item in records:
-            try:
-                item['datetime'] = item['datetime'].strftime('%Y/%m/%d %H:%M:%S')
-            except:
-                item['datetime'] = '-'
-        return records
+        )
+
+    @staticmethod
+    def count_records(datalist, search=None):
+        return DataTypeOrder.get_records_queryset(datalist, search).count()
+
+    @staticmethod
+    def get_records(datalist, offset=0, limit=RECORDS_PAGE_SIZE, search=None, order_by=None):
+        '''
+        one page of the datalist detail table, datetimes are formatted by the database.
+        the detail page only gets the first page, its table reads the next ones from get_records_url
+        '''
+        records = DataTypeOrder.get_records_queryset(datalist, search, order_by)
+        return list(records[offset:offset + limit])
+
+    @staticmethod
+    def get_records_url(datalist):
+        '''
+        server side datatables source of the detail table, see retail.views.OrderDataListRecords
+        '''
+        return reverse('retail:datalist-records', kwargs={'datalist_id': datalist.id})
 
 @data_type
 class DataTypeProduct(DataType):
@@ -0,0 +1,260 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:15
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def dedup_external_ids(apps, schema_editor):
+    '''
+    keeps the latest purchase / product of every (team, external_id) so the unique constraints can be added.
+    the staged rows of a dropped one are moved to the kept one, the order products of a dropped purchase
+    are deleted (the kept purchase has its own from the latest import), those of a dropped product are moved
+    '''
+    PurchaseBase = apps.get_model('retail', 'PurchaseBase')
+    RetailProduct = apps.get_model('retail', 'RetailProduct')
+    orderproduct_table = apps.get_model('retail', 'OrderProduct')._meta.db_table
+    order_table = apps.get_model('retail_importly', 'Order')._meta.db_table
+    orderrow_table = apps.get_model('retail_importly', 'OrderRow')._meta.db_table
+    product_table = apps.get_model('retail_importly', 'Product')._meta.db_table
+
+    def duplicates(model):
+        return f'''
+            SELECT id, keep_id FROM (
+                SELECT id, max(id) OVER (PARTITION BY team_id, external_id) AS keep_id FROM {model._meta.db_table}
+            ) ranked
+            WHERE id <> keep_id
+        '''
+
+    def categories_table(model):
+        return model._meta.get_field('categories').remote_field.through._meta.db_table
+
+    with schema_editor.connection.cursor() as cursor:
+        purchases = duplicates(PurchaseBase)
+        cursor.execute(f'''
+            UPDATE {order_table} SET purchasebase_id = duplicate.keep_id FROM ({purchases}) duplicate
+            WHERE {order_table}.purchasebase_id = duplicate.id
+        ''')
+        for table in (orderproduct_table, categories_table(PurchaseBase)):
+            cursor.execute(f'DELETE FROM {table} WHERE purchasebase_id IN (SELECT id FROM ({purchases}) duplicate)')
+        cursor.execute(f'DELETE FROM {PurchaseBase._meta.db_table} WHERE id IN (SELECT id FROM ({purchases}) duplicate)')
+
+        products = duplicates(RetailProduct)
+        for table in (orderproduct_table, product_table, orderrow_table):
+            cursor.execute(f'''
+                UPDATE {table} SET productbase_id = duplicate.keep_id FROM ({products}) duplicate
+                WHERE {table}.productbase_id = duplicate.id
+            ''')
+        cursor.execute(
+            f'DELETE FROM {categories_table(RetailProduct)} WHERE retailproduct_id IN (SELECT id FROM ({products}) duplicate)'
+        )
+        cursor.execute(f'DELETE FROM {RetailProduct._meta.db_table} WHERE id IN (SELECT id FROM ({products}) duplicate)')
+
+        # fire the deferred foreign key checks now, ALTER TABLE refuses tables with pending trigger events
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team', '0001_initial'),
+        ('retail', '0002_auto_20221012_1411'),
+        ('retail_importly', '0005_order_purchasebase'),
+    ]
+
+    operations = [
+        # already in the database, the models changed without their migrations
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RenameModel(
+                old_name='ProductBase',
+                new_name='RetailProduct',
+            ),
+            migrations.CreateModel(
+                name='RepurchaseCycle',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('u_at', models.DateTimeField(auto_now=True)),
+                    ('purchase_append_days', models.IntegerField(default=2)),
+                    ('count_cycle', models.IntegerField(default=0)),
+                    ('count_of_clientbase', models.IntegerField(default=0)),
+                    ('clientbases', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('daybase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('cycle_daybase_of_each_client', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('cycle_daybase', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('count_of_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('mean_of_daybase', models.FloatField(default=-1)),
+                    ('median_of_daybase', models.IntegerField(default=-1)),
+                    ('median_low_of_daybase', models.IntegerField(default=-1)),
+                    ('median_high_of_daybase', models.IntegerField(default=-1)),
+                    ('mode_of_daybase', models.IntegerField(default=-1)),
+                    ('pstdev_of_daybase', models.FloatField(default=-1)),
+                    ('pvariance_of_daybase', models.FloatField(default=-1)),
+                    ('stdev_of_daybase', models.FloatField(default=-1)),
+                    ('variance_of_daybase', models.FloatField(default=-1)),
+                    ('essentialized_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('low_of_essentialized_daybase', models.IntegerField(default=-1)),
+                    ('high_of_essentialized_daybase', models.IntegerField(default=-1)),
+                    ('stdev_of_essentialized_daybase', models.FloatField(default=-1)),
+                    ('forced_of_essentialized_daybase', models.FloatField(default=-1)),
+                    ('mean_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('median_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('mode_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('pstdev_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('pvariance_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('stdev_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('variance_of_each_cycle_daybase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('cycle_weekbase_of_each_client', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('cycle_weekbase', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('count_of_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('mean_of_weekbase', models.FloatField(default=-1)),
+                    ('median_of_weekbase', models.IntegerField(default=-1)),
+                    ('median_low_of_weekbase', models.IntegerField(default=-1)),
+                    ('median_high_of_weekbase', models.IntegerField(default=-1)),
+                    ('mode_of_weekbase', models.IntegerField(default=-1)),
+                    ('pstdev_of_weekbase', models.FloatField(default=-1)),
+                    ('pvariance_of_weekbase', models.FloatField(default=-1)),
+                    ('stdev_of_weekbase', models.FloatField(default=-1)),
+                    ('variance_of_weekbase', models.FloatField(default=-1)),
+                    ('essentialized_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('low_of_essentialized_weekbase', models.IntegerField(default=-1)),
+                    ('high_of_essentialized_weekbase', models.IntegerField(default=-1)),
+                    ('stdev_of_essentialized_weekbase', models.FloatField(default=-1)),
+                    ('mean_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('median_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('mode_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                    ('pstdev_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('pvariance_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('stdev_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('variance_of_each_cycle_weekbase', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                    ('team', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+                ],
+            ),
+            migrations.AddIndex(
+                model_name='repurchasecycle',
+                index=models.Index(fields=['team'], name='retail_repu_team_id_6ac3d1_idx'),
+            ),
+        ]),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='segment_type',
+            field=models.CharField(blank=True, choices=[('', '全部'), ('brand', '品牌'), ('shop', '門市'), ('level', '等級')], default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='segment_key',
+            field=models.TextField(blank=True, default=str),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='watermark',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='calculated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='day_histogram',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='week_histogram',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='cycle_day_histogram',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='cycle_week_histogram',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='repurchasecycle',
+            name='client_cycle_histogram',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddIndex(
+            model_name='repurchasecycle',
+            index=models.Index(fields=['team', 'segment_type', 'segment_key'], name='retail_repu_team_id_367fbb_idx'),
+        ),
+        migrations.CreateModel(
+            name='RepurchaseClientState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('clientbase_id', models.IntegerField()),
+                ('last_datetime', models.DateTimeField()),
+                ('count_cycle', models.IntegerField(default=0)),
+                ('count_order', models.IntegerField(default=0)),
+                ('repurchase_cycle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='retail.RepurchaseCycle')),
+                ('team', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+            options={
+                'unique_together': {('repurchase_cycle', 'clientbase_id')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='repurchaseclientstate',
+            index=models.Index(fields=['team'], name='retail_repu_team_id_eb677d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='repurchaseclientstate',
+            index=models.Index(fields=['repurchase_cycle', 'clientbase_id'], name='retail_repu_repurch_667432_idx'),
+        ),
+        migrations.CreateModel(
+            name='NESLInterval',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('clientbase_id', models.IntegerField()),
+                ('state', models.CharField(choices=[('N', 'N'), ('E', 'E'), ('S', 'S'), ('L', 'L')], max_length=1)),
+                ('date_from', models.DateField()),
+                ('date_to', models.DateField()),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='neslinterval',
+            index=models.Index(fields=['team', 'date_from', 'date_to', 'state'], name='retail_nesl_team_id_c19c59_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='neslinterval',
+            index=models.Index(fields=['clientbase_id', 'date_from'], name='retail_nesl_clientb_ba01d0_idx'),
+        ),
+        migrations.AddField(
+            model_name='purchasebase',
+            name='purchase_seq',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='purchasebase',
+            name='days_since_prev_purchase',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='purchasebase',
+            index=models.Index(fields=['team', 'purchase_seq', 'datetime'], name='retail_purc_team_id_a3d5c1_idx'),
+        ),
+        migrations.RunPython(dedup_external_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='purchasebase',
+            unique_together={('team', 'external_id')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='retailproduct',
+            unique_together={('team', 'external_id')},
+        ),
+    ]
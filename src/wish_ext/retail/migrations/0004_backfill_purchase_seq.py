@@ -0,0 +1,54 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:40
+
+from django.db import migrations
+
+STATUS_CONFIRMED = 'CONFIRMED'
+
+
+def backfill_purchase_sequences(apps, schema_editor):
+    '''
+    purchase_seq / days_since_prev_purchase of the existing orders, as PurchaseBase.update_purchase_sequences
+    did when this migration was written. one committed UPDATE per team, an interrupted run redoes the teams left
+    '''
+    table = apps.get_model('retail', 'PurchaseBase')._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'SELECT DISTINCT team_id FROM {table} WHERE purchase_seq IS NULL AND clientbase_id IS NOT NULL')
+        team_ids = [team_id for team_id, in cursor.fetchall()]
+        for team_id in team_ids:
+            cursor.execute(f'''
+                UPDATE {table} AS purchasebase
+                SET purchase_seq = sequence.purchase_seq, days_since_prev_purchase = sequence.days_since_prev_purchase
+                FROM (
+                    SELECT
+                        id,
+                        CASE WHEN removed = false AND status = %s THEN
+                            ROW_NUMBER() OVER w
+                        END AS purchase_seq,
+                        CASE WHEN removed = false AND status = %s THEN
+                            DATE_PART('day', datetime - LAG(datetime) OVER w)::integer
+                        END AS days_since_prev_purchase
+                    FROM {table}
+                    WHERE team_id = %s AND clientbase_id IS NOT NULL
+                    WINDOW w AS (
+                        PARTITION BY clientbase_id, (removed = false AND status = %s)
+                        ORDER BY datetime, id
+                    )
+                ) AS sequence
+                WHERE purchasebase.id = sequence.id AND (
+                    purchasebase.purchase_seq IS DISTINCT FROM sequence.purchase_seq
+                    OR purchasebase.days_since_prev_purchase IS DISTINCT FROM sequence.days_since_prev_purchase
+                )
+            ''', [STATUS_CONFIRMED, STATUS_CONFIRMED, team_id, STATUS_CONFIRMED])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('retail', '0003_repurchase_state_nesl_purchase_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_purchase_sequences, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,23 @@
 from django.urls import reverse
+import datetime
 import html2text
+import itertools
+import math
+import statistics
+from collections import defaultdict
 from uuid import uuid4
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models.functions import TruncDate
+from django.utils import timezone
 from django.contrib.postgres.fields import JSONField, ArrayField
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
 
 from datahub.models import DataSource
 
 from core.models import BaseModel, ValueTaggable
+from core.utils import ForestTimer
 from team.models import Team, OrderBase, ProductBase, ClientBase
 from team.registries import client_info_model
 from tag_assigner.registries import taggable
@@ -15,7 +25,9 @@ from tag_assigner.registries import taggable
 from cerem.utils import TeamMongoDB, F, Sum
 
 from ..extension import wish_ext
-from ..wish.models import Brand
+from ..wish.models import Brand, LevelLogBase
+from .repurchase import RepurchaseAccumulator, expand_histogram, histogram_from_json
+from . import nesl
 
 
 class RepurchaseCycle(BaseModel):
@@ -24,9 +36,30 @@ class RepurchaseCycle(BaseModel):
 
         indexes = [
             models.Index(fields=['team', ]),
+
+            models.Index(fields=['team', 'segment_type', 'segment_key']),
         ]
 
+    SEGMENT_TEAM = ''
+    SEGMENT_BRAND = 'brand'
+    SEGMENT_SHOP = 'shop'
+    SEGMENT_LEVEL = 'level'
+
+    SEGMENT_CHOICES = (
+        (SEGMENT_TEAM, '全部'),
+        (SEGMENT_BRAND, '品牌'),
+        (SEGMENT_SHOP, '門市'),
+        (SEGMENT_LEVEL, '等級'),
+    )
+
+    SHOP_ATTRIBUTION_KEY = '門市名稱'
+
     team = models.ForeignKey(Team, blank=True, null=True, on_delete=models.CASCADE)
+
+    # segment_key: brand id / shop name / member level id, the whole team if segment_type is SEGMENT_TEAM
+    segment_type = models.CharField(choices=SEGMENT_CHOICES, max_length=64, blank=True, default=SEGMENT_TEAM)
+    segment_key = models.TextField(blank=True, default=str)
+
     purchase_append_days = models.IntegerField(default=2)  # if an order day is less than this number, it's a append purcahse (not a re-purchase)
 
     # count
@@ -100,7 +133,122 @@ class RepurchaseCycle(BaseModel):
     stdev_of_each_cycle_weekbase = ArrayField(models.FloatField(), default=list)      # cycle_weekbase - stdev
     variance_of_each_cycle_weekbase = ArrayField(models.FloatField(), default=list)   # cycle_weekbase - variance
 
-    def calculate(self, date_end=None, save_data=True):
+    # incremental state, see calculate(incremental=True)
+    watermark = models.DateTimeField(blank=True, null=True)      # datetime of the latest order taken into account
+    calculated_at = models.DateTimeField(blank=True, null=True)  # orders created after this are not taken into account yet
+
+    day_histogram = JSONField(default=dict)             # { days_between: count }
+    week_histogram = JSONField(default=dict)            # { weeks_between: count }
+    cycle_day_histogram = JSONField(default=dict)       # { nth repurchase: { days_between: count } }
+    cycle_week_histogram = JSONField(default=dict)      # { nth repurchase: { weeks_between: count } }
+    client_cycle_histogram = JSONField(default=dict)    # { count of repurchase: count of clientbase }
+
+    @classmethod
+    def get_segment(cls, team, segment_type=SEGMENT_TEAM, segment_key=''):
+        return cls.objects.filter(team=team, segment_type=segment_type, segment_key=str(segment_key)).first()
+
+    def get_order_queryset(self):
+        qs = self.team.purchasebase_set.filter(
+            status=PurchaseBase.STATUS_CONFIRMED,
+            removed=False,
+            clientbase_id__isnull=False,
+        )
+
+        if self.segment_type == self.SEGMENT_BRAND:
+            qs = qs.filter(brand_id=self.segment_key)
+        elif self.segment_type == self.SEGMENT_SHOP:
+            qs = qs.filter(**{f'attributions__{self.SHOP_ATTRIBUTION_KEY}': self.segment_key})
+        elif self.segment_type == self.SEGMENT_LEVEL:
+            qs = qs.filter(clientbase__wish_info__level_id=self.segment_key)
+
+        return qs
+
+    def scan_orders(self, qs):
+        accumulator = RepurchaseAccumulator(self.purchase_append_days)
+        for clientbase_id, dt in qs.order_by('datetime').values_list('clientbase_id', 'datetime').iterator():
+            accumulator.add(clientbase_id, dt)
+        return accumulator
+
+    def scan_incremental(self, qs):
+        '''
+        merge orders newer than the watermark into the stored histograms,
+        clients with back-dated orders (created after the last run, dated before the watermark)
+        are taken out of the histograms and recomputed from their own history.
+        '''
+        accumulator = RepurchaseAccumulator(self.purchase_append_days)
+        accumulator.load_histograms(self)
+
+        reset_clients = set(
+            qs.filter(c_at__gt=self.calculated_at, datetime__lte=self.watermark)
+            .values_list('clientbase_id', flat=True).distinct()
+        )
+
+        if reset_clients:
+            client_qs = qs.filter(clientbase_id__in=reset_clients)
+            previous = self.scan_orders(client_qs.filter(c_at__lte=self.calculated_at, datetime__lte=self.watermark))
+            current = self.scan_orders(client_qs)
+            accumulator.merge(previous, sign=-1)
+            accumulator.merge(current)
+            accumulator.states.update(current.states)
+            accumulator.changed |= current.changed
+
+        rows = list(
+            qs.filter(datetime__gt=self.watermark).exclude(clientbase_id__in=reset_clients)
+            .order_by('datetime').values_list('clientbase_id', 'datetime')
+        )
+        client_ids = set(clientbase_id for clientbase_id, dt in rows)
+        states = self.repurchaseclientstate_set.filter(clientbase_id__in=client_ids).values_list(
+            'clientbase_id', 'last_datetime', 'count_cycle', 'count_order'
+        )
+        for clientbase_id, last_datetime, count_cycle, count_order in states:
+            accumulator.states[clientbase_id] = [last_datetime, count_cycle, count_order]
+
+        for clientbase_id, dt in rows:
+            accumulator.add(clientbase_id, dt)
+
+        accumulator.reset_clients = reset_clients
+        if accumulator.watermark is None or accumulator.watermark < self.watermark:
+            accumulator.watermark = self.watermark
+
+        return accumulator
+
+    def save_client_states(self, accumulator, full=True):
+        state_map = {}
+        if full:
+            self.repurchaseclientstate_set.all().delete()
+        else:
+            self.repurchaseclientstate_set.filter(clientbase_id__in=accumulator.reset_clients).delete()
+            states = self.repurchaseclientstate_set.filter(clientbase_id__in=accumulator.changed).values_list('clientbase_id', 'id')
+            for clientbase_id, state_id in states:
+                state_map[clientbase_id] = state_id
+
+        states_to_create = []
+        states_to_update = []
+        for clientbase_id in accumulator.changed:
+            last_datetime, count_cycle, count_order = accumulator.states[clientbase_id]
+            state = RepurchaseClientState(
+                id=state_map.get(clientbase_id),
+                team_id=self.team_id,
+                repurchase_cycle=self,
+                clientbase_id=clientbase_id,
+                last_datetime=last_datetime,
+                count_cycle=count_cycle,
+                count_order=count_order,
+            )
+            if state.id:
+                states_to_update.append(state)
+            else:
+                states_to_create.append(state)
+
+        RepurchaseClientState.objects.bulk_create(states_to_create, batch_size=settings.BATCH_SIZE_M)
+        RepurchaseClientState.objects.bulk_update(
+            states_to_update, ['last_datetime', 'count_cycle', 'count_order'], batch_size=settings.BATCH_SIZE_M
+        )
+
+    def summarize(self, accumulator, clientbases, ft=None):
+        '''
+        fill the statistics fields from the histograms of an accumulator
+        '''
 
         def essentialize(data: list) -> tuple:
             length = len(data)
@@ -113,96 +261,38 @@ class RepurchaseCycle(BaseModel):
 
             return (data[0], data[len(data) - 1], stdev)
 
-        ft = ForestTimer()
+        if ft is None:
+            ft = ForestTimer()
 
-        qs = self.team.orderbase_set.filter(
-            status_key=OrderBase.STATUS_CONFIRMED,
-            removed=False,
-        )
-
-        if date_end is not None:
-
-            qs = qs.filter(datetime__lte=date_end)
-
-        data = qs.order_by('datetime').values_list('clientbase_id', 'datetime')
+        count_cycle = accumulator.count_cycle()
+        count_of_clientbase = accumulator.count_of_clientbase()
 
-        ft.step('data')
-
-        # no data to be calculated
-        if len(data) == 0:
-            return False
-
-        count_cycle = 0
-        count_of_clientbase = 0
-
-        daybase = list()
-        weekbase = list()
-        clientbases = list()
+        daybase = expand_histogram(accumulator.day_histogram)
+        daybase = [x for x in daybase if x < 365]  # remove element greater than 365
+        weekbase = expand_histogram(accumulator.week_histogram)
 
         cycle_daybase_of_each_client = list()
         cycle_weekbase_of_each_client = list()
 
-        purchase_append_days = self.purchase_append_days
-
         cycle_daybase = dict()
         cycle_weekbase = dict()
-        last_date_of_client = dict()
-        cycle_count_of_client = dict()
-        order_count_of_client = dict()
-
-        for order in data:
-            id = order[0]
-            dt = order[1]
-            # pids = order[2]
-            # cost = order[3]
-
-            clientbases.append(id)
-
-            if(id in last_date_of_client):
-                if (dt - last_date_of_client[id]).days > purchase_append_days:
-                    delta = dt - last_date_of_client[id]
-                    cycle_count_of_client[id] += 1
-                    days = delta.days
-                    weeks = int(days / 7)
-                    daybase.append(days)
-                    weekbase.append(weeks)
-                    count_cycle += 1
-                    if cycle_count_of_client[id] not in cycle_daybase:
-                        cycle_daybase[cycle_count_of_client[id]] = []
-                        cycle_weekbase[cycle_count_of_client[id]] = []
-
-                    if cycle_count_of_client[id] == 1:
-                        count_of_clientbase += 1
-                    cycle_daybase[cycle_count_of_client[id]].append(days)
-                    cycle_weekbase[cycle_count_of_client[id]].append(weeks)
-                order_count_of_client[id] += 1
-            else:  # first order of this client
-                cycle_count_of_client[id] = 0
-                order_count_of_client[id] = 0
-
-            last_date_of_client[id] = dt
+        for cycle in sorted(accumulator.cycle_day_histogram):
+            days = expand_histogram(accumulator.cycle_day_histogram[cycle])
+            if days:
+                cycle_daybase[cycle] = days
+                cycle_weekbase[cycle] = expand_histogram(accumulator.cycle_week_histogram[cycle])
 
         ft.step('daybase')
 
-        daybase.sort()
-        daybase = [x for x in daybase if x < 365]  # remove element greater than 365
-
+        # count_of_cycle_daybase, count_of_cycle_weekbase
         count_of_cycle_daybase = list()
-        count_of_cycle_weekbase = list()
-        # count_of_cycle_daybase, count_of_cycle_weekbase, client_of_cycle_weekbase
-        for client in cycle_count_of_client.items():
-            id = client[0]
-            count = client[1]
+        for count, clients in sorted(accumulator.client_cycle_histogram.items()):
+            if clients <= 0:
+                continue
             while len(count_of_cycle_daybase) <= count:
                 count_of_cycle_daybase.append(0)
-                count_of_cycle_weekbase.append(0)
-            if count not in cycle_daybase:
-                cycle_weekbase[count] = list()
-                cycle_daybase[count] = list()
-            count_of_cycle_daybase[count] += 1
-            count_of_cycle_weekbase[count] += 1
-            cycle_weekbase[count].append(id)
-            cycle_daybase[count].append(id)
+            count_of_cycle_daybase[count] = clients
+        count_of_cycle_weekbase = list(count_of_cycle_daybase)
 
         ft.step('cycle_count_of_client')
 
@@ -352,7 +442,7 @@ class RepurchaseCycle(BaseModel):
 
         ft.step('cycle_weekbase')
 
-        self.clientbases = list(set(clientbases))
+        self.clientbases = sorted(clientbases)
 
         self.count_cycle = count_cycle
         self.count_of_clientbase = count_of_clientbase
@@ -418,13 +508,371 @@ class RepurchaseCycle(BaseModel):
         self.stdev_of_each_cycle_weekbase = stdev_of_each_cycle_weekbase            # stdev
         self.variance_of_each_cycle_weekbase = variance_of_each_cycle_weekbase      # variance
 
+        accumulator.dump_histograms(self)
+
+    def calculate(self, date_end=None, save_data=True, incremental=False):
+        '''
+        incremental: only orders newer than the last watermark are scanned and merged into
+        the stored per-client state and histograms. Falls back to a full scan when there is
+        no stored state yet or date_end is given. Orders removed / cancelled afterwards are
+        only picked up by a full scan.
+        '''
+
+        ft = ForestTimer()
+
+        calculated_at = timezone.now()
+        qs = self.get_order_queryset().filter(c_at__lte=calculated_at)
+
+        full = not (incremental and date_end is None and self.watermark and self.calculated_at)
+
+        if full:
+            if date_end is not None:
+                qs = qs.filter(datetime__lte=date_end)
+
+            accumulator = self.scan_orders(qs)
+
+            # no data to be calculated
+            if accumulator.watermark is None:
+                return False
+
+            clientbases = accumulator.states.keys()
+        else:
+            accumulator = self.scan_incremental(qs)
+            clientbases = set(self.clientbases) | accumulator.changed
+
+        ft.step('data')
+
+        self.summarize(accumulator, clientbases, ft)
+
         if save_data:
+            self.watermark = accumulator.watermark
+            self.calculated_at = calculated_at
             self.save()
+            self.save_client_states(accumulator, full=full)
 
             ft.step('save')
 
         return True
 
+    @classmethod
+    def segment_data(cls, qs):
+        '''
+        (clientbase_id, datetime, c_at, brand_id, shop_name, level_id) of the orders sorted by (clientbase, datetime)
+        '''
+        return qs.annotate(
+            shop_name=KeyTextTransform(cls.SHOP_ATTRIBUTION_KEY, 'attributions'),
+            level_id=models.F('clientbase__wish_info__level_id'),
+        ).order_by('clientbase_id', 'datetime').values_list('clientbase_id', 'datetime', 'c_at', 'brand_id', 'shop_name', 'level_id')
+
+    @classmethod
+    def get_segments(cls, segment_types, brand_id, shop_name, level_id):
+        '''
+        (segment_type, segment_key) of an order
+        '''
+        segment_keys = {
+            cls.SEGMENT_BRAND: brand_id,
+            cls.SEGMENT_SHOP: shop_name,
+            cls.SEGMENT_LEVEL: level_id,
+        }
+        segments = list()
+        for segment_type in segment_types:
+            segment_key = segment_keys[segment_type]
+            if segment_key is None or segment_key == '':
+                continue
+            segments.append((segment_type, str(segment_key)))
+        return segments
+
+    @classmethod
+    def segments_filter(cls, segments):
+        '''
+        Q of the orders of segment_data in any of the segments
+        '''
+        fields = {
+            cls.SEGMENT_BRAND: 'brand_id',
+            cls.SEGMENT_SHOP: 'shop_name',
+            cls.SEGMENT_LEVEL: 'level_id',
+        }
+        q = models.Q()
+        for segment_type, field in fields.items():
+            segment_keys = [segment_key for _type, segment_key in segments if _type == segment_type]
+            if segment_keys:
+                q |= models.Q(**{f'{field}__in': segment_keys})
+        return q
+
+    @classmethod
+    def calculate_segments(cls, team, segment_types=(SEGMENT_BRAND, SEGMENT_SHOP, SEGMENT_LEVEL), date_end=None, save_data=True, only=None):
+        '''
+        full calculation of every brand / shop / member level segment in a single pass over
+        the orders sorted by (clientbase, datetime), with one accumulator per segment.
+        member level is the current level of the clientbase.
+        only: set of (segment_type, segment_key) to calculate, every segment of segment_types if not given
+        '''
+        ft = ForestTimer()
+
+        calculated_at = timezone.now()
+        cycle_map = {
+            (cycle.segment_type, cycle.segment_key): cycle
+            for cycle in cls.objects.filter(team=team, segment_type__in=segment_types)
+        }
+
+        qs = team.purchasebase_set.filter(
+            status=PurchaseBase.STATUS_CONFIRMED,
+            removed=False,
+            clientbase_id__isnull=False,
+            c_at__lte=calculated_at,
+        )
+
+        if date_end is not None:
+            qs = qs.filter(datetime__lte=date_end)
+
+        data = cls.segment_data(qs)
+        if only is not None:
+            data = data.filter(cls.segments_filter(only))
+
+        accumulators = dict()
+        for clientbase_id, dt, c_at, brand_id, shop_name, level_id in data.iterator():
+            for segment in cls.get_segments(segment_types, brand_id, shop_name, level_id):
+                if only is not None and segment not in only:
+                    continue
+                accumulator = accumulators.get(segment)
+                if accumulator is None:
+                    if segment not in cycle_map:
+                        cycle_map[segment] = cls(team=team, segment_type=segment[0], segment_key=segment[1])
+                    accumulator = RepurchaseAccumulator(cycle_map[segment].purchase_append_days)
+                    accumulators[segment] = accumulator
+
+                accumulator.add(clientbase_id, dt)
+
+        ft.step('data')
+
+        cycles = list()
+        for segment, accumulator in accumulators.items():
+            cycle = cycle_map[segment]
+            cycle.summarize(accumulator, accumulator.states.keys())
+
+            if save_data:
+                cycle.watermark = accumulator.watermark
+                cycle.calculated_at = calculated_at
+                cycle.save()
+                cycle.save_client_states(accumulator)
+
+            cycles.append(cycle)
+
+        ft.step('summarize')
+
+        return cycles
+
+    @classmethod
+    def calculate_segments_incremental(cls, team, segment_types=(SEGMENT_BRAND, SEGMENT_SHOP, SEGMENT_LEVEL)):
+        '''
+        incremental calculation of every brand / shop / member level segment, calculate(incremental=True)
+        of all the segment cycles from a single scan of the orders created since their last run.
+        clients with back-dated orders are recomputed from their own history, like scan_incremental.
+        clients with level logs since the last run are taken out of the level cycle holding their state
+        and recomputed into the cycle of their current level, level cycles left without clients are deleted.
+        returns the segments of the new orders which have no calculated cycle yet, for calculate_segments(only=...)
+        '''
+        ft = ForestTimer()
+
+        calculated_at = timezone.now()
+        cycle_map = {
+            (cycle.segment_type, cycle.segment_key): cycle
+            for cycle in cls.objects.filter(
+                team=team, segment_type__in=segment_types, watermark__isnull=False, calculated_at__isnull=False
+            )
+        }
+        if not cycle_map:
+            return set()
+
+        qs = team.purchasebase_set.filter(
+            status=PurchaseBase.STATUS_CONFIRMED,
+            removed=False,
+            clientbase_id__isnull=False,
+            c_at__lte=calculated_at,
+        )
+        since = min(cycle.calculated_at for cycle in cycle_map.values())
+
+        accumulators = dict()
+
+        def get_accumulator(segment):
+            accumulator = accumulators.get(segment)
+            if accumulator is None:
+                accumulator = RepurchaseAccumulator(cycle_map[segment].purchase_append_days)
+                accumulator.load_histograms(cycle_map[segment])
+                accumulators[segment] = accumulator
+            return accumulator
+
+        reset_clients = defaultdict(set)    # { segment: clientbase ids recomputed from their history }
+
+        # clients whose level moved: { clientbase_id: level segment holding their state }
+        moved_clients = dict()
+        if cls.SEGMENT_LEVEL in segment_types:
+            level_segments = {cycle.id: segment for segment, cycle in cycle_map.items() if segment[0] == cls.SEGMENT_LEVEL}
+            moved_clients = dict.fromkeys(
+                LevelLogBase.objects.filter(team=team, u_at__gt=since).values_list('clientbase_id', flat=True).distinct()
+            )
+            states = RepurchaseClientState.objects.filter(repurchase_cycle_id__in=level_segments, clientbase_id__in=moved_clients)
+            for clientbase_id, cycle_id in states.values_list('clientbase_id', 'repurchase_cycle_id').iterator():
+                moved_clients[clientbase_id] = level_segments[cycle_id]
+                reset_clients[level_segments[cycle_id]].add(clientbase_id)
+
+        ft.step('levels')
+
+        new_segments = set()
+        rows = defaultdict(list)            # { segment: [(clientbase_id, datetime)] } newer than the watermark
+        for clientbase_id, dt, c_at, brand_id, shop_name, level_id in cls.segment_data(qs.filter(c_at__gt=since)).iterator():
+            for segment in cls.get_segments(segment_types, brand_id, shop_name, level_id):
+                cycle = cycle_map.get(segment)
+                if cycle is None:
+                    new_segments.add(segment)
+                elif segment[0] == cls.SEGMENT_LEVEL and clientbase_id in moved_clients:
+                    continue
+                elif c_at <= cycle.calculated_at:
+                    continue
+                elif dt > cycle.watermark:
+                    rows[segment].append((clientbase_id, dt))
+                else:
+                    reset_clients[segment].add(clientbase_id)
+
+        ft.step('data')
+
+        # running states of the clients with new orders, of every segment at once
+        cycle_segments = {cycle_map[segment].id: segment for segment in rows}
+        client_ids = set(clientbase_id for segment_rows in rows.values() for clientbase_id, dt in segment_rows)
+        states = RepurchaseClientState.objects.filter(
+            repurchase_cycle_id__in=cycle_segments, clientbase_id__in=client_ids
+        ).values_list('repurchase_cycle_id', 'clientbase_id', 'last_datetime', 'count_cycle', 'count_order')
+        for cycle_id, clientbase_id, last_datetime, count_cycle, count_order in states.iterator():
+            get_accumulator(cycle_segments[cycle_id]).states[clientbase_id] = [last_datetime, count_cycle, count_order]
+
+        # the history of the reset clients, before (as of the last run) and now
+        previous = dict()
+        current = dict()
+
+        def add_history(segment, clientbase_id, dt, c_at, before=True, now=True):
+            cycle = cycle_map[segment]
+            if segment not in current:
+                previous[segment] = RepurchaseAccumulator(cycle.purchase_append_days)
+                current[segment] = RepurchaseAccumulator(cycle.purchase_append_days)
+            if before and c_at <= cycle.calculated_at and dt <= cycle.watermark:
+                previous[segment].add(clientbase_id, dt)
+            if now:
+                current[segment].add(clientbase_id, dt)
+
+        reset_client_ids = set().union(moved_clients, *reset_clients.values())
+        if reset_client_ids:
+            data = cls.segment_data(qs.filter(clientbase_id__in=reset_client_ids))
+            for clientbase_id, dt, c_at, brand_id, shop_name, level_id in data.iterator():
+                for segment in cls.get_segments(segment_types, brand_id, shop_name, level_id):
+                    if segment[0] == cls.SEGMENT_LEVEL and clientbase_id in moved_clients:
+                        continue
+                    if clientbase_id in reset_clients.get(segment, ()):
+                        add_history(segment, clientbase_id, dt, c_at)
+
+                if clientbase_id not in moved_clients:
+                    continue
+                # the level of all the orders of a client is the level the client is in
+                previous_segment = moved_clients[clientbase_id]
+                current_segment = cls.get_segments((cls.SEGMENT_LEVEL, ), brand_id, shop_name, level_id)
+                current_segment = current_segment[0] if current_segment else None
+                if previous_segment is not None:
+                    add_history(previous_segment, clientbase_id, dt, c_at, now=current_segment == previous_segment)
+                if current_segment is None or current_segment == previous_segment:
+                    continue
+                if current_segment in cycle_map:
+                    reset_clients[current_segment].add(clientbase_id)
+                    add_history(current_segment, clientbase_id, dt, c_at, before=False)
+                else:
+                    new_segments.add(current_segment)
+
+        for segment, clients in reset_clients.items():
+            accumulator = get_accumulator(segment)
+            if segment in current:
+                accumulator.merge(previous[segment], sign=-1)
+                accumulator.merge(current[segment])
+                accumulator.states.update(current[segment].states)
+                accumulator.changed |= current[segment].changed
+                accumulator.watermark = current[segment].watermark
+            accumulator.reset_clients = clients
+
+        for segment, segment_rows in rows.items():
+            accumulator = get_accumulator(segment)
+            for clientbase_id, dt in segment_rows:
+                if clientbase_id not in accumulator.reset_clients:
+                    accumulator.add(clientbase_id, dt)
+
+        ft.step('merge')
+
+        for segment, accumulator in accumulators.items():
+            cycle = cycle_map[segment]
+            if not any(count > 0 for count in accumulator.client_cycle_histogram.values()):
+                # every client of the level moved to another one
+                cycle.delete()
+                continue
+
+            if accumulator.watermark is None or accumulator.watermark < cycle.watermark:
+                accumulator.watermark = cycle.watermark
+
+            cycle.summarize(accumulator, (set(cycle.clientbases) - accumulator.reset_clients) | accumulator.changed)
+            cycle.watermark = accumulator.watermark
+            cycle.calculated_at = calculated_at
+            cycle.save()
+            cycle.save_client_states(accumulator, full=False)
+
+        # nothing new for the other segments
+        cls.objects.filter(
+            id__in=[cycle.id for segment, cycle in cycle_map.items() if segment not in accumulators]
+        ).update(calculated_at=calculated_at)
+
+        ft.step('summarize')
+
+        return new_segments
+
+    def get_member_count_of_cycles(self, max_cycle=5):
+        '''
+        [clients without re-purchase, clients with 1 re-purchase, ..., clients with max_cycle or more]
+        '''
+        data = [0] * (max_cycle + 1)
+        for cycle, count in histogram_from_json(self.client_cycle_histogram).items():
+            data[min(cycle, max_cycle)] += count
+        return data
+
+    def get_mean_days_of_cycles(self, max_cycle=5):
+        '''
+        [mean days of the 1st re-purchase, ..., mean days of the max_cycle-th and later]
+        '''
+        days = [0] * max_cycle
+        counts = [0] * max_cycle
+        for cycle, histogram in (self.cycle_day_histogram or {}).items():
+            index = min(int(cycle), max_cycle) - 1
+            for day, count in histogram.items():
+                days[index] += int(day) * count
+                counts[index] += count
+        return [math.ceil(day / count) if count else 0 for day, count in zip(days, counts)]
+
+
+class RepurchaseClientState(BaseModel):
+    '''
+    running state of a clientbase in a RepurchaseCycle, so new orders can be merged
+    into the cycle without scanning the order history again.
+    '''
+
+    class Meta:
+
+        unique_together = [['repurchase_cycle', 'clientbase_id']]
+        indexes = [
+            models.Index(fields=['team', ]),
+            models.Index(fields=['repurchase_cycle', 'clientbase_id']),
+        ]
+
+    team = models.ForeignKey(Team, blank=True, null=True, on_delete=models.CASCADE)
+    repurchase_cycle = models.ForeignKey(RepurchaseCycle, blank=False, on_delete=models.CASCADE)
+    clientbase_id = models.IntegerField(blank=False)
+
+    last_datetime = models.DateTimeField()          # last purchase datetime
+    count_cycle = models.IntegerField(default=0)    # re-purchases so far
+    count_order = models.IntegerField(default=0)    # orders after the first one
+
 
 # class ClientRecency(BaseModel):
 
@@ -462,6 +910,7 @@ class ProductCategory(BaseModel):
 @taggable('product')
 class RetailProduct(ProductBase):
     class Meta:
+        unique_together = [['team', 'external_id']]
         indexes = [
             models.Index(fields=['datasource', ]),
 
@@ -489,10 +938,12 @@ class RetailProduct(ProductBase):
 @taggable('order')
 class PurchaseBase(OrderBase):
     class Meta:
+        unique_together = [['team', 'external_id']]
         indexes = [
             models.Index(fields=['datasource', ]),
 
             models.Index(fields=['team', 'datasource']),
+            models.Index(fields=['team', 'purchase_seq', 'datetime']),
         ]
 
     STATUS_CONFIRMED = 'CONFIRMED'
@@ -510,6 +961,172 @@ class PurchaseBase(OrderBase):
     status = models.CharField(max_length=64, blank=False, null=False, default=STATUS_CONFIRMED)
     is_transaction = models.BooleanField(default=True)
 
+    # only set on confirmed orders, see update_purchase_sequences
+    purchase_seq = models.IntegerField(blank=True, null=True)               # Nth confirmed purchase of the clientbase
+    days_since_prev_purchase = models.IntegerField(blank=True, null=True)   # days since the previous confirmed purchase
+
+    @classmethod
+    def update_total_prices(cls, purchasebase_ids):
+        '''
+        total_price = sum of the non-refound OrderProduct total_price, in one UPDATE
+        '''
+        if not purchasebase_ids:
+            return
+
+        table = cls._meta.db_table
+        orderproduct_table = OrderProduct._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {table} AS purchasebase
+                SET total_price = summary.total_price
+                FROM (
+                    SELECT
+                        purchasebase.id,
+                        COALESCE(SUM(orderproduct.total_price) FILTER (WHERE orderproduct.refound = false), 0) AS total_price
+                    FROM {table} AS purchasebase
+                    LEFT JOIN {orderproduct_table} AS orderproduct ON orderproduct.purchasebase_id = purchasebase.id
+                    WHERE purchasebase.id = ANY(%s)
+                    GROUP BY purchasebase.id
+                ) AS summary
+                WHERE purchasebase.id = summary.id AND purchasebase.total_price IS DISTINCT FROM summary.total_price
+            ''', [list(purchasebase_ids)])
+
+    @classmethod
+    def update_purchase_sequences(cls, team_id, clientbase_ids=None):
+        '''
+        recompute purchase_seq / days_since_prev_purchase of the given clientbases (all clientbases of the team if None)
+        '''
+        table = cls._meta.db_table
+        params = [team_id]
+        client_filter = ''
+        if clientbase_ids is not None:
+            clientbase_ids = [clientbase_id for clientbase_id in clientbase_ids if clientbase_id is not None]
+            if not clientbase_ids:
+                return
+            client_filter = 'AND clientbase_id = ANY(%s)'
+            params.append(clientbase_ids)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {table} AS purchasebase
+                SET purchase_seq = sequence.purchase_seq, days_since_prev_purchase = sequence.days_since_prev_purchase
+                FROM (
+                    SELECT
+                        id,
+                        CASE WHEN removed = false AND status = %s THEN
+                            ROW_NUMBER() OVER w
+                        END AS purchase_seq,
+                        CASE WHEN removed = false AND status = %s THEN
+                            DATE_PART('day', datetime - LAG(datetime) OVER w)::integer
+                        END AS days_since_prev_purchase
+                    FROM {table}
+                    WHERE team_id = %s AND clientbase_id IS NOT NULL {client_filter}
+                    WINDOW w AS (
+                        PARTITION BY clientbase_id, (removed = false AND status = %s)
+                        ORDER BY datetime, id
+                    )
+                ) AS sequence
+                WHERE purchasebase.id = sequence.id AND (
+                    purchasebase.purchase_seq IS DISTINCT FROM sequence.purchase_seq
+                    OR purchasebase.days_since_prev_purchase IS DISTINCT FROM sequence.days_since_prev_purchase
+                )
+            ''', [cls.STATUS_CONFIRMED, cls.STATUS_CONFIRMED] + params + [cls.STATUS_CONFIRMED])
+
+
+class NESLInterval(BaseModel):
+    '''
+    NESL state of a clientbase from date_from (inclusive) to date_to (exclusive),
+    rebuilt nightly from the orders of the clientbases whose orders changed, see rebuild().
+    '''
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['team', 'date_from', 'date_to', 'state']),
+            models.Index(fields=['clientbase_id', 'date_from']),
+        ]
+
+    STATE_CHOICES = (
+        (nesl.STATE_NEW, 'N'),
+        (nesl.STATE_EXISTING, 'E'),
+        (nesl.STATE_SLEEPING, 'S'),
+        (nesl.STATE_LOST, 'L'),
+    )
+
+    team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
+    clientbase_id = models.IntegerField(blank=False)
+    state = models.CharField(choices=STATE_CHOICES, max_length=1, blank=False)
+    date_from = models.DateField()
+    date_to = models.DateField()
+
+    @classmethod
+    def rebuild(cls, team, full=False):
+        '''
+        rebuild the NESL history of a team in one pass over its confirmed orders sorted by (clientbase, date).
+        the intervals of a clientbase only depend on its own orders, so once the team has intervals only the
+        clientbases with orders created / changed (u_at) since the last run (the c_at of the intervals) are rebuilt.
+        orders changed with a queryset update(), which leaves u_at alone, are only picked up with full=True.
+        '''
+        rebuilt_at = timezone.now()
+        qs = team.purchasebase_set.filter(status=PurchaseBase.STATUS_CONFIRMED, removed=False, clientbase_id__isnull=False)
+        intervals = cls.objects.filter(team=team)
+
+        since = None if full else intervals.aggregate(since=models.Max('c_at'))['since']
+        if since is not None:
+            clientbase_ids = list(
+                team.purchasebase_set.filter(u_at__gt=since, clientbase_id__isnull=False)
+                .values_list('clientbase_id', flat=True).distinct()
+            )
+            if not clientbase_ids:
+                return False
+            qs = qs.filter(clientbase_id__in=clientbase_ids)
+            intervals = intervals.filter(clientbase_id__in=clientbase_ids)
+
+        data = (
+            qs.annotate(date=TruncDate('datetime'))
+            .order_by('clientbase_id', 'date')
+            .values_list('clientbase_id', 'date')
+        )
+
+        with transaction.atomic():
+            intervals.delete()
+
+            intervals_to_create = []
+            for clientbase_id, rows in itertools.groupby(data.iterator(), key=lambda row: row[0]):
+                order_days = [date.toordinal() for _, date in rows]
+                for state, day_from, day_to in nesl.nesl_intervals(order_days):
+                    intervals_to_create.append(cls(
+                        team=team,
+                        clientbase_id=clientbase_id,
+                        state=state,
+                        date_from=datetime.date.fromordinal(day_from),
+                        date_to=datetime.date.fromordinal(day_to),
+                        c_at=rebuilt_at,
+                    ))
+
+                if len(intervals_to_create) >= settings.BATCH_SIZE_L:
+                    cls.objects.bulk_create(intervals_to_create, batch_size=settings.BATCH_SIZE_L)
+                    intervals_to_create = []
+
+            cls.objects.bulk_create(intervals_to_create, batch_size=settings.BATCH_SIZE_L)
+
+        return True
+
+    @classmethod
+    def filter_at(cls, team, date):
+        return cls.objects.filter(team=team, date_from__lte=date, date_to__gt=date)
+
+    @classmethod
+    def count_states(cls, team, date):
+        '''
+        { state: count of clientbase } as of date
+        '''
+        data = {state: 0 for state, name in cls.STATE_CHOICES}
+        counts = cls.filter_at(team, date).values('state').annotate(count=models.Count('id')).values_list('state', 'count')
+        for state, count in counts:
+            data[state] = count
+        return data
+
 
 class OrderProduct(BaseModel):
 
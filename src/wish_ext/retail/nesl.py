@@ -0,0 +1,53 @@
+from bisect import bisect_left, bisect_right
+
+STATE_NEW = 'N'
+STATE_EXISTING = 'E'
+STATE_SLEEPING = 'S'
+STATE_LOST = 'L'
+
+NE_DAYS = 90        # orders in [date - 90, date] -> N / E
+SL_DAYS_FROM = 365  # orders in [date - 365, date - 120] -> S / L
+SL_DAYS_TO = 120
+
+
+def nesl_state(order_days, day):
+    '''
+    order_days: sorted date ordinals of the orders of a clientbase
+    returns the NESL state as of day, None if the clientbase is in none of the groups.
+    clientbases having orders in both the NE and the SL range belong to neither group.
+    '''
+    ne_count = bisect_right(order_days, day) - bisect_left(order_days, day - NE_DAYS)
+    sl_count = bisect_right(order_days, day - SL_DAYS_TO) - bisect_left(order_days, day - SL_DAYS_FROM)
+
+    if ne_count and sl_count:
+        return None
+    if ne_count:
+        return STATE_NEW if ne_count == 1 else STATE_EXISTING
+    if sl_count:
+        return STATE_SLEEPING if sl_count == 1 else STATE_LOST
+    return None
+
+
+def nesl_intervals(order_days):
+    '''
+    order_days: sorted date ordinals of the orders of a clientbase
+    returns [(state, day_from, day_to)], day_to exclusive
+    '''
+    # the state can only change when an order enters / leaves one of the ranges
+    candidates = set()
+    for day in order_days:
+        candidates.update((day, day + NE_DAYS + 1, day + SL_DAYS_TO, day + SL_DAYS_FROM + 1))
+
+    intervals = []
+    current_state = None
+    current_from = None
+    for day in sorted(candidates):
+        state = nesl_state(order_days, day)
+        if state == current_state:
+            continue
+        if current_state is not None:
+            intervals.append((current_state, current_from, day))
+        current_state = state
+        current_from = day
+
+    return intervals
@@ -0,0 +1,117 @@
+from collections import Counter, defaultdict
+
+
+class RepurchaseAccumulator:
+    '''
+    Folds orders of each client (in datetime order) into the running state the
+    repurchase cycle needs, and keeps the repurchase gaps as histograms so the
+    aggregates can be merged / subtracted without rescanning history.
+
+    states: { clientbase_id: [last_datetime, count_cycle, count_order] }
+    '''
+
+    def __init__(self, purchase_append_days, states=None):
+        self.purchase_append_days = purchase_append_days
+        self.states = states if states is not None else dict()
+
+        self.day_histogram = Counter()              # { days: count }
+        self.week_histogram = Counter()             # { weeks: count }
+        self.cycle_day_histogram = defaultdict(Counter)   # { nth cycle: { days: count } }
+        self.cycle_week_histogram = defaultdict(Counter)  # { nth cycle: { weeks: count } }
+        self.client_cycle_histogram = Counter()     # { count_cycle: count of clientbase }
+
+        self.changed = set()
+        self.reset_clients = set()
+        self.watermark = None
+
+    def add(self, clientbase_id, dt):
+        state = self.states.get(clientbase_id)
+
+        if state is None:  # first order of this client
+            self.states[clientbase_id] = [dt, 0, 0]
+            self.client_cycle_histogram[0] += 1
+        else:
+            days = (dt - state[0]).days
+            if days > self.purchase_append_days:
+                weeks = int(days / 7)
+                self.client_cycle_histogram[state[1]] -= 1
+                state[1] += 1
+                self.client_cycle_histogram[state[1]] += 1
+
+                self.day_histogram[days] += 1
+                self.week_histogram[weeks] += 1
+                self.cycle_day_histogram[state[1]][days] += 1
+                self.cycle_week_histogram[state[1]][weeks] += 1
+            state[2] += 1
+            state[0] = dt
+
+        self.changed.add(clientbase_id)
+        if self.watermark is None or dt > self.watermark:
+            self.watermark = dt
+
+    def merge(self, other, sign=1):
+        '''
+        add (sign=1) or remove (sign=-1) the histograms of another accumulator,
+        states are not touched.
+        '''
+        for mine, theirs in (
+            (self.day_histogram, other.day_histogram),
+            (self.week_histogram, other.week_histogram),
+            (self.client_cycle_histogram, other.client_cycle_histogram),
+        ):
+            for key, value in theirs.items():
+                mine[key] += sign * value
+
+        for mine, theirs in (
+            (self.cycle_day_histogram, other.cycle_day_histogram),
+            (self.cycle_week_histogram, other.cycle_week_histogram),
+        ):
+            for cycle, histogram in theirs.items():
+                for key, value in histogram.items():
+                    mine[cycle][key] += sign * value
+
+    def load_histograms(self, cycle):
+        self.day_histogram = histogram_from_json(cycle.day_histogram)
+        self.week_histogram = histogram_from_json(cycle.week_histogram)
+        self.client_cycle_histogram = histogram_from_json(cycle.client_cycle_histogram)
+        self.cycle_day_histogram = defaultdict(Counter, {
+            int(key): histogram_from_json(value) for key, value in (cycle.cycle_day_histogram or {}).items()
+        })
+        self.cycle_week_histogram = defaultdict(Counter, {
+            int(key): histogram_from_json(value) for key, value in (cycle.cycle_week_histogram or {}).items()
+        })
+
+    def dump_histograms(self, cycle):
+        cycle.day_histogram = histogram_to_json(self.day_histogram)
+        cycle.week_histogram = histogram_to_json(self.week_histogram)
+        cycle.client_cycle_histogram = histogram_to_json(self.client_cycle_histogram)
+        cycle.cycle_day_histogram = {
+            str(key): histogram_to_json(value) for key, value in self.cycle_day_histogram.items() if any(value.values())
+        }
+        cycle.cycle_week_histogram = {
+            str(key): histogram_to_json(value) for key, value in self.cycle_week_histogram.items() if any(value.values())
+        }
+
+    def count_cycle(self):
+        return sum(self.day_histogram.values())
+
+    def count_of_clientbase(self):
+        return sum(count for cycle, count in self.client_cycle_histogram.items() if cycle > 0)
+
+
+def histogram_from_json(data):
+    return Counter({int(key): value for key, value in (data or {}).items()})
+
+
+def histogram_to_json(histogram):
+    return {str(key): value for key, value in sorted(histogram.items()) if value}
+
+
+def expand_histogram(histogram):
+    '''
+    histogram -> sorted list of values
+    '''
+    data = list()
+    for key in sorted(histogram):
+        data.extend([key] * histogram[key])
+    return data
@@ -3,6 +3,7 @@ import pandas as pd
 import math
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django_pandas.io import read_frame
 
@@ -14,8 +15,9 @@ from config.celery import app
 from team.models import Team, ClientBase
 from core.utils import run
 
-from .models import PurchaseBase
+from .models import PurchaseBase, RepurchaseCycle, NESLInterval
 from ..extension import wish_ext
+from ..segments import invalidate_segments
 
 
 @app.task
@@ -207,9 +209,59 @@ def calculate_clientbase_rfm_for_team(team_id):
     # update rfm_segment
     team.clientbase_set.bulk_update(items_to_update, ['rfm_segment'], batch_size=settings.BATCH_SIZE_L)
 
+    invalidate_segments(team.id)
+
 
 
 @wish_ext.periodic_task()
 def calculate_rfm():
     for team_id in Team.objects.filter(removed=False).values_list('id', flat=True):
         run(calculate_clientbase_rfm_for_team, team_id)
+
+
+@app.task
+def calculate_repurchase_cycle_for_team(team_id, incremental=True):
+    # queued by every order import and nightly, runs of a team must not overlap: the incremental state is read and written back
+    lock = f'wish_ext:calculate_repurchase_cycle:{team_id}'
+    if not cache.add(lock, True, timeout=settings.APP_TASK_TIME_LIMIT_SM):
+        return
+    try:
+        team = Team.objects.get(id=team_id)
+
+        repurchase_cycle = RepurchaseCycle.get_segment(team)
+        if repurchase_cycle is None:
+            repurchase_cycle = RepurchaseCycle(team=team)
+
+        since = repurchase_cycle.calculated_at
+        repurchase_cycle.calculate(incremental=incremental)
+
+        segment_cycles = RepurchaseCycle.objects.filter(team=team).exclude(segment_type=RepurchaseCycle.SEGMENT_TEAM)
+        if not incremental or since is None or not segment_cycles.exists():
+            RepurchaseCycle.calculate_segments(team)
+            return
+
+        # a single scan of the new orders and level moves for every segment cycle, segments first seen since the last run get their cycle
+        new_segments = RepurchaseCycle.calculate_segments_incremental(team)
+        if new_segments:
+            RepurchaseCycle.calculate_segments(team, only=new_segments)
+    finally:
+        cache.delete(lock)
+
+
+@wish_ext.periodic_task()
+def calculate_repurchase_cycle():
+    for team_id in Team.objects.filter(removed=False).values_list('id', flat=True):
+        run(calculate_repurchase_cycle_for_team, team_id)
+
+
+@app.task
+def rebuild_nesl_intervals_for_team(team_id, full=False):
+    team = Team.objects.get(id=team_id)
+    if NESLInterval.rebuild(team, full=full):
+        invalidate_segments(team.id)
+
+
+@wish_ext.periodic_task()
+def rebuild_nesl_intervals():
+    for team_id in Team.objects.filter(removed=False).values_list('id', flat=True):
+        run(rebuild_nesl_intervals_for_team, team_id)
@@ -12,8 +12,41 @@ from django.conf import settings
 from core import views as core
 from core.utils import TeamAuthPermission, ForestTimer, array_to_dict, make_datetimeStart_datetimeEnd, querydict_to_dict, sort_list_by_key, str_to_hex, bulk_create, bulk_update
 
+from importly.models import DataList
 from team.views import TeamMixin
 
 from ..extension import wish_ext
+from .datahub import DataTypeOrder
 
 retail_router = wish_ext.router('retail/', name='retail')
+
+
+@retail_router.route('datalist/<int:datalist_id>/records/', name='datalist-records')
+class OrderDataListRecords(TeamMixin, View):
+    '''
+    rows of an order datalist for the datatables of its detail page, one page at a time (start / length / search / order),
+    see DataTypeOrder.get_records_url
+    '''
+
+    def get(self, request, datalist_id):
+        datalist = get_object_or_404(DataList, id=datalist_id, team=self.team)
+
+        try:
+            start = max(int(request.GET.get('start', 0)), 0)
+            length = min(max(int(request.GET.get('length', DataTypeOrder.RECORDS_PAGE_SIZE)), 1), settings.BATCH_SIZE_M)
+            draw = int(request.GET.get('draw', 0))
+        except ValueError:
+            return JsonResponse({'result': False}, status=400)
+
+        search = request.GET.get('search[value]') or None
+        order_by = request.GET.get('columns[{}][data]'.format(request.GET.get('order[0][column]')))
+        if order_by and request.GET.get('order[0][dir]') == 'desc':
+            order_by = f'-{order_by}'
+
+        total = DataTypeOrder.count_records(datalist)
+        return JsonResponse({
+            'draw': draw,
+            'recordsTotal': total,
+            'recordsFiltered': DataTypeOrder.count_records(datalist, search) if search else total,
+            'data': DataTypeOrder.get_records(datalist, offset=start, limit=length, search=search, order_by=order_by),
+        })
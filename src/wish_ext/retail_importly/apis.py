@@ -9,7 +9,10 @@ from rest_framework import status
 
 from external_app.models import ExternalAppApiKey
 
-from .tasks import process_orderlist
+from ..ndjson import APIStreamImportBaseView
+from ..payloads import batch_key, claim_batch, store_payload
+from .importers import LineItemOrderImporter
+from .tasks import process_orderlist, process_orderlinelist
 from ..extension import wish_ext
 
 class APIImportBaseView(APIView):
@@ -42,10 +45,17 @@ class APIImportBaseView(APIView):
         if len(data['data']) > settings.BATCH_SIZE_L:
             return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': f'Max row of data per request is {settings.BATCH_SIZE_L}.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
 
+        batch = claim_batch(team, batch_key(request.path, request.body, request.headers.get('Idempotency-Key')))
+        if not batch:
+            # a replay of a batch already applied or in progress
+            return JsonResponse({'result': True, 'msg': {'title': 'OK', 'text': 'Data is already recived'}, 'duplicate': True}, status=status.HTTP_200_OK)
+
+        # only the payload id goes through the broker
+        payload = store_payload(team, data, batch)
         if settings.DEBUG is True:
-            self.task(team_slug=team.slug, data=data)
+            self.task(team_slug=team.slug, payload_id=payload.id)
         else:
-            self.task.delay(team_slug=team.slug, data=data)
+            self.task.delay(team_slug=team.slug, payload_id=payload.id)
 
         return JsonResponse({'result': True, 'msg': {'title': 'OK', 'text': 'Data is recived'}}, status=status.HTTP_200_OK)
 
@@ -53,3 +63,17 @@ class APIImportBaseView(APIView):
 @wish_ext.api('v1/<signature>/orderlist/')
 class ImportEventList(APIImportBaseView):
     task = process_orderlist
+
+
+@wish_ext.api('v1/<signature>/orderlinelist/')
+class ImportOrderLineList(APIImportBaseView):
+    task = process_orderlinelist
+
+
+@wish_ext.api('v1/<signature>/orderlist/stream/')
+class StreamImportOrderList(APIStreamImportBaseView):
+    importer = LineItemOrderImporter
+
+    def clean_rows(self, rows):
+        # orders without line items were never imported
+        return [row for row in rows if row.get('items')]
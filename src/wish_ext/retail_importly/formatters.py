@@ -19,3 +19,25 @@ def format_bool(bool_string):
         return bool(bool_string)
     except:
         return False
+
+def format_refound(refound):
+    if isinstance(refound, bool):
+        return refound
+    if refound is None:
+        return False
+    return format_bool(str(refound))
+
+def format_items(items):
+    if not isinstance(items, list):
+        return []
+    return [
+        {
+            'product_id': str(item.get('product_id', '')),
+            'product_name': str(item.get('product_name', ''))[:64],
+            'price': format_price(item.get('price')),
+            'sale_price': format_price(item.get('sale_price')),
+            'quantity': int(format_price(item.get('quantity', 1))),
+            'total_price': format_price(item.get('total_price')),
+            'refound': format_refound(item.get('refound')),
+        } for item in items if isinstance(item, dict)
+    ]
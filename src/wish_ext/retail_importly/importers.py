@@ -3,23 +3,31 @@ import hashlib
 from dateutil import parser
 
 from django.conf import settings
-from django.db.models import Min, Sum
+from django.db import transaction
+from django.db.models import Min
 
 from importly.importers import DataImporter
-from importly.formatters import (
-    Formatted, format_datetime
-)
+from importly.formatters import Formatted
 
 from datahub.data_flows import handle_data
 from datahub.models import Field, FieldGroup, ChoiceField, PrimaryField
 from team.models import ClientBase
+from core.utils import run
 from orderly.models import Client
 
+from ..columnar import DatetimeFormatter
+from ..instrumentation import instrumented
+from ..resolvers import Resolver
+from ..sharding import assign_shards
+from ..staging import iter_chunks
+from ..upsert import upsert
+from ..wish_importly.models import DataListTimeBounds
 from ..retail.datahub import channels, DataTypeOrder
-from ..retail.models import OrderBase, PurchaseBase, RetailProduct
+from ..retail.models import OrderBase, PurchaseBase, RetailProduct, OrderProduct
+from ..retail.tasks import calculate_repurchase_cycle_for_team
 
-from .formatters import format_dict, format_price, format_bool
-from .models import Order, Product, OrderRow
+from .formatters import format_dict, format_price, format_bool, format_items
+from .models import Order, OrderLine, Product, OrderRow
 
 
 class OrderImporter(DataImporter):
@@ -46,7 +54,7 @@ class OrderImporter(DataImporter):
             status = Formatted(str, 'status')
             brand_id = Formatted(str, 'brand_id')
 
-            datetime = Formatted(format_datetime, 'datetime')
+            datetime = Formatted(DatetimeFormatter(), 'datetime')
 
         class OrderRowTransfer:
             model = OrderRow
@@ -100,167 +108,326 @@ class OrderImporter(DataImporter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.orderbase_map = None
+        self.shard = None
 
+    def get_datalistrows(self):
+        rows = self.datalist.datalistrow_set.order_by('id')
+        if self.shard is not None:
+            rows = rows.filter(order__shard=self.shard)
+        return rows
+
+    def get_orders(self):
+        orders = self.datalist.order_set.all()
+        if self.shard is not None:
+            orders = orders.filter(shard=self.shard)
+        return orders
+
+    @instrumented
     def create_orderbases(self):
-        brand_map = {}
-        brands = self.team.brand_set.filter(removed=False).values_list('id', 'external_id')
-        for brand_id, external_id in brands:
-            brand_map[external_id] = brand_id
+        order_set = self.get_orders()
+        brand_map = Resolver('brand', self.team.id, self.team.brand_set.filter(removed=False)).resolve(
+            order_set.values_list('brand_id', flat=True).distinct()
+        )
         orderbase_map = {}
-        orders = self.team.purchasebase_set.filter(removed=False).values('id', 'external_id')
-        for order in orders:
-            orderbase_map[order['external_id']] = PurchaseBase(id=order['id'])
-        orderbases_to_create = []
-        orderbase = []
-        orders_to_update = []
-        orderbases_to_update = []
-        for order in self.datalist.datalistrow_set.values(
+        for orders in iter_chunks(self.get_datalistrows().values(
             'order__id', 'order__external_id', 'order__clientbase_id', 'order__datetime', 'order__brand_id',
             'order__status', 'order__attributions'
-        ):
-            order['order__status'] = order['order__status'] | PurchaseBase.STATUS_CONFIRMED
-            brand_id = brand_map.get(order['order__brand_id'])
-            if order['order__external_id'] in orderbase_map:
-                orderbase = orderbase_map[order['order__external_id']]
-                update = False
-                if brand_id:
-                    orderbase.brand_id = brand_id
-                    update = True
-                if order['order__datetime']:
-                    orderbase.datetime = order['order__datetime']
-                    update = True
-                if order['order__status']:
-                    orderbase.status = order['order__status']
-                    update = True
-                if order['order__attributions']:
-                    orderbase.attributions.update(order['order__attributions'])
-                    update = True
-                if update and orderbase.id:
-                    orderbases_to_update.append(orderbase)
-            else:
-                orderbase = PurchaseBase(
-                    external_id=order['order__external_id'],
-                    clientbase_id=order['order__clientbase_id'],
-                    datetime=order['order__datetime'],
-                    status=order['order__status'],
-                    attributions=order['order__attributions'],
-                    brand_id=brand_id,
-                    team=self.team
-                )
-                if not orderbase.datetime:
-                    continue
-                orderbase_map[order['order__external_id']] = orderbase
-                orderbases_to_create.append(orderbase)
-            orders_to_update.append([order['order__id'], orderbase])
-        PurchaseBase.objects.bulk_create(orderbases_to_create, batch_size=settings.BATCH_SIZE_M)
-        PurchaseBase.objects.bulk_update(orderbases_to_update, ['datetime', 'brand_id', 'status', 'attributions'], batch_size=settings.BATCH_SIZE_M)
-        orders_to_update = [
-            Order(
-                id=order_id, purchasebase_id=orderbase.id
-            ) for order_id, orderbase in orders_to_update
-        ]
-        Order.objects.bulk_update(orders_to_update, ['purchasebase_id'], batch_size=settings.BATCH_SIZE_M)
+        )):
+            rows = []
+            for order in orders:
+                rows.append({
+                    'external_id': order['order__external_id'],
+                    'clientbase_id': order['order__clientbase_id'],
+                    'datetime': order['order__datetime'],
+                    'status': order['order__status'] or PurchaseBase.STATUS_CONFIRMED,
+                    'attributions': order['order__attributions'] or {},
+                    'brand_id': brand_map.get(order['order__brand_id']),
+                    'removed': False,
+                })
+            orderbase_map.update(upsert(
+                PurchaseBase, self.team.id, rows,
+                update_fields=['status', 'removed'],
+                coalesce_fields=['datetime', 'brand_id'],
+                merge_fields=['attributions'],
+                required_fields=['datetime'],
+            ))
+            orders_to_update = [
+                Order(
+                    id=order['order__id'], purchasebase_id=orderbase_map[order['order__external_id']]
+                ) for order in orders if order['order__external_id'] in orderbase_map
+            ]
+            Order.objects.bulk_update(orders_to_update, ['purchasebase_id'], batch_size=settings.BATCH_SIZE_M)
         self.orderbase_map = orderbase_map
 
+    @instrumented
     def create_clientbases(self):
-        client_map = {}
-        clients = list(
-            self.team.clientbase_set.filter(removed=False).values_list('external_id', 'id')
-        )
-        for external_id, client_id in clients:
-            client_map[external_id] = ClientBase(id=client_id)
-        clientbases_to_create = []
-        rows = list(self.datalist.datalistrow_set.values('client__external_id', 'id', 'order__id'))
-        for row in rows:
-            external_id = row['client__external_id']
-            if external_id in client_map:
-                clientbase = client_map[external_id]
-            else:
-                uniq_code = ':'.join([external_id])
-                hashcode = hashlib.md5(uniq_code.encode('utf8'))
-
-                uniq_code = int(hashcode.hexdigest(), 16)
-                clientbase = ClientBase(uniq_id=uniq_code, external_id=external_id, team=self.team)
-                clientbases_to_create.append(clientbase)
-                client_map[external_id] = clientbase
-            row['clientbase'] = clientbase
-        ClientBase.objects.bulk_create(clientbases_to_create, batch_size=settings.BATCH_SIZE_M)
-        orders_to_update = []
-        for row in rows:
-            orders_to_update.append(
-                Order(
-                    id=row['order__id'],
-                    clientbase_id=row['clientbase'].id
+        resolver = Resolver('clientbase', self.team.id, self.team.clientbase_set.filter(removed=False))
+        for rows in iter_chunks(self.get_datalistrows().values('client__external_id', 'id', 'order__id')):
+            client_map = {}
+            clients = resolver.resolve([row['client__external_id'] for row in rows])
+            for external_id, client_id in clients.items():
+                client_map[external_id] = ClientBase(id=client_id)
+            clientbases_to_create = []
+            for row in rows:
+                external_id = row['client__external_id']
+                if external_id in client_map:
+                    clientbase = client_map[external_id]
+                else:
+                    uniq_code = ':'.join([external_id])
+                    hashcode = hashlib.md5(uniq_code.encode('utf8'))
+
+                    uniq_code = int(hashcode.hexdigest(), 16)
+                    clientbase = ClientBase(uniq_id=uniq_code, external_id=external_id, team=self.team)
+                    clientbases_to_create.append(clientbase)
+                    client_map[external_id] = clientbase
+                row['clientbase'] = clientbase
+            ClientBase.objects.bulk_create(clientbases_to_create, batch_size=settings.BATCH_SIZE_M)
+            resolver.add({clientbase.external_id: clientbase.id for clientbase in clientbases_to_create})
+            orders_to_update = []
+            for row in rows:
+                orders_to_update.append(
+                    Order(
+                        id=row['order__id'],
+                        clientbase_id=row['clientbase'].id
+                    )
                 )
-            )
-        Order.objects.bulk_update(orders_to_update, ['clientbase_id'], batch_size=settings.BATCH_SIZE_M)
+            Order.objects.bulk_update(orders_to_update, ['clientbase_id'], batch_size=settings.BATCH_SIZE_M)
 
+    @instrumented
     def create_productbases(self):
-        product_map = {}
-        products = list(
-            RetailProduct.objects.filter(team=self.team).filter(removed=False).values('external_id', 'id', 'name', 'price')
-        )
-        for product in products:
-            product_map[product['external_id']] = RetailProduct(**product)
-        productbases_to_create = []
-        rows = list(self.datalist.datalistrow_set.values('product__external_id', 'id', 'orderrow__id', 'product__name', 'product__price'))
-        products_to_update = []
-        for row in rows:
-            external_id = row['product__external_id']
-            if external_id in product_map:
-                productbase = product_map[external_id]
-                if productbase.id and productbase.id not in products_to_update:
-                    products_to_update.append(productbase)
-            else:
-                productbase = RetailProduct(external_id=external_id, team=self.team, name=row['product__name'], price=row['product__price'])
-                product_map[external_id] = productbase
-                productbases_to_create.append(productbase)
-            row['productbase'] = productbase
-        RetailProduct.objects.bulk_create(productbases_to_create, batch_size=settings.BATCH_SIZE_M)
-        orders_to_update = []
-        for row in rows:
-            orders_to_update.append(
-                OrderRow(
-                    id=row['orderrow__id'],
-                    productbase_id=row['productbase'].id
-                )
+        for rows in iter_chunks(self.datalist.datalistrow_set.values('product__external_id', 'orderrow__id', 'product__name', 'product__price')):
+            product_map = upsert(
+                RetailProduct, self.team.id, [
+                    {
+                        'external_id': row['product__external_id'],
+                        'name': row['product__name'],
+                        'price': row['product__price'],
+                        'removed': False,
+                    } for row in rows
+                ],
+                update_fields=['name', 'price', 'removed'],
             )
-        OrderRow.objects.bulk_update(orders_to_update, ['productbase_id'], batch_size=settings.BATCH_SIZE_M)
-        RetailProduct.objects.bulk_update(products_to_update, ['name', 'price'], batch_size=settings.BATCH_SIZE_M)
+            orders_to_update = []
+            for row in rows:
+                orders_to_update.append(
+                    OrderRow(
+                        id=row['orderrow__id'],
+                        productbase_id=product_map.get(row['product__external_id'])
+                    )
+                )
+            OrderRow.objects.bulk_update(orders_to_update, ['productbase_id'], batch_size=settings.BATCH_SIZE_M)
 
+    @instrumented
     def create_orderproducts(self):
-        for order in self.orderbase_map.values():
-            order.orderproduct_set.all().delete()
-
-        for row in self.datalist.datalistrow_set.values(
-            'order__external_id',
-            'orderrow__productbase_id',
-            'order__clientbase_id',
-            'orderrow__refound',
-            'orderrow__sale_price',
-            'orderrow__quantity'
-        ):
-            if row['order__external_id'] not in self.orderbase_map:
-                continue
-            orderbase = self.orderbase_map[row['order__external_id']]
-            orderbase.orderproduct_set.create(
-                team=self.team,
-                productbase_id=row['orderrow__productbase_id'],
-                clientbase_id=row['order__clientbase_id'],
-                refound=row['orderrow__refound'],
-                sale_price = row['orderrow__sale_price'],
-                quantity = row['orderrow__quantity'],
-                total_price = row['orderrow__sale_price'] * row['orderrow__quantity']
-            )
+        purchasebase_ids = list(
+            self.get_orders().filter(purchasebase_id__isnull=False).values_list('purchasebase_id', flat=True).distinct()
+        )
 
+        with transaction.atomic():
+            OrderProduct.objects.filter(purchasebase_id__in=purchasebase_ids).delete()
+            for rows in iter_chunks(self.get_datalistrows().filter(order__purchasebase_id__isnull=False).values(
+                'order__purchasebase_id',
+                'orderrow__productbase_id',
+                'order__clientbase_id',
+                'orderrow__refound',
+                'orderrow__sale_price',
+                'orderrow__quantity'
+            )):
+                orderproducts_to_create = []
+                for row in rows:
+                    orderproducts_to_create.append(
+                        OrderProduct(
+                            team=self.team,
+                            datalist_id=self.datalist.id,
+                            purchasebase_id=row['order__purchasebase_id'],
+                            productbase_id=row['orderrow__productbase_id'],
+                            clientbase_id=row['order__clientbase_id'],
+                            refound=row['orderrow__refound'],
+                            sale_price=row['orderrow__sale_price'],
+                            quantity=row['orderrow__quantity'],
+                            total_price=row['orderrow__sale_price'] * row['orderrow__quantity']
+                        )
+                    )
+                OrderProduct.objects.bulk_create(orderproducts_to_create, batch_size=settings.BATCH_SIZE_L)
+
+    @instrumented
     def calculate_total_price(self):
-        orderbases_to_update = []
-        for orderbase in self.orderbase_map.values():
-            orderproducts = orderbase.orderproduct_set.filter(refound=False)
-            total_price = orderproducts.aggregate(total_price=Sum('total_price'))['total_price'] or 0
-            orderbase.total_price = total_price
-            orderbases_to_update.append(orderbase)
-        PurchaseBase.objects.bulk_update(orderbases_to_update, ['total_price'], batch_size=settings.BATCH_SIZE_M)
+        purchasebase_ids = self.get_orders().filter(purchasebase_id__isnull=False).values_list('purchasebase_id', flat=True).distinct()
+        PurchaseBase.update_total_prices(list(purchasebase_ids))
+
+    @instrumented
+    def calculate_purchase_sequences(self):
+        clientbase_ids = self.get_orders().filter(clientbase_id__isnull=False).values_list('clientbase_id', flat=True).distinct()
+        PurchaseBase.update_purchase_sequences(self.team.id, list(clientbase_ids))
+
+    @instrumented
+    def store_time_bounds(self):
+        DataListTimeBounds.store(self.datalist, self.datalist.order_set)
+
+    def process_raw_records(self):
+        self.create_clientbases()
+        self.create_orderbases()
+        self.create_productbases()
+        self.create_orderproducts()
+        self.calculate_total_price()
+        self.calculate_purchase_sequences()
+        self.store_time_bounds()
+        self.queue_rollups()
+
+    def queue_rollups(self):
+        '''
+        the incremental rollups of the team after every order import, whichever path it took (api, file, stream,
+        consumer, shards)
+        '''
+        run(calculate_repurchase_cycle_for_team, self.team.id)
+
+    def prepare_shards(self, shard_count):
+        '''
+        split the datalist by client, products are shared by the shards so they are created here, once
+        '''
+        assign_shards(Order, self.datalist.datalistrow_set.values_list('order__id', 'client__external_id'), shard_count)
+        self.create_productbases()
+
+    def process_shard(self, shard):
+        self.shard = shard
+        self.create_clientbases()
+        self.create_orderbases()
+        self.create_orderproducts()
+        self.calculate_total_price()
+        self.calculate_purchase_sequences()
+
+    def finish_shards(self):
+        self.store_time_bounds()
+        self.queue_rollups()
+
+
+class LineItemOrderImporter(OrderImporter):
+    '''
+    orders with their line items nested in `items`, staged as one Order per order
+    and one OrderLine per line item, instead of one Order / Client / Product per line item.
+    '''
+
+    class DataTransfer:
+        class ClientTransfer:
+            model = Client
+            external_id = Formatted(str, 'client_id')
+
+        class OrderTransfer:
+            model = Order
+
+            external_id = Formatted(str, 'id')
+            total_price = Formatted(format_price, 'total_price')
+
+            status = Formatted(str, 'status')
+            brand_id = Formatted(str, 'brand_id')
+
+            datetime = Formatted(DatetimeFormatter(), 'datetime')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rows = None
+
+    def create_datalist(self, rows):
+        # the line items are staged from the rows themselves, see stage_order_lines
+        self.rows = rows
+        return super().create_datalist(rows)
+
+    def data_to_raw_records(self):
+        super().data_to_raw_records()
+        self.stage_order_lines()
+
+    def get_orderlines(self):
+        lines = self.datalist.orderline_set.all()
+        if self.shard is not None:
+            lines = lines.filter(order__shard=self.shard)
+        return lines
+
+    @instrumented
+    def stage_order_lines(self):
+        '''
+        one OrderLine per item of the rows given to create_datalist, linked to the Order staged with the same id
+        '''
+        for start in range(0, len(self.rows), settings.BATCH_SIZE_L):
+            rows = self.rows[start:start + settings.BATCH_SIZE_L]
+            order_map = dict(self.datalist.order_set.filter(
+                external_id__in=set(str(row.get('id')) for row in rows)
+            ).values_list('external_id', 'id'))
+            lines_to_create = []
+            for row in rows:
+                order_id = order_map.get(str(row.get('id')))
+                if order_id is None:
+                    continue
+                for item in format_items(row.get('items')):
+                    lines_to_create.append(
+                        OrderLine(
+                            team=self.team,
+                            datalist_id=self.datalist.id,
+                            order_id=order_id,
+                            product_external_id=item['product_id'],
+                            product_name=item['product_name'],
+                            price=item['price'],
+                            refound=item['refound'],
+                            sale_price=item['sale_price'],
+                            quantity=item['quantity'],
+                            total_price=item['total_price'],
+                        )
+                    )
+            OrderLine.objects.bulk_create(lines_to_create)
+
+    @instrumented
+    def create_productbases(self):
+        lines = self.datalist.orderline_set.values('product_external_id', 'product_name', 'price').distinct()
+        product_map = {}
+        for rows in iter_chunks(lines):
+            product_map.update(upsert(
+                RetailProduct, self.team.id, [
+                    {
+                        'external_id': row['product_external_id'],
+                        'name': row['product_name'],
+                        'price': row['price'],
+                        'removed': False,
+                    } for row in rows
+                ],
+                update_fields=['name', 'price', 'removed'],
+            ))
+        for rows in iter_chunks(self.datalist.orderline_set.values('id', 'product_external_id')):
+            lines_to_update = [
+                OrderLine(id=row['id'], productbase_id=product_map.get(row['product_external_id'])) for row in rows
+            ]
+            OrderLine.objects.bulk_update(lines_to_update, ['productbase_id'], batch_size=settings.BATCH_SIZE_M)
+
+    @instrumented
+    def create_orderproducts(self):
+        purchasebase_ids = list(
+            self.get_orders().filter(purchasebase_id__isnull=False).values_list('purchasebase_id', flat=True).distinct()
+        )
+
+        with transaction.atomic():
+            OrderProduct.objects.filter(purchasebase_id__in=purchasebase_ids).delete()
+            for rows in iter_chunks(self.get_orderlines().filter(order__purchasebase_id__isnull=False).values(
+                'order__purchasebase_id',
+                'productbase_id',
+                'order__clientbase_id',
+                'refound',
+                'sale_price',
+                'quantity'
+            )):
+                orderproducts_to_create = []
+                for row in rows:
+                    orderproducts_to_create.append(
+                        OrderProduct(
+                            team=self.team,
+                            datalist_id=self.datalist.id,
+                            purchasebase_id=row['order__purchasebase_id'],
+                            productbase_id=row['productbase_id'],
+                            clientbase_id=row['order__clientbase_id'],
+                            refound=row['refound'],
+                            sale_price=row['sale_price'],
+                            quantity=row['quantity'],
+                            total_price=row['sale_price'] * row['quantity']
+                        )
+                    )
+                OrderProduct.objects.bulk_create(orderproducts_to_create, batch_size=settings.BATCH_SIZE_L)
 
     def process_raw_records(self):
         self.create_clientbases()
@@ -268,3 +435,6 @@ class OrderImporter(DataImporter):
         self.create_productbases()
         self.create_orderproducts()
         self.calculate_total_price()
+        self.calculate_purchase_sequences()
+        self.store_time_bounds()
+        self.queue_rollups()
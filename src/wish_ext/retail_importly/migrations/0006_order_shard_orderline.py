@@ -0,0 +1,44 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team', '0001_initial'),
+        ('retail_importly', '0005_order_purchasebase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='shard',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('product_external_id', models.TextField()),
+                ('product_name', models.CharField(default=str, max_length=64)),
+                ('price', models.FloatField(default=0.0)),
+                ('refound', models.BooleanField(default=False)),
+                ('sale_price', models.FloatField(default=0.0)),
+                ('quantity', models.IntegerField(default=1)),
+                ('total_price', models.FloatField(default=0.0)),
+                ('productbase_id', models.IntegerField(blank=True, null=True)),
+                ('datalist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='importly.DataList')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='retail_importly.Order')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='orderline',
+            index=models.Index(fields=['datalist', 'product_external_id'], name='retail_impo_datalis_3b59f4_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:50
+
+from django.conf import settings
+from django.db import migrations
+
+# an unlogged table can not be referenced from a logged one: OrderLine before Order
+STAGING_MODELS = ['Product', 'OrderRow', 'OrderLine', 'Order']
+
+
+def set_persistence(apps, schema_editor, persistence, names):
+    with schema_editor.connection.cursor() as cursor:
+        for name in names:
+            cursor.execute(f'ALTER TABLE {apps.get_model("retail_importly", name)._meta.db_table} SET {persistence}')
+
+
+def unlogged_staging(apps, schema_editor):
+    '''
+    staging tables are UNLOGGED when settings.WISH_UNLOGGED_STAGING is set: no WAL for the raw rows,
+    they are emptied on crash recovery and not replicated. changing the setting later takes migrating back and forth
+    '''
+    if getattr(settings, 'WISH_UNLOGGED_STAGING', False):
+        set_persistence(apps, schema_editor, 'UNLOGGED', STAGING_MODELS)
+
+
+def logged_staging(apps, schema_editor):
+    set_persistence(apps, schema_editor, 'LOGGED', reversed(STAGING_MODELS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('retail_importly', '0006_order_shard_orderline'),
+    ]
+
+    operations = [
+        migrations.RunPython(unlogged_staging, logged_staging),
+    ]
@@ -7,8 +7,9 @@ from datahub.models import DataSource
 from team.models import Team
 
 from core.models import BaseModel, ValueTaggable
-from importly.models import RawModel
+from importly.models import DataList, RawModel
 
+from ..staging import StagingQuerySet
 from ..retail.models import RetailProduct, PurchaseBase
 
 
@@ -35,6 +36,8 @@ class Product(RawModel):
 
     productbase = models.ForeignKey(RetailProduct, blank=True, null=True, on_delete=models.CASCADE)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class OrderRow(RawModel):
     refound = models.BooleanField(default=False)
@@ -47,6 +50,8 @@ class OrderRow(RawModel):
     total_price = models.FloatField(default=0.0)
     productbase_id = models.IntegerField(default=1)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class Order(RawModel):
     team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
@@ -61,3 +66,32 @@ class Order(RawModel):
     purchasebase = models.ForeignKey(PurchaseBase, null=True, on_delete=models.CASCADE)
     datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
     attributions = JSONField(default=dict)
+    shard = models.SmallIntegerField(blank=True, null=True)  # see sharding.assign_shards
+
+    objects = StagingQuerySet.as_manager()
+
+
+class OrderLine(BaseModel):
+    '''
+    one line item of a staged Order, linked to it by key instead of having a datalistrow of its own
+    '''
+    class Meta:
+        indexes = [
+            models.Index(fields=['datalist', 'product_external_id']),
+        ]
+
+    team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
+    datalist = models.ForeignKey(DataList, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, related_name='lines', on_delete=models.CASCADE)
+
+    product_external_id = models.TextField(blank=False)
+    product_name = models.CharField(max_length=64, default=str)
+    price = models.FloatField(default=0.0)
+
+    refound = models.BooleanField(default=False)
+    sale_price = models.FloatField(default=0.0)
+    quantity = models.IntegerField(default=1)
+    total_price = models.FloatField(default=0.0)
+    productbase_id = models.IntegerField(blank=True, null=True)
+
+    objects = StagingQuerySet.as_manager()
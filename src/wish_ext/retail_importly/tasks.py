@@ -8,10 +8,19 @@ from importly.models import DataList
 from config.celery import app
 from team.models import Team
 
-from .importers import OrderImporter
+from ..instrumentation import log_slow_import
+from ..payloads import attach_datalist, delete_payload, load_payload
+from ..segments import invalidate_segments
+from ..sharding import default_shard_count, process_in_shards
+from ..staging import stage_rows
+from .importers import OrderImporter, LineItemOrderImporter
 
 
-def process_datalist(team_slug, data, importer_cls):
+def process_datalist(team_slug, data, importer_cls, shard_count=None, payload_id=None):
+    '''
+    payload_id: the ImportPayload data was loaded from, deleted once the datalist is done.
+    shard_count: see sharding.default_shard_count when not given
+    '''
     team = Team.objects.get(slug=team_slug)
 
     datasource = data.get('datasource')
@@ -28,19 +37,30 @@ def process_datalist(team_slug, data, importer_cls):
 
     importer = importer_cls(team, datasource)
 
-    datalist = importer.create_datalist(rows)
-    datalist.set_step(DataList.STEP_CREATE_RAW_RECORDS)
+    datalist = stage_rows(importer, rows)
+    if payload_id:
+        attach_datalist(payload_id, datalist)
 
-    importer.data_to_raw_records()
-    datalist.set_step(DataList.STEP_PROCESS_RAW_RECORDS)
+    if shard_count is None:
+        shard_count = default_shard_count(importer, len(rows))
+    if shard_count:
+        # STEP_DONE is set by finish_datalist_shards once every shard is done
+        process_in_shards(importer, datasource, shard_count)
+        return
 
     importer.process_raw_records()
     datalist.set_step(DataList.STEP_DONE)
+    log_slow_import(datalist)
+    invalidate_segments(team.id)
+    if payload_id:
+        delete_payload(payload_id)
 
 
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_orderlist(team_slug, data):
+def process_orderlist(team_slug, data=None, shard_count=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
     cleaned_data = []
     for row in data['data']:
         for line_item in row.pop('items', []):
@@ -48,5 +68,16 @@ def process_orderlist(team_slug, data):
             row.update(line_item)
             cleaned_data.append(row)
     data['data'] = cleaned_data
-    print(data['data'])
-    process_datalist(team_slug, data, OrderImporter)
+    process_datalist(team_slug, data, OrderImporter, shard_count, payload_id=payload_id)
+
+
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def process_orderlinelist(team_slug, data=None, shard_count=None, payload_id=None):
+    '''
+    the same orders as process_orderlist, staged by LineItemOrderImporter: one Order per order and one OrderLine per line item
+    '''
+    if payload_id:
+        data = load_payload(payload_id)
+    # orders without line items were never imported
+    data['data'] = [row for row in data['data'] if row.get('items')]
+    process_datalist(team_slug, data, LineItemOrderImporter, shard_count, payload_id=payload_id)
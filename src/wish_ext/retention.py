@@ -0,0 +1,123 @@
+import datetime
+import gzip
+import os
+import time
+
+import orjson
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from importly.models import DataList
+
+from .resolvers import resolve_external_ids
+from .retail.models import PurchaseBase, RetailProduct
+from .retail_importly.models import Order, OrderLine, OrderRow, Product
+from .staging import iter_chunks
+from .wish.models import EventBase, EventLogBase, LevelLogBase, MemberLevelBase, PointLogBase, event_log_key
+from .wish_importly.models import CompactedDataList, CompactedLineage, Event, EventLog, Level, LevelLog, PointLog
+
+def base_ids_of(field):
+    '''
+    lineage of staging rows which point at their base row with field
+    '''
+    def base_ids(rows, team_id):
+        return rows.exclude(**{field: None}).values_list(field, flat=True).distinct()
+    return base_ids
+
+
+def base_ids_by_key(base_model, key=lambda team_id, external_id: external_id, base_key='external_id'):
+    '''
+    lineage of staging rows which only know the external_id of their base row
+    '''
+    def base_ids(rows, team_id):
+        keys = set(key(team_id, external_id) for external_id in rows.values_list('external_id', flat=True) if external_id)
+        return resolve_external_ids(base_model.objects.filter(team_id=team_id), keys, key=base_key).values()
+    return base_ids
+
+
+# deleted in this order, line items before their orders, with the base model they were imported into
+STAGING_MODELS = [
+    (OrderLine, RetailProduct, base_ids_of('productbase_id')),
+    (OrderRow, RetailProduct, base_ids_of('productbase_id')),
+    (Order, PurchaseBase, base_ids_of('purchasebase_id')),
+    (Product, RetailProduct, base_ids_of('productbase_id')),
+    (Level, MemberLevelBase, base_ids_by_key(MemberLevelBase)),
+    (LevelLog, LevelLogBase, base_ids_by_key(LevelLogBase)),
+    (Event, EventBase, base_ids_by_key(EventBase)),
+    (EventLog, EventLogBase, base_ids_by_key(EventLogBase, event_log_key, 'dedup_key')),
+    (PointLog, PointLogBase, base_ids_by_key(PointLogBase)),
+]
+
+
+def archive_rows(queryset, path):
+    '''
+    writes the rows as gzipped ndjson, a batch archived again after a crash overwrites its own file
+    '''
+    with gzip.open(path, 'wb') as f:
+        for rows in iter_chunks(queryset.values()):
+            f.write(b''.join(orjson.dumps(row, default=str) + b'\n' for row in rows))
+
+
+def compact_datalist(datalist, deadline=None):
+    '''
+    archive (if settings.WISH_STAGING_ARCHIVE_DIR is set) and delete the staging rows of datalist,
+    settings.WISH_STAGING_DELETE_BATCH rows per statement so locks stay short.
+    each batch is archived, traced in CompactedLineage and deleted by the same ids, a batch interrupted in the middle
+    is done again as a whole.
+    returns False when deadline (time.monotonic()) passed before it was done, calling it again resumes.
+    '''
+    batch_size = getattr(settings, 'WISH_STAGING_DELETE_BATCH', settings.BATCH_SIZE_M)
+    archive_dir = getattr(settings, 'WISH_STAGING_ARCHIVE_DIR', None)
+    compaction, created = CompactedDataList.objects.get_or_create(datalist=datalist)
+
+    if archive_dir:
+        compaction.archive_path = os.path.join(archive_dir, str(datalist.id))
+        os.makedirs(compaction.archive_path, exist_ok=True)
+        compaction.save(update_fields=['archive_path', 'u_at'])
+
+    for model, base_model, base_ids in STAGING_MODELS:
+        rows = model.objects.filter(datalist=datalist)
+        while True:
+            ids = list(rows.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            batch = model.objects.filter(id__in=ids)
+            if archive_dir:
+                archive_rows(batch, os.path.join(compaction.archive_path, f'{model._meta.db_table}.{ids[0]}.ndjson.gz'))
+
+            with transaction.atomic():
+                CompactedLineage.objects.create(
+                    compaction=compaction,
+                    staging_model=model.__name__,
+                    base_model=base_model.__name__,
+                    base_ids=sorted(base_ids(batch, datalist.team_id)),
+                )
+                batch.delete()
+                compaction.rows_deleted += len(ids)
+                compaction.save(update_fields=['rows_deleted', 'u_at'])
+            if deadline and time.monotonic() > deadline:
+                return False
+
+    compaction.done = True
+    compaction.save(update_fields=['done', 'u_at'])
+    return True
+
+
+def compact_staging(time_budget=None):
+    '''
+    staging rows of datalists done more than settings.WISH_STAGING_RETENTION_DAYS ago, disabled when it is not set
+    '''
+    retention_days = getattr(settings, 'WISH_STAGING_RETENTION_DAYS', None)
+    if retention_days is None:
+        return
+    deadline = time.monotonic() + time_budget if time_budget else None
+    expired_at = timezone.now() - datetime.timedelta(days=retention_days)
+
+    datalists = DataList.objects.filter(step=DataList.STEP_DONE, u_at__lt=expired_at).exclude(compaction__done=True).order_by('id')
+    for datalist in datalists.iterator():
+        if not compact_datalist(datalist, deadline):
+            return
+        if deadline and time.monotonic() > deadline:
+            return
@@ -0,0 +1,145 @@
+import hashlib
+
+import orjson
+from pyroaring import BitMap
+
+from django.conf import settings
+from django.core.cache import caches
+
+from filtration.conditions import Condition
+from filtration.exceptions import UseIdList
+from team.models import Team
+
+# dotted path: condition class, the conditions a SegmentCondition can combine, see bitmap_condition
+BITMAP_CONDITIONS = {}
+
+
+def bitmap_enabled():
+    return getattr(settings, 'WISH_SEGMENT_ENGINE', 'sql') == 'bitmap'
+
+
+def get_cache():
+    return caches[getattr(settings, 'WISH_SEGMENT_CACHE_ALIAS', 'default')]
+
+
+def version_key(team_id):
+    return f'wish_ext:segments:version:{team_id}'
+
+
+def get_version(team_id):
+    return get_cache().get(version_key(team_id), 0)
+
+
+def invalidate_segments(team_id):
+    '''
+    called when data of the team changed (imports, rfm), every cached bitmap of the team is stale after it
+    '''
+    cache = get_cache()
+    key = version_key(team_id)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def cached_bitmap(team_id, parts, build):
+    '''
+    parts: what the bitmap depends on besides the team data, plain json values only so the key is stable between processes,
+    build: returns the client ids when not cached. conditions relative to now are covered by settings.WISH_SEGMENT_TIMEOUT
+    '''
+    digest = hashlib.md5(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    key = f'wish_ext:segments:{team_id}:{get_version(team_id)}:{digest}'
+
+    cache = get_cache()
+    data = cache.get(key)
+    if data is not None:
+        return BitMap.deserialize(data)
+
+    bitmap = BitMap(build())
+    cache.set(key, bitmap.serialize(), timeout=getattr(settings, 'WISH_SEGMENT_TIMEOUT', 3600))
+    return bitmap
+
+
+def team_clients(client_qs, team_id):
+    return client_qs.model.objects.filter(team_id=team_id)
+
+
+def universe_bitmap(client_qs, team_id):
+    '''
+    every client of the team, NOT is taken against it
+    '''
+    return cached_bitmap(
+        team_id, ['universe'], lambda: team_clients(client_qs, team_id).values_list('id', flat=True).iterator()
+    )
+
+
+def condition_bitmap(node, client_qs, team_id):
+    '''
+    the clients of the team matching a condition node, evaluated alone with its own filter()
+    so the same condition is reused between segments whatever it is combined with.
+    the key is the node as sent, the condition is only built when the bitmap is not cached
+    '''
+    choices = node.get('choices')
+
+    def build():
+        condition = build_condition(node, Team.objects.get(id=team_id))
+        qs, q = condition.filter(team_clients(client_qs, team_id), choices)
+        return qs.filter(q).values_list('id', flat=True).iterator()
+
+    return cached_bitmap(team_id, [node['condition'], choices, node.get('options') or {}], build)
+
+
+def condition_path(condition_cls):
+    return f'{condition_cls.__module__}.{condition_cls.__name__}'
+
+
+def build_condition(node, team):
+    '''
+    node: {'condition': a key of BITMAP_CONDITIONS, 'choices': ..., 'options': {option: value}}
+    the condition is initialized for the team like filtration does (options added by lazy_init / real_time_init),
+    then every option it declares gets the value of the node, None when the node leaves it out
+    '''
+    condition_cls = BITMAP_CONDITIONS[node['condition']]
+    condition = condition_cls(condition_cls.__name__)
+    condition.lazy_init(team)
+    condition.real_time_init(team)
+    options = node.get('options') or {}
+    condition.options = {key: options.get(key) for key in condition.options}
+    return condition
+
+
+def evaluate(node, client_qs, team_id):
+    '''
+    node: {'and': [nodes]}, {'or': [nodes]}, {'not': node} or a condition node (see build_condition),
+    every condition is one cached bitmap and they are combined in memory
+    '''
+    if 'and' in node:
+        bitmaps = [evaluate(child, client_qs, team_id) for child in node['and']]
+        if not bitmaps:
+            return universe_bitmap(client_qs, team_id)
+        return BitMap.intersection(*bitmaps)
+    if 'or' in node:
+        bitmaps = [evaluate(child, client_qs, team_id) for child in node['or']]
+        return BitMap.union(*bitmaps) if bitmaps else BitMap()
+    if 'not' in node:
+        return universe_bitmap(client_qs, team_id) - evaluate(node['not'], client_qs, team_id)
+    return condition_bitmap(node, client_qs, team_id)
+
+
+class SegmentCondition(Condition):
+    '''
+    a whole AND / OR / NOT tree of bitmap conditions as one condition, registered when settings.WISH_SEGMENT_ENGINE = 'bitmap'.
+    choices: the tree, see evaluate. the combined ids go back to filtration once, as an id list
+    '''
+
+    def filter(self, client_qs, choices):
+        team_id = next(iter(client_qs.values_list('team_id', flat=True)[:1]), None)
+        if team_id is None:
+            raise UseIdList([])
+        raise UseIdList(list(evaluate(choices, client_qs, team_id)))
+
+
+def bitmap_condition(cls):
+    '''
+    condition class decorator: the condition can be combined by SegmentCondition, evaluated alone into a cached bitmap
+    '''
+    BITMAP_CONDITIONS[condition_path(cls)] = cls
+    return cls
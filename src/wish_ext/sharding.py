@@ -0,0 +1,128 @@
+import logging
+import time
+import zlib
+
+from celery import chord
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from datahub.models import DataSource
+from importly.models import DataList
+
+from config.celery import app
+from team.models import Team
+
+from .instrumentation import log_slow_import
+from .segments import invalidate_segments
+from .staging import iter_chunks
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(external_id, shard_count):
+    '''
+    stable across processes, unlike hash()
+    '''
+    return zlib.crc32(str(external_id).encode('utf8')) % shard_count
+
+
+def assign_shards(model, values, shard_count):
+    '''
+    values: queryset of (id of model, client external_id) rows,
+    every staged row of a client ends up in the same shard so its rows keep their order.
+    '''
+    for rows in iter_chunks(values):
+        model.objects.bulk_update(
+            [model(id=id, shard=shard_of(external_id, shard_count)) for id, external_id in rows if id],
+            ['shard'], batch_size=settings.BATCH_SIZE_M
+        )
+
+
+def report_speedup(name, started_at, shard_seconds):
+    '''
+    started_at: time.time() when the shards were queued, shard_seconds: time spent in each shard
+    '''
+    wall_seconds = max(time.time() - started_at, 1e-6)
+    serial_seconds = sum(shard_seconds)
+    report = {
+        'shards': len(shard_seconds),
+        'wall_seconds': round(wall_seconds, 3),
+        'serial_seconds': round(serial_seconds, 3),
+        'speedup': round(serial_seconds / wall_seconds, 2),
+    }
+    logger.info('%s %s', name, report)
+    return report
+
+
+def build_importer(importer_path, team_id, datasource_id, datalist_id):
+    importer = import_string(importer_path)(Team.objects.get(id=team_id), DataSource.objects.get(id=datasource_id))
+    importer.datalist = DataList.objects.get(id=datalist_id)
+    return importer
+
+
+def default_shard_count(importer, row_count):
+    '''
+    settings.WISH_IMPORT_SHARD_COUNT shards for datalists of at least settings.WISH_IMPORT_SHARD_MIN_ROWS rows,
+    0 (not sharded) for smaller ones and importers which cannot be sharded
+    '''
+    if not hasattr(importer, 'prepare_shards'):
+        return 0
+    if row_count < getattr(settings, 'WISH_IMPORT_SHARD_MIN_ROWS', settings.BATCH_SIZE_L // 2):
+        return 0
+    return getattr(settings, 'WISH_IMPORT_SHARD_COUNT', 4)
+
+
+def process_in_shards(importer, datasource, shard_count):
+    '''
+    importer: a DataImporter with prepare_shards / process_shard, its raw records already created.
+    the shards run as separate tasks, finish_shards of the importer runs once all of them are done,
+    or fail_datalist_shards once one of them failed.
+    '''
+    importer.prepare_shards(shard_count)
+
+    args = (f'{type(importer).__module__}.{type(importer).__name__}', importer.team.id, datasource.id, importer.datalist.id)
+    chord(
+        process_datalist_shard.s(*args, shard) for shard in range(shard_count)
+    )(finish_datalist_shards.s(*args, time.time()).on_error(fail_datalist_shards.s(importer.datalist.id)))
+
+
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def process_datalist_shard(importer_path, team_id, datasource_id, datalist_id, shard):
+    started = time.time()
+    importer = build_importer(importer_path, team_id, datasource_id, datalist_id)
+    importer.process_shard(shard)
+    return time.time() - started
+
+
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def finish_datalist_shards(shard_seconds, importer_path, team_id, datasource_id, datalist_id, started_at):
+    importer = build_importer(importer_path, team_id, datasource_id, datalist_id)
+    importer.finish_shards()
+    importer.datalist.set_step(DataList.STEP_DONE)
+    log_slow_import(importer.datalist)
+    invalidate_segments(team_id)
+    return report_speedup(importer_path, started_at, shard_seconds)
+
+
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def fail_datalist_shards(request, exc, traceback, datalist_id):
+    '''
+    errback of the chord, the datalist never reaches STEP_DONE so it is marked failed instead of looking stuck
+    '''
+    from .wish_importly.models import DataListFailure
+
+    logger.error('shards of datalist %s failed: %r', datalist_id, exc)
+    DataListFailure.objects.update_or_create(datalist_id=datalist_id, defaults={'error': repr(exc)})
+
+
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def process_staged_datalist(importer_path, team_id, datasource_id, datalist_id):
+    '''
+    process_raw_records of a datalist whose raw records were staged elsewhere, e.g. by the stream apis
+    '''
+    importer = build_importer(importer_path, team_id, datasource_id, datalist_id)
+    importer.process_raw_records()
+    importer.datalist.set_step(DataList.STEP_DONE)
+    log_slow_import(importer.datalist)
+    invalidate_segments(team_id)
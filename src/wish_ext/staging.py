@@ -0,0 +1,116 @@
+import io
+import json
+
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.db import connection, models
+
+from importly.models import DataList
+
+from .columnar import datetime_formats
+from .instrumentation import count_rows, import_stage
+
+
+def to_copy_value(field, value):
+    if value is None:
+        return None
+    if isinstance(field, JSONField):
+        return json.dumps(value)
+    if isinstance(field, ArrayField):
+        items = []
+        for item in value:
+            item = to_copy_value(field.base_field, item)
+            if item is None:
+                items.append('NULL')
+            else:
+                items.append('"{}"'.format(str(item).replace('\\', '\\\\').replace('"', '\\"')))
+        return '{' + ','.join(items) + '}'
+    return field.get_db_prep_save(value, connection)
+
+
+def copy_cell(value):
+    '''
+    csv cell of COPY ... WITH (FORMAT csv, NULL '\\N'): NULL is the bare marker, every value is quoted
+    so empty strings and a literal \\N stay strings
+    '''
+    if value is None:
+        return '\\N'
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def copy_insert(model, objs):
+    '''
+    write model instances with COPY FROM STDIN, ids are taken from the table sequence first
+    so the instances get their pk like with bulk_create.
+    '''
+    objs = list(objs)
+    if not objs:
+        return objs
+
+    table = model._meta.db_table
+    pk = model._meta.pk
+    fields = [field for field in model._meta.concrete_fields if field is not pk]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [table, pk.column, len(objs)]
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+
+        buffer = io.StringIO()
+        for obj, id in zip(objs, ids):
+            setattr(obj, pk.attname, id)
+            values = [id] + [to_copy_value(field, field.pre_save(obj, True)) for field in fields]
+            buffer.write(','.join(copy_cell(value) for value in values))
+            buffer.write('\n')
+            obj._state.adding = False
+            obj._state.db = connection.alias
+        buffer.seek(0)
+
+        columns = ', '.join([pk.column] + [field.column for field in fields])
+        cursor.cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    count_rows(written=len(objs))
+    return objs
+
+
+class StagingQuerySet(models.QuerySet):
+    '''
+    bulk_create of raw staging rows goes through COPY
+    '''
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        if ignore_conflicts:
+            return super().bulk_create(objs, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+        return copy_insert(self.model, objs)
+
+
+def stage_rows(importer, rows):
+    '''
+    create the datalist of rows and its raw records, the same way for every entry point (api, stream, file, consumer).
+    returns the datalist, at STEP_PROCESS_RAW_RECORDS
+    '''
+    datalist = importer.create_datalist(rows)
+    datalist.set_step(DataList.STEP_CREATE_RAW_RECORDS)
+
+    with import_stage(importer, 'data_to_raw_records'), datetime_formats():
+        importer.data_to_raw_records()
+    datalist.set_step(DataList.STEP_PROCESS_RAW_RECORDS)
+    return datalist
+
+
+def iter_chunks(queryset, chunk_size=None):
+    '''
+    read a queryset with a server-side cursor, yielding lists of chunk_size rows
+    '''
+    chunk_size = chunk_size or settings.BATCH_SIZE_L
+    chunk = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            count_rows(read=len(chunk))
+            yield chunk
+            chunk = []
+    if chunk:
+        count_rows(read=len(chunk))
+        yield chunk
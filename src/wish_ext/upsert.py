@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.db import connection, models
+
+from .instrumentation import count_changes
+from .resolvers import resolve_external_ids
+
+MAX_QUERY_PARAMS = 65535
+
+
+def merge_rows(rows, key, update_fields=(), coalesce_fields=(), merge_fields=()):
+    '''
+    fold rows sharing the same key into one, with the same rules upsert applies against the table,
+    one INSERT ... ON CONFLICT can not touch a row twice.
+    rows without a key are kept as they are.
+    '''
+    merged = {}
+    keyless = []
+    for row in rows:
+        external_id = row.get(key)
+        if external_id is None:
+            keyless.append(row)
+            continue
+        if external_id not in merged:
+            merged[external_id] = dict(row)
+            continue
+        current = merged[external_id]
+        for field in update_fields:
+            if field in row:
+                current[field] = row[field]
+        for field in coalesce_fields:
+            if row.get(field) is not None:
+                current[field] = row[field]
+        for field in merge_fields:
+            if row.get(field):
+                current[field] = {**(current.get(field) or {}), **row[field]}
+    return list(merged.values()) + keyless
+
+
+def upsert(model, team_id, rows, update_fields=(), coalesce_fields=(), merge_fields=(), required_fields=(), key='external_id', batch_size=None, resolve_unchanged=True):
+    '''
+    INSERT ... ON CONFLICT (team_id, key) DO UPDATE ... WHERE (changed), rows are dicts of attnames.
+
+    update_fields: overwritten by the incoming value
+    coalesce_fields: overwritten only if the incoming value is not null
+    merge_fields: jsonb, the incoming keys are merged into the existing object
+    required_fields: rows missing any of these take the existing value, or are dropped if there is no existing row
+
+    returns { key: id } of every upserted row, unchanged rows included unless resolve_unchanged is False,
+    which saves reading them back when the caller does not need the ids.
+    counts of inserted / updated / unchanged rows are added to the running import stages.
+    '''
+    rows = merge_rows(rows, key, update_fields, coalesce_fields, merge_fields)
+
+    incomplete = [row for row in rows if any(row.get(field) is None for field in required_fields)]
+    if incomplete:
+        existing = resolve_external_ids(
+            model.objects.filter(team_id=team_id), [row.get(key) for row in incomplete], *required_fields, key=key
+        )
+        rows = [row for row in rows if all(row.get(field) is not None for field in required_fields) or row.get(key) in existing]
+        for row in incomplete:
+            for field in required_fields:
+                if row.get(field) is None and row.get(key) in existing:
+                    row[field] = existing[row[key]][field]
+
+    if not rows:
+        return {}
+
+    table = model._meta.db_table
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+    columns = [field.column for field in fields]
+    column_of = {field.attname: field.column for field in fields}
+    key_column = column_of[key]
+    team_column = column_of['team_id']
+
+    assignments = []
+    for field in update_fields:
+        column = column_of[field]
+        assignments.append((column, f'EXCLUDED.{column}'))
+    for field in coalesce_fields:
+        column = column_of[field]
+        assignments.append((column, f'COALESCE(EXCLUDED.{column}, t.{column})'))
+    for field in merge_fields:
+        column = column_of[field]
+        assignments.append((column, f"COALESCE(t.{column}, '{{}}'::jsonb) || COALESCE(EXCLUDED.{column}, '{{}}'::jsonb)"))
+    changes = [(f't.{column}', value) for column, value in assignments]
+    # auto_now fields are refreshed on the rows that do change, but do not count as a change
+    for field in fields:
+        if getattr(field, 'auto_now', False):
+            assignments.append((field.column, f'EXCLUDED.{field.column}'))
+
+    if changes:
+        on_conflict = 'DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})'.format(
+            ', '.join(f'{column} = {value}' for column, value in assignments),
+            ', '.join(column for column, value in changes),
+            ', '.join(value for column, value in changes),
+        )
+    else:
+        on_conflict = 'DO NOTHING'
+
+    batch_size = min(batch_size or settings.BATCH_SIZE_M, MAX_QUERY_PARAMS // len(columns))
+    placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+
+    id_map = {}
+    inserted = returned = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            params = []
+            for row in rows[start:start + batch_size]:
+                obj = model(**row, team_id=team_id)
+                params.extend(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+            batch_count = min(batch_size, len(rows) - start)
+            cursor.execute(f'''
+                INSERT INTO {table} AS t ({', '.join(columns)})
+                VALUES {', '.join([placeholder] * batch_count)}
+                ON CONFLICT ({team_column}, {key_column}) {on_conflict}
+                RETURNING t.{key_column}, t.id, (t.xmax = 0)
+            ''', params)
+            for external_id, id, is_new in cursor.fetchall():
+                id_map[external_id] = id
+                inserted += is_new
+                returned += 1
+
+    # rows left untouched by the WHERE (changed) clause are not returned
+    missing = [row[key] for row in rows if row.get(key) is not None and row[key] not in id_map]
+    if missing and resolve_unchanged:
+        id_map.update(resolve_external_ids(model.objects.filter(team_id=team_id), missing, key=key))
+
+    id_map.pop(None, None)
+    count_changes(inserted=inserted, updated=returned - inserted, unchanged=len(rows) - returned)
+    return id_map
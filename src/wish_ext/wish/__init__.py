@@ -0,0 +1 @@
+default_app_config = 'wish_ext.wish.apps.WishConfig'
@@ -9,6 +9,7 @@ from core.utils import ReadableJSONFormField
 
 from plan.models import PlanSetting
 from ..retail.models import RepurchaseCycle, ProductCategory, RetailProduct, PurchaseBase, OrderProduct
+from ..wish_importly.models import ImportStage
 
 
 from .models import (
@@ -76,6 +77,30 @@ class RetailProductAdmin(admin.ModelAdmin):
 
     search_fields = ('name', 'external_id')
 
+@admin.register(ImportStage)
+class ImportStageAdmin(admin.ModelAdmin):
+
+    list_display = (
+        'id',
+        'c_at',
+        'datalist_id',
+        'importer',
+        'name',
+        'shard',
+        'seconds',
+        'queries',
+        'rows_read',
+        'rows_written',
+        'rows_inserted',
+        'rows_updated',
+        'rows_unchanged',
+        'rows_per_second',
+        'peak_memory_kb',
+    )
+
+    list_filter = ('importer', 'name')
+    search_fields = ('datalist__id',)
+
 admin.site.register(LevelLogBase)
 admin.site.register(RepurchaseCycle)
 admin.site.register(ProductCategory)
@@ -1,4 +1,10 @@
 from django.apps import AppConfig
 
 class WishConfig(AppConfig):
+    name = 'wish_ext.wish'
     label = 'wish'
+
+    def ready(self):
+        from ..resolvers import connect_signals
+
+        connect_signals()
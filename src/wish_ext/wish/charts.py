@@ -9,12 +9,12 @@ import numpy as np
 
 from django.utils import timezone
 from django.db.models.functions import TruncDate, ExtractMonth, ExtractYear, Cast, ExtractWeekDay
-from django.db.models import Count, Func, Max, Min, IntegerField, Sum, Avg
+from django.db.models import Count, Func, Max, Min, IntegerField, Sum, Avg, Value
 from django.contrib.postgres.aggregates import ArrayAgg
 from django.db.models import ExpressionWrapper, DecimalField, FloatField
 from django.db.models.expressions import OuterRef, Subquery
 from dateutil import rrule
-from django.db.models.functions import Abs
+from django.db.models.functions import Abs, Least
 
 
 from charts.exceptions import NoData
@@ -30,7 +30,7 @@ from orderly_core.team.charts import overview_charts, AttributionPieChart, past_
 from charts.drawers import MatrixChart, HeatMapChart
 from charts.registries import chart_category, dashboard_preset
 from .models import EventBase, LevelLogBase, EventLogBase, EventBase, MemberLevelBase, PointLogBase
-from wish_ext.retail.models import PurchaseBase, OrderProduct, RetailProduct
+from wish_ext.retail.models import PurchaseBase, OrderProduct, RetailProduct, RepurchaseCycle, NESLInterval
 from wish_ext.wish.models import Brand, BrandAuth
 import pandas as pd
 from mlxtend.preprocessing import TransactionEncoder
@@ -1319,6 +1319,14 @@ class RFMCountBar(BarChart):
 
 @overview_charts.chart(name='交易回購人數直條圖')
 class RepurchaseMemCountBar(BarChart):
+    '''
+    Hidden options:
+        -repurchase_segment:
+            format: [segment_type, segment_key]
+            default: None
+            explain: read from the pre-calculated RepurchaseCycle of the segment instead of the orders in time_range,
+                     use ['', ''] for the whole team.
+    '''
     def __init__(self):
         super().__init__()
         now = timezone.now()
@@ -1342,35 +1350,47 @@ class RepurchaseMemCountBar(BarChart):
     def explain_y(self):
         return '人數'
 
+    def draw_from_repurchase_cycle(self, segment_type, segment_key):
+        repurchase_cycle = RepurchaseCycle.get_segment(self.team, segment_type, segment_key)
+        if repurchase_cycle is None:
+            raise NoData('資料不足')
+        labels = ['首購', '第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
+        self.set_labels(labels)
+        data = repurchase_cycle.get_member_count_of_cycles(max_cycle=len(labels) - 1)
+        self.set_total(sum(data))
+
+        self.notes.update({
+                'tooltip_value': f'{{data}} 人<br> 佔會員比例: {{percentage}}%',
+                'tooltip_name': ' '
+            })
+
+        self.create_label(data=data, notes=self.notes)
+
+        data_check = set(data)
+        if data_check == {0} or data_check == {None}:
+            raise NoData('資料不足')
+
     def draw(self):
+        repurchase_segment = self.options.get('repurchase_segment')
+        if repurchase_segment:
+            return self.draw_from_repurchase_cycle(*repurchase_segment)
         purchase_base_set = PurchaseBase.objects.filter(removed=False)
         if not purchase_base_set.exists():
             raise NoData('資料不足')
         date_start, date_end = self.get_date_range('time_range')
-        self.set_total(len(purchase_base_set))
+        self.set_total(purchase_base_set.count())
         labels = ['首購', '第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
         self.set_labels(labels)
         data = [0]*len(labels)
-        now = timezone.now()
-        dict_data = []
-        value_data = []
-        order_member_count = purchase_base_set.filter(datetime__lte=date_end, datetime__gte=date_start).values('clientbase_id').annotate(Count('clientbase_id'))
-        if order_member_count:
-            for count_data in order_member_count:
-                dict_data.append(count_data['clientbase_id'])
-                value_data.append(count_data['clientbase_id__count'])
-                if count_data['clientbase_id__count'] == 1:
-                    data[0] += 1
-                elif count_data['clientbase_id__count'] == 2:
-                    data[1] += 1
-                elif count_data['clientbase_id__count'] == 3:
-                    data[2] += 1
-                elif count_data['clientbase_id__count'] == 4:
-                    data[3] += 1
-                elif count_data['clientbase_id__count'] == 5:
-                    data[4] += 1
-                else:
-                    data[5] += 1
+        # clients making their Nth purchase in time range, grouped by purchase_seq
+        seq_member_count = (
+            purchase_base_set.filter(datetime__lte=date_end, datetime__gte=date_start, purchase_seq__isnull=False)
+            .annotate(seq=Least('purchase_seq', Value(len(labels))))
+            .values('seq').annotate(member_count=Count('clientbase_id', distinct=True))
+            .values_list('seq', 'member_count')
+        )
+        for seq, member_count in seq_member_count:
+            data[seq - 1] = member_count
 
         self.notes.update({
                 'tooltip_value': f'{{data}} 人<br> 佔會員比例: {{percentage}}%',
@@ -1385,6 +1405,14 @@ class RepurchaseMemCountBar(BarChart):
 
 @overview_charts.chart(name='交易回購天數直條圖')
 class RepurchaseDayCountBar(BarChart):
+    '''
+    Hidden options:
+        -repurchase_segment:
+            format: [segment_type, segment_key]
+            default: None
+            explain: read from the pre-calculated RepurchaseCycle of the segment instead of the orders in time_range,
+                     use ['', ''] for the whole team.
+    '''
     def __init__(self):
         super().__init__()
         now = timezone.now()
@@ -1411,37 +1439,43 @@ class RepurchaseDayCountBar(BarChart):
     def explain_x(self):
         return '回購頻率'
 
+    def draw_from_repurchase_cycle(self, segment_type, segment_key):
+        repurchase_cycle = RepurchaseCycle.get_segment(self.team, segment_type, segment_key)
+        if repurchase_cycle is None:
+            raise NoData('資料不足')
+        data = repurchase_cycle.get_mean_days_of_cycles(max_cycle=len(self.get_labels()))
+        self.set_total(repurchase_cycle.count_cycle)
+        data_check = set(data)
+        if data_check == {0} or data_check == {None}:
+            raise NoData('資料不足')
+
+        self.notes.update({
+            'tooltip_value': f'{{data}} 天 ',
+            'tooltip_name': ' '
+        })
+
+        self.create_label(data=data, notes=self.notes)
+
     def draw(self):
+        repurchase_segment = self.options.get('repurchase_segment')
+        if repurchase_segment:
+            return self.draw_from_repurchase_cycle(*repurchase_segment)
         purchase_base_set = PurchaseBase.objects.filter(removed=False)
         if not purchase_base_set.exists():
             raise NoData('資料不足')
         date_start, date_end = self.get_date_range('time_range')
-        self.set_total(len(purchase_base_set))
+        self.set_total(purchase_base_set.count())
         tooltip_titles = ['第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
-        day_data = [0]*len(tooltip_titles)
-        data_member_count = [0] * len(tooltip_titles)
-        now = timezone.now()
-        per_data_count = {}
-        perchase_data = purchase_base_set.filter(datetime__lte=date_end, datetime__gte=date_start).values('clientbase_id','datetime')
-        for per_data in perchase_data:
-            per_data_count[per_data['clientbase_id']] = per_data_count.get(per_data['clientbase_id'], 0) + 1
-            if per_data_count.get(per_data['clientbase_id']) == 2:
-                day_data[0] += (now - per_data['datetime']).days
-                data_member_count[0] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 3:
-                day_data[1] += (now - per_data['datetime']).days
-                data_member_count[1] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 4:
-                day_data[2] += (now - per_data['datetime']).days
-                data_member_count[2] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 5:
-                day_data[3] += (now - per_data['datetime']).days
-                data_member_count[3] += 1
-            else:
-                day_data[4] += (now - per_data['datetime']).days
-                data_member_count[4] += 1
-        f_data_member_count = [1 for count in data_member_count if count == 0]
-        data = [math.ceil(day / count) for day, count in zip(day_data, f_data_member_count)]
+        data = [0]*len(tooltip_titles)
+        # average days since the previous purchase, grouped by purchase_seq (2nd purchase is the 1st re-purchase)
+        seq_days = (
+            purchase_base_set.filter(datetime__lte=date_end, datetime__gte=date_start, purchase_seq__gt=1)
+            .annotate(seq=Least('purchase_seq', Value(len(tooltip_titles) + 1)))
+            .values('seq').annotate(avg_days=Avg('days_since_prev_purchase'))
+            .values_list('seq', 'avg_days')
+        )
+        for seq, avg_days in seq_days:
+            data[seq - 2] = math.ceil(avg_days or 0)
         data_check = set(data)
         if data_check == {0} or data_check == {None}:
             raise NoData('資料不足')
@@ -1478,36 +1512,13 @@ class NESLHorBar(HorizontalBarChart):
         now = timezone.now()
         data = []
         date_start, date_end = self.get_date_range('time_range')
-        date_range_in_ne_group = [(date_end - datetime.timedelta(days=90)), date_end]
-        date_range_in_sl_group = [(date_end - datetime.timedelta(days=365)), date_end - datetime.timedelta(days=120)]
-        purchase_set = PurchaseBase.objects.filter(removed=False)
-        # get NE group data in range
-        purchasebase_ne_group=purchase_set.filter(datetime__lte=date_range_in_ne_group[1], datetime__gte=date_range_in_ne_group[0])
-        # get SL group data in range
-        purchasebase_sl_group=purchase_set.filter(datetime__lte=date_range_in_sl_group[1], datetime__gte=date_range_in_sl_group[0])
-
-        if not purchasebase_ne_group.exists() and not purchasebase_sl_group.exists():
+        state_counts = NESLInterval.count_states(self.team, timezone.localtime(date_end).date())
+        n_count = state_counts['N']
+        e_count = state_counts['E']
+        s_count = state_counts['S']
+        l_count = state_counts['L']
+        if not any(state_counts.values()):
             raise NoData('資料不足')
-        # get all NE group clients id
-        purchasebase_ne_group_cli_id = purchasebase_ne_group.values_list('clientbase_id',flat=True)
-        # get all SL group
-        purchasebase_sl_group_cli_id = purchasebase_sl_group.values_list('clientbase_id',flat=True)
-        # get real NE data(exclude SL data)
-        ne_group_id = purchasebase_ne_group_cli_id.exclude(clientbase_id__in=list(purchasebase_sl_group_cli_id))
-        # get real SL data(exclude NE data)
-        sl_group_id = purchasebase_sl_group_cli_id.exclude(clientbase_id__in=list(purchasebase_ne_group_cli_id))
-        # get NE count data
-        ne_group_count = ne_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-        # get SL count data
-        sl_group_count = sl_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-        # S count
-        s_count = sl_group_count.filter(clientbase_id__count=1).count()
-        # L count
-        l_count = sl_group_count.exclude(clientbase_id__count=1).count()
-        # N count
-        n_count = ne_group_count.filter(clientbase_id__count=1).count()
-        # E count
-        e_count = ne_group_count.exclude(clientbase_id__count=1).count()
         e = e_count + n_count
         s = s_count + e
         l = l_count + s
@@ -2079,48 +2090,15 @@ class NESLCount(BarChart):
         self.trace_days = self.options.get('trace_days', self.trace_days)
         now = timezone.now()
         levels = ['N','E','S','L']
+        trace_state_counts = [
+            NESLInterval.count_states(self.team, timezone.localtime(now - datetime.timedelta(days=days)).date())
+            for days in self.trace_days
+        ]
         if self.options.get('table_mode'):
             for level in levels:
                 data = []
-                for days in self.trace_days:
-                    date = now - datetime.timedelta(days=days)
-                    date_range_in_ne_group = [(date - datetime.timedelta(days=90)), date]
-                    date_range_in_sl_group = [(date - datetime.timedelta(days=365)), date - datetime.timedelta(days=120)]
-                    purchase_set = PurchaseBase.objects.filter(removed=False)
-                    # get NE group data in range
-                    purchasebase_ne_group=purchase_set.filter(datetime__lte=date_range_in_ne_group[1], datetime__gte=date_range_in_ne_group[0])
-                    # get SL group data in range
-                    purchasebase_sl_group=purchase_set.filter(datetime__lte=date_range_in_sl_group[1], datetime__gte=date_range_in_sl_group[0])
-                    # get all NE group clients id
-                    purchasebase_ne_group_cli_id = purchasebase_ne_group.values_list('clientbase_id',flat=True)
-                    # get all SL group
-                    purchasebase_sl_group_cli_id = purchasebase_sl_group.values_list('clientbase_id',flat=True)
-                    # get real NE data(exclude SL data)
-                    ne_group_id = purchasebase_ne_group_cli_id.exclude(clientbase_id__in=list(purchasebase_sl_group_cli_id))
-                    # get real SL data(exclude NE data)
-                    sl_group_id = purchasebase_sl_group_cli_id.exclude(clientbase_id__in=list(purchasebase_ne_group_cli_id))
-                    # get NE count data
-                    ne_group_count = ne_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-                    # get SL count data
-                    sl_group_count = sl_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-                    # S count
-                    s_count = sl_group_count.filter(clientbase_id__count=1).count()
-                    # L count
-                    l_count = sl_group_count.exclude(clientbase_id__count=1).count()
-                    # N count
-                    n_count = ne_group_count.filter(clientbase_id__count=1).count()
-                    # E count
-                    e_count = ne_group_count.exclude(clientbase_id__count=1).count()
-
-                    # jugde data
-                    if level == 'N':
-                        data.append(n_count)
-                    elif level == 'E':
-                        data.append(e_count)
-                    elif level == 'S':
-                        data.append(s_count)
-                    else:
-                        data.append(l_count)
+                for state_counts in trace_state_counts:
+                    data.append(state_counts[level])
                 sum_data = sum(data)
                 data = [str(per_data) + '(' + '{:.1%}'.format(per_data/sum_data) + ')'\
                 if sum_data != 0 else str(per_data) + '(0.0%)' for per_data in data]
@@ -2132,45 +2110,8 @@ class NESLCount(BarChart):
         else:
             for level in levels:
                 data = []
-                for days in self.trace_days:
-                    date = now - datetime.timedelta(days=days)
-                    date_range_in_ne_group = [(date - datetime.timedelta(days=90)), date]
-                    date_range_in_sl_group = [(date - datetime.timedelta(days=365)), date - datetime.timedelta(days=120)]
-                    purchase_set = PurchaseBase.objects.filter(removed=False)
-                    # get NE group data in range
-                    purchasebase_ne_group=purchase_set.filter(datetime__lte=date_range_in_ne_group[1], datetime__gte=date_range_in_ne_group[0])
-                    # get SL group data in range
-                    purchasebase_sl_group=purchase_set.filter(datetime__lte=date_range_in_sl_group[1], datetime__gte=date_range_in_sl_group[0])
-                    # get all NE group clients id
-                    purchasebase_ne_group_cli_id = purchasebase_ne_group.values_list('clientbase_id',flat=True)
-                    # get all SL group
-                    purchasebase_sl_group_cli_id = purchasebase_sl_group.values_list('clientbase_id',flat=True)
-                    # get real NE data(exclude SL data)
-                    ne_group_id = purchasebase_ne_group_cli_id.exclude(clientbase_id__in=list(purchasebase_sl_group_cli_id))
-                    # get real SL data(exclude NE data)
-                    sl_group_id = purchasebase_sl_group_cli_id.exclude(clientbase_id__in=list(purchasebase_ne_group_cli_id))
-                    # get NE count data
-                    ne_group_count = ne_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-                    # get SL count data
-                    sl_group_count = sl_group_id.annotate(Count('clientbase_id')).values('clientbase_id','clientbase_id__count')
-                    # S count
-                    s_count = sl_group_count.filter(clientbase_id__count=1).count()
-                    # L count
-                    l_count = sl_group_count.exclude(clientbase_id__count=1).count()
-                    # N count
-                    n_count = ne_group_count.filter(clientbase_id__count=1).count()
-                    # E count
-                    e_count = ne_group_count.exclude(clientbase_id__count=1).count()
-
-                    # jugde data
-                    if level == 'N':
-                        data.append(n_count)
-                    elif level == 'E':
-                        data.append(e_count)
-                    elif level == 'S':
-                        data.append(s_count)
-                    else:
-                        data.append(l_count)
+                for state_counts in trace_state_counts:
+                    data.append(state_counts[level])
                 notes = {
                     'tooltip_value': '{data} 人',
                     'tooltip_name': ' '
@@ -3333,6 +3274,13 @@ class RFMLevelCountBar(BarChart):
 
 @overview_charts.chart(name='交易等級回購人數直條圖')
 class RepurchaseLevelMemCountBar(BarChart):
+    '''
+    Hidden options:
+        -use_repurchase_cycle:
+            format: bool
+            default: False
+            explain: read from the pre-calculated RepurchaseCycle of each member level instead of the orders in time_range.
+    '''
     stacked = True
     def __init__(self):
         super().__init__()
@@ -3357,13 +3305,40 @@ class RepurchaseLevelMemCountBar(BarChart):
     def explain_y(self):
         return '人數'
 
+    def draw_from_repurchase_cycle(self):
+        labels = ['首購', '第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
+        self.set_labels(labels)
+        repurchase_cycles = {
+            repurchase_cycle.segment_key: repurchase_cycle for repurchase_cycle in
+            RepurchaseCycle.objects.filter(team=self.team, segment_type=RepurchaseCycle.SEGMENT_LEVEL)
+        }
+        if not repurchase_cycles:
+            raise NoData('資料不足')
+        data_check = []
+        for level_id, level in MemberLevelBase.objects.filter(team=self.team).values_list('id', 'name'):
+            repurchase_cycle = repurchase_cycles.get(str(level_id))
+            if repurchase_cycle is None:
+                data = [0] * len(labels)
+            else:
+                data = repurchase_cycle.get_member_count_of_cycles(max_cycle=len(labels) - 1)
+            data_check.append(set(data))
+
+            self.notes.update({
+                    'tooltip_value': '{name}<br>{data}人',
+                    'tooltip_name': ' '
+                })
+
+            self.create_label(name=level, data=data, notes=self.notes)
+
+        if all(d_check == {0} for d_check in data_check):
+            raise NoData('資料不足')
+
     def draw(self):
+        if self.options.get('use_repurchase_cycle'):
+            return self.draw_from_repurchase_cycle()
         date_start, date_end = self.get_date_range('time_range')
         labels = ['首購', '第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
         self.set_labels(labels)
-        now = timezone.now()
-        dict_data = []
-        value_data = []
         purchasebase_qs = PurchaseBase.objects.filter(removed=False).filter(datetime__gte=date_start, datetime__lte=date_end).annotate(
             current_level_name=Subquery(
                 LevelLogBase.objects.filter(clientbase_id=OuterRef('clientbase_id'), from_datetime__gte=date_start, from_datetime__lte=date_end).order_by('-from_datetime').values('to_level__name')[:1]
@@ -3372,27 +3347,19 @@ class RepurchaseLevelMemCountBar(BarChart):
         if not purchasebase_qs.exists():
             raise NoData('資料不足')
         member_level = list(MemberLevelBase.objects.values_list('name', flat=True))
-        order_member_count = purchasebase_qs.filter(datetime__lte=date_end, datetime__gte=date_start).values('clientbase_id').annotate(value=Count('clientbase_id'))
+        # clients making their Nth purchase in time range, grouped by level and purchase_seq
+        level_seq_member_count = (
+            purchasebase_qs.filter(current_level_name__isnull=False, purchase_seq__isnull=False)
+            .annotate(seq=Least('purchase_seq', Value(len(labels))))
+            .values('current_level_name', 'seq').annotate(member_count=Count('clientbase_id', distinct=True))
+            .values_list('current_level_name', 'seq', 'member_count')
+        )
+        level_data = defaultdict(lambda: [0]*len(labels))
+        for level, seq, member_count in level_seq_member_count:
+            level_data[level][seq - 1] = member_count
         data_check = []
         for level in member_level:
-            data = [0]*len(labels)
-            order_member_count = purchasebase_qs.filter(current_level_name=level).filter(datetime__lte=date_end, datetime__gte=date_start).values('clientbase_id').annotate(value=Count('clientbase_id'))
-            if order_member_count:
-                for count_data in order_member_count:
-                    dict_data.append(count_data['clientbase_id'])
-                    value_data.append(count_data['value'])
-                    if count_data['value'] == 1:
-                        data[0] += 1
-                    elif count_data['value'] == 2:
-                        data[1] += 1
-                    elif count_data['value'] == 3:
-                        data[2] += 1
-                    elif count_data['value'] == 4:
-                        data[3] += 1
-                    elif count_data['value'] == 5:
-                        data[4] += 1
-                    else:
-                        data[5] += 1
+            data = level_data[level]
             data_check.append(set(data))
 
             self.notes.update({
@@ -3411,6 +3378,13 @@ class RepurchaseLevelMemCountBar(BarChart):
 
 @overview_charts.chart(name='交易等級回購天數直條圖')
 class RepurchaseLevelDayCountBar(BarChart):
+    '''
+    Hidden options:
+        -use_repurchase_cycle:
+            format: bool
+            default: False
+            explain: read from the pre-calculated RepurchaseCycle of each member level instead of the orders in time_range.
+    '''
     def __init__(self):
         super().__init__()
         now = timezone.now()
@@ -3454,14 +3428,25 @@ class RepurchaseLevelDayCountBar(BarChart):
     def get_id_level_map(self, member_level):
         return {level['id']:level['name'] for level in member_level}
 
+    def draw_from_repurchase_cycle(self, level):
+        repurchase_cycle = RepurchaseCycle.get_segment(self.team, RepurchaseCycle.SEGMENT_LEVEL, level)
+        if repurchase_cycle is None:
+            raise NoData('資料不足')
+        data = repurchase_cycle.get_mean_days_of_cycles(max_cycle=len(self.get_labels()))
+        self.set_total(repurchase_cycle.count_cycle)
+        self.notes.update({
+            'tooltip_value': f'{{data}} 天 ',
+            'tooltip_name': ' '
+        })
+
+        self.create_label(data=data, notes=self.notes)
+
     def draw(self):
         level = self.options.get('levels')
+        if self.options.get('use_repurchase_cycle') and level != 'no_levels':
+            return self.draw_from_repurchase_cycle(level)
         date_start, date_end = self.get_date_range('time_range')
         tooltip_titles = ['第一次回購', '第二次回購', '第三次回購', '第四次回購', '大於四次回購']
-        day_data = [0]*len(tooltip_titles)
-        data_member_count = [0] * len(tooltip_titles)
-        now = timezone.now()
-        per_data_count = {}
         purchasebase_qs = PurchaseBase.objects.filter(removed=False).filter(datetime__gte=date_start, datetime__lte=date_end).annotate(
             current_level_name=Subquery(
                 LevelLogBase.objects.filter(clientbase_id=OuterRef('clientbase_id'), from_datetime__gte=date_start, from_datetime__lte=date_end).order_by('-from_datetime').values('to_level__name')[:1]
@@ -3473,27 +3458,17 @@ class RepurchaseLevelDayCountBar(BarChart):
             purchasebase_qs = purchasebase_qs.filter(current_level_name=id_level_map[int(level)])
         if not purchasebase_qs.exists():
             raise NoData('資料不足')
-        self.set_total(len(purchasebase_qs))
-        purchase_data = purchasebase_qs.values('clientbase_id','datetime')
-        for per_data in purchase_data:
-            per_data_count[per_data['clientbase_id']] = per_data_count.get(per_data['clientbase_id'], 0) + 1
-            if per_data_count.get(per_data['clientbase_id']) == 2:
-                day_data[0] += (now - per_data['datetime']).days
-                data_member_count[0] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 3:
-                day_data[1] += (now - per_data['datetime']).days
-                data_member_count[1] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 4:
-                day_data[2] += (now - per_data['datetime']).days
-                data_member_count[2] += 1
-            elif per_data_count.get(per_data['clientbase_id']) == 5:
-                day_data[3] += (now - per_data['datetime']).days
-                data_member_count[3] += 1
-            else:
-                day_data[4] += (now - per_data['datetime']).days
-                data_member_count[4] += 1
-        f_data_member_count = [1 for count in data_member_count if count == 0]
-        data = [math.ceil(day / count) for day, count in zip(day_data, f_data_member_count)]
+        self.set_total(purchasebase_qs.count())
+        data = [0]*len(tooltip_titles)
+        # average days since the previous purchase, grouped by purchase_seq (2nd purchase is the 1st re-purchase)
+        seq_days = (
+            purchasebase_qs.filter(purchase_seq__gt=1)
+            .annotate(seq=Least('purchase_seq', Value(len(tooltip_titles) + 1)))
+            .values('seq').annotate(avg_days=Avg('days_since_prev_purchase'))
+            .values_list('seq', 'avg_days')
+        )
+        for seq, avg_days in seq_days:
+            data[seq - 2] = math.ceil(avg_days or 0)
         self.notes.update({
             'tooltip_value': f'{{data}} 天 ',
             'tooltip_name': ' '
@@ -15,9 +15,14 @@ from tag_assigner.models import ValueTag
 
 from cerem.tasks import aggregate_from_cerem
 
+from ..segments import SegmentCondition, bitmap_condition, bitmap_enabled
 from .models import EventBase, LevelLogBase, EventLogBase, EventBase
 
 
+if bitmap_enabled():
+    condition('組合條件', tab='進階')(SegmentCondition)
+
+
 class EventConditionBase(SelectCondition):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -42,6 +47,7 @@ class EventConditionBase(SelectCondition):
 
 
 @condition('免費活動', tab='活動')
+@bitmap_condition
 class FreeEventCondition(EventConditionBase):
     def lazy_init(self, team, *args, **kwargs):
         events = team.eventbase_set.filter(cost_type=EventBase.COST_TYPE_FREE)
@@ -52,6 +58,7 @@ class FreeEventCondition(EventConditionBase):
 
 
 @condition('兌換碼活動', tab='活動')
+@bitmap_condition
 class CodeEventCondition(EventConditionBase):
     def lazy_init(self, team, *args, **kwargs):
         events = team.eventbase_set.filter(cost_type=EventBase.COST_TYPE_CODE)
@@ -62,6 +69,7 @@ class CodeEventCondition(EventConditionBase):
 
 
 @condition('點數活動', tab='活動')
+@bitmap_condition
 class CreditEventCondition(EventConditionBase):
     def lazy_init(self, team, *args, **kwargs):
         events = team.eventbase_set.filter(cost_type=EventBase.COST_TYPE_CREDIT)
@@ -101,16 +109,19 @@ class PointConditionBase(SelectCondition):
 
 
 @condition('兌點', tab='點數')
+@bitmap_condition
 class PointUseCondition(PointConditionBase):
     log_filter = Q(pointlogbase__amount__lt=0)
 
 
 @condition('給點', tab='點數')
+@bitmap_condition
 class PointClaimCondition(PointConditionBase):
     log_filter = Q(pointlogbase__amount__gt=0)
 
 
 @condition('等級', tab='等級')
+@bitmap_condition
 class LevelCondition(SelectCondition):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -187,6 +198,7 @@ class TicketNameConditionBase(SelectCondition):
         self.choice(*data)
 
 @condition('發券_票券類型', tab='票券')
+@bitmap_condition
 class TicketTypeClaim(TicketTypeConditionBase):
     action = EventLogBase.ACTION_CLAIM
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
@@ -204,6 +216,7 @@ class TicketTypeClaim(TicketTypeConditionBase):
 
 
 @condition('發券_票券名稱', tab='票券')
+@bitmap_condition
 class TicketNameClaim(TicketNameConditionBase):
     action = EventLogBase.ACTION_CLAIM
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
@@ -219,6 +232,7 @@ class TicketNameClaim(TicketNameConditionBase):
         return client_qs, q
 
 @condition('核銷_票券類型', tab='票券')
+@bitmap_condition
 class TicketTypeUse(TicketTypeConditionBase):
     action = EventLogBase.ACTION_USE
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
@@ -235,6 +249,7 @@ class TicketTypeUse(TicketTypeConditionBase):
 
 
 @condition('核銷_票券名稱', tab='票券')
+@bitmap_condition
 class TicketNameUse(TicketNameConditionBase):
     action = EventLogBase.ACTION_USE
     def filter(self, client_qs: QuerySet, choices: Any) -> Tuple[QuerySet, Q]:
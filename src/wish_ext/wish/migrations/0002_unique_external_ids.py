@@ -0,0 +1,82 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import uuid
+
+
+def dedup_external_ids(apps, schema_editor):
+    '''
+    keeps the latest row of every (team, external_id) so the unique constraints can be added,
+    the logs of a dropped event are moved to the kept one
+    '''
+    event_table = apps.get_model('wish', 'EventBase')._meta.db_table
+    eventlog_table = apps.get_model('wish', 'EventLogBase')._meta.db_table
+    pointlog_table = apps.get_model('wish', 'PointLogBase')._meta.db_table
+
+    def duplicates(table):
+        return f'''
+            SELECT id, keep_id FROM (
+                SELECT id, max(id) OVER (PARTITION BY team_id, external_id) AS keep_id
+                FROM {table} WHERE external_id IS NOT NULL
+            ) ranked
+            WHERE id <> keep_id
+        '''
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'''
+            UPDATE {eventlog_table} SET event_id = duplicate.keep_id
+            FROM ({duplicates(event_table)}) duplicate
+            WHERE {eventlog_table}.event_id = duplicate.id
+        ''')
+        for table in (event_table, pointlog_table):
+            cursor.execute(f'DELETE FROM {table} WHERE id IN (SELECT id FROM ({duplicates(table)}) duplicate)')
+        # fire the deferred foreign key checks now, ALTER TABLE refuses tables with pending trigger events
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team', '0001_initial'),
+        ('wish', '0001_initial'),
+    ]
+
+    operations = [
+        # already in the database, the models changed without their migrations
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RenameField(
+                model_name='eventlogbase',
+                old_name='cost_type',
+                new_name='action',
+            ),
+            migrations.AddField(
+                model_name='eventlogbase',
+                name='external_id',
+                field=models.CharField(default=uuid.uuid4, max_length=128, unique=True),
+            ),
+            migrations.AddField(
+                model_name='pointlogbase',
+                name='external_id',
+                field=models.TextField(null=True),
+            ),
+        ]),
+        migrations.AddField(
+            model_name='levellogbase',
+            name='external_id',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(dedup_external_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='eventbase',
+            unique_together={('team', 'external_id')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='levellogbase',
+            unique_together={('team', 'external_id')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='pointlogbase',
+            unique_together={('team', 'external_id')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wish', '0002_unique_external_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventlogbase',
+            name='dedup_key',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:30
+
+import hashlib
+
+from django.db import migrations
+
+BATCH_SIZE = 10000
+
+
+def event_log_key(team_id, external_id):
+    # wish.models.event_log_key when this migration was written
+    digest = hashlib.blake2b(f'{team_id}:{external_id}'.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def backfill_dedup_keys(apps, schema_editor):
+    '''
+    dedup_key of the existing logs, one committed batch of ids at a time so an interrupted run resumes where it stopped.
+    external_id was unique until now, so the keys are too
+    '''
+    table = apps.get_model('wish', 'EventLogBase')._meta.db_table
+    last_id = 0
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            cursor.execute(f'''
+                SELECT id, team_id, external_id FROM {table}
+                WHERE id > %s AND dedup_key IS NULL ORDER BY id LIMIT %s
+            ''', [last_id, BATCH_SIZE])
+            logs = cursor.fetchall()
+            if not logs:
+                break
+            cursor.execute(f'''
+                UPDATE {table} SET dedup_key = keys.dedup_key
+                FROM unnest(%s::integer[], %s::bigint[]) AS keys(id, dedup_key)
+                WHERE {table}.id = keys.id
+            ''', [[id for id, team_id, external_id in logs], [event_log_key(team_id, external_id) for id, team_id, external_id in logs]])
+            last_id = logs[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('wish', '0003_eventlogbase_dedup_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_dedup_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:30
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('team', '0001_initial'),
+        ('wish', '0004_backfill_eventlogbase_dedup_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='eventlogbase',
+            name='external_id',
+            field=models.CharField(default=uuid.uuid4, max_length=128),
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventlogbase',
+            unique_together={('team', 'dedup_key')},
+        ),
+        migrations.AddIndex(
+            model_name='eventlogbase',
+            index=models.Index(fields=['clientbase', 'action', 'datetime'], name='wish_eventl_clientb_d5b6e4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventlogbase',
+            index=models.Index(fields=['event', 'action', 'datetime'], name='wish_eventl_event_i_0c34a6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventlogbase',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['datetime'], name='wish_eventl_datetim_70bebf_brin'),
+        ),
+    ]
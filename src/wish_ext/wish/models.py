@@ -1,9 +1,11 @@
 from django.urls import reverse
+import hashlib
 import html2text
 from uuid import uuid4
 
 from django.db import models
 from django.contrib.postgres.fields import JSONField, ArrayField
+from django.contrib.postgres.indexes import BrinIndex
 
 from datahub.models import DataSource
 
@@ -73,8 +75,19 @@ class MemberLevelBase(BaseModel):
     attributions = JSONField(blank=True, null=True)
 
 
+def level_log_key(clientbase_external_id, from_level_id, to_level_id, *datetimes):
+    '''
+    external_id of a level log sent without an id, derived from its content so replays still hit the same row
+    '''
+    content = '\x1f'.join(str(value) for value in (clientbase_external_id, from_level_id, to_level_id, *datetimes))
+    return 'content:' + hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
 class LevelLogBase(BaseModel):
+    class Meta:
+        unique_together = [['team', 'external_id']]
 
+    external_id = models.TextField(null=True)  # dedup key, level_log_key for logs sent without an id, rows imported before it was added have none
     team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
     from_level = models.ForeignKey(MemberLevelBase, related_name='to_logs', on_delete=models.CASCADE)
     to_level = models.ForeignKey(MemberLevelBase, related_name='from_logs', on_delete=models.CASCADE)
@@ -91,6 +104,7 @@ class LevelLogBase(BaseModel):
 
 class EventBase(BaseModel):
     class Meta:
+        unique_together = [['team', 'external_id']]
         indexes = [
             models.Index(fields=['cost_type', ]),
             models.Index(fields=['ticket_type', ]),
@@ -126,9 +140,26 @@ class EventBase(BaseModel):
     attributions = JSONField(blank=True, null=True)
 
 
+def event_log_key(team_id, external_id):
+    '''
+    team scoped dedup key of an event log, 8 bytes of blake2b as a signed bigint
+    '''
+    digest = hashlib.blake2b(f'{team_id}:{external_id}'.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
 class EventLogBase(BaseModel):
+    class Meta:
+        unique_together = [['team', 'dedup_key']]
+        indexes = [
+            models.Index(fields=['clientbase', 'action', 'datetime']),
+            models.Index(fields=['event', 'action', 'datetime']),
+            # logs are appended in about datetime order, a brin index stays tiny and cheap to maintain
+            BrinIndex(fields=['datetime']),
+        ]
 
-    external_id = models.CharField(max_length=128, unique=True, default=uuid4)
+    external_id = models.CharField(max_length=128, default=uuid4)
+    dedup_key = models.BigIntegerField(null=True)  # event_log_key(team_id, external_id), none for logs sent without an id
     team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
     event = models.ForeignKey(EventBase, related_name='logs', on_delete=models.CASCADE)
     clientbase = models.ForeignKey(ClientBase, on_delete=models.CASCADE)
@@ -155,6 +186,8 @@ class EventLogBase(BaseModel):
 
 
 class PointLogBase(BaseModel):
+    class Meta:
+        unique_together = [['team', 'external_id']]
 
     external_id = models.TextField(null=True)
     team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
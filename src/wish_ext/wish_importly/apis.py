@@ -1,16 +1,26 @@
+from uuid import uuid4
+
 import orjson
 
 from django.http import JsonResponse
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
 
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
 from rest_framework import status
 
+from datahub.models import DataSource
 from external_app.models import ExternalAppApiKey
 
+from ..datasources import standards
+from ..datasources.streaming import StreamingFileImporter
 from ..extension import wish_ext
-from .tasks import process_eventlist, process_levellist, process_eventloglist, process_levelloglist, process_pointloglist
+from ..ndjson import APIStreamImportBaseView
+from ..payloads import batch_key, claim_batch, store_payload
+from .importers import LevelImporter, LevelLogImporter, EventImporter, EventLogImporter, PointLogImporter
+from .tasks import process_eventlist, process_levellist, process_eventloglist, process_levelloglist, process_pointloglist, start_streaming_import
 
 class APIImportBaseView(APIView):
     permission_classes = [AllowAny]
@@ -42,10 +52,17 @@ class APIImportBaseView(APIView):
         if len(data['data']) > settings.BATCH_SIZE_L:
             return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': f'Max row of data per request is {settings.BATCH_SIZE_L}.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
 
+        batch = claim_batch(team, batch_key(request.path, request.body, request.headers.get('Idempotency-Key')))
+        if not batch:
+            # a replay of a batch already applied or in progress
+            return JsonResponse({'result': True, 'msg': {'title': 'OK', 'text': 'Data is already recived'}, 'duplicate': True}, status=status.HTTP_200_OK)
+
+        # only the payload id goes through the broker
+        payload = store_payload(team, data, batch)
         if settings.DEBUG is True:
-            self.task(team_slug=team.slug, data=data)
+            self.task(team_slug=team.slug, payload_id=payload.id)
         else:
-            self.task.delay(team_slug=team.slug, data=data)
+            self.task.delay(team_slug=team.slug, payload_id=payload.id)
 
         return JsonResponse({'result': True, 'msg': {'title': 'OK', 'text': 'Data is recived'}}, status=status.HTTP_200_OK)
 
@@ -73,3 +90,71 @@ class ImportLevelLogList(APIImportBaseView):
 @wish_ext.api('v1/<signature>/pointloglist/')
 class ImportPointLogList(APIImportBaseView):
     task = process_pointloglist
+
+
+@wish_ext.api('v1/<signature>/eventlist/stream/')
+class StreamImportEventList(APIStreamImportBaseView):
+    importer = EventImporter
+
+
+@wish_ext.api('v1/<signature>/eventloglist/stream/')
+class StreamImportEventLogList(APIStreamImportBaseView):
+    importer = EventLogImporter
+
+
+@wish_ext.api('v1/<signature>/levellist/stream/')
+class StreamImportLevelList(APIStreamImportBaseView):
+    importer = LevelImporter
+
+
+@wish_ext.api('v1/<signature>/levelloglist/stream/')
+class StreamImportLevelLogList(APIStreamImportBaseView):
+    importer = LevelLogImporter
+
+
+@wish_ext.api('v1/<signature>/pointloglist/stream/')
+class StreamImportPointLogList(APIStreamImportBaseView):
+    importer = PointLogImporter
+
+
+@wish_ext.api('v1/<signature>/file/')
+class StreamingFileImport(APIView):
+    '''
+    multipart upload: file (csv / xlsx), datasource (uuid), format (a StreamingFileImporter of datasources.standards).
+    the file is stored in default_storage and imported chunk by chunk by process_streaming_import.
+    '''
+    permission_classes = [AllowAny]
+
+    def post(self, request, *args, **kwargs):
+
+        signature = kwargs.get('signature')
+        api_key = request.headers.get('X-Api-Key')
+
+        if not any([signature, api_key]):
+            return JsonResponse({'result': False, 'msg': {'title': 'Value Missing', 'text': 'Signature or api_key is missing.'}}, status=status.HTTP_400_BAD_REQUEST)
+
+        team = ExternalAppApiKey.get_team(signature, api_key)
+
+        if not team:
+            return JsonResponse({'result': False, 'msg': {'title': 'Not Valid', 'text': 'api_key is not valid or is expired.'}}, status=status.HTTP_401_UNAUTHORIZED)
+
+        file_importer = getattr(standards, str(request.data.get('format')), None)
+        if not (isinstance(file_importer, type) and issubclass(file_importer, StreamingFileImporter)):
+            return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': 'Format is not supported.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        try:
+            datasource = DataSource.objects.filter(uuid=request.data.get('datasource')).first()
+        except ValidationError:
+            datasource = None
+
+        if not datasource:
+            return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': 'Datasource is missing.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        upload = request.FILES.get('file')
+        if not upload:
+            return JsonResponse({'result': False, 'msg': {'title': 'Invalid data', 'text': 'File is missing.'}}, status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        path = default_storage.save(f'wish_ext/streaming_imports/{team.id}/{uuid4().hex}/{upload.name}', upload)
+        streaming_import = start_streaming_import(team, datasource, file_importer, path)
+
+        return JsonResponse({'result': True, 'msg': {'title': 'OK', 'text': 'File is recived'}, 'id': streaming_import.id}, status=status.HTTP_200_OK)
@@ -6,14 +6,20 @@ from django.db.models import Min
 
 from importly.importers import DataImporter
 from importly.formatters import (
-    Formatted, format_datetime, format_int, format_bool
+    Formatted, format_int, format_bool
 )
 
 from datahub.data_flows import handle_data
 from datahub.models import Field, FieldGroup, ChoiceField, PrimaryField
 
+from ..columnar import DatetimeFormatter
+from ..instrumentation import count_changes, instrumented
+from ..resolvers import Resolver, invalidate_team, resolve_external_ids
+from ..sharding import assign_shards
+from ..staging import iter_chunks
+from ..upsert import upsert
 from ..wish.datahub import DataTypeLevel, DataTypeLevelLog, DataTypeEvent, DataTypeEventLog, DataTypePointLog
-from ..wish.models import EventBase, MemberLevelBase, LevelLogBase, EventLogBase, PointLogBase
+from ..wish.models import EventBase, MemberLevelBase, LevelLogBase, EventLogBase, PointLogBase, event_log_key, level_log_key
 
 from .formatters import format_dict
 from .models import Level, LevelLog, Event, EventLog, PointLog
@@ -41,31 +47,46 @@ class LevelImporter(DataImporter):
     rank = Field('階級數字', group=group_level)
     attributions = Field('等級屬性', group=group_level, is_attributions=True)
 
+    @instrumented
     def process_raw_records(self):
 
+        levels = list(self.datalist.level_set.values('external_id', 'rank', 'name', 'attributions'))
+
         level_map = {}
-        for level in self.team.memberlevelbase_set.values('id', 'external_id', 'rank', 'name', 'attributions'):
+        existing_levels = resolve_external_ids(
+            self.team.memberlevelbase_set, [level['external_id'] for level in levels],
+            'id', 'rank', 'name', 'attributions'
+        )
+        for level in existing_levels.values():
             level_map[level['external_id']] = MemberLevelBase(**level)
 
-        levels = self.datalist.level_set.values('external_id', 'rank', 'name', 'attributions')
         levels_to_create = []
-        levels_to_update = set()
+        levels_to_update = {}
+        unchanged = 0
         for level in levels:
             external_id = level['external_id']
             if external_id in level_map:
                 levelbase = level_map[external_id]
-                if levelbase.id:
-                    levels_to_update.add(levelbase)
-                levelbase.attributions.update(level['attributions'])
+                attributions = {**(levelbase.attributions or {}), **(level['attributions'] or {})}
+                if (levelbase.rank, levelbase.name, levelbase.attributions) == (level['rank'], level['name'], attributions):
+                    unchanged += 1
+                    continue
+                levelbase.attributions = attributions
                 levelbase.rank = level['rank']
                 levelbase.name = level['name']
+                if levelbase.id:
+                    levels_to_update[levelbase.id] = levelbase
             else:
                 level = MemberLevelBase(**level, team_id=self.team.id)
                 levels_to_create.append(level)
                 level_map[external_id] = level
         update_fields = ['rank', 'name', 'attributions']
         MemberLevelBase.objects.bulk_create(levels_to_create, batch_size=settings.BATCH_SIZE_M)
-        MemberLevelBase.objects.bulk_update(levels_to_update, update_fields, batch_size=settings.BATCH_SIZE_M)
+        MemberLevelBase.objects.bulk_update(levels_to_update.values(), update_fields, batch_size=settings.BATCH_SIZE_M)
+        count_changes(inserted=len(levels_to_create), updated=len(levels_to_update), unchanged=unchanged)
+        if levels_to_create or levels_to_update:
+            # names / ids of levels have changed
+            invalidate_team(self.team.id)
 
 
 class LevelLogImporter(DataImporter):
@@ -81,9 +102,9 @@ class LevelLogImporter(DataImporter):
             from_level_id = Formatted(str, 'from_level_id')
             to_level_id = Formatted(str, 'to_level_id')
             clientbase_external_id = Formatted(str, 'member_id')
-            datetime = Formatted(format_datetime, 'datetime')
-            from_datetime = Formatted(format_datetime, 'from_datetime')
-            to_datetime = Formatted(format_datetime, 'to_datetime')
+            datetime = Formatted(DatetimeFormatter(), 'datetime')
+            from_datetime = Formatted(DatetimeFormatter(), 'from_datetime')
+            to_datetime = Formatted(DatetimeFormatter(), 'to_datetime')
             attributions = Formatted(dict, 'attributions')
 
     group_level_log = FieldGroup(key='LEVELLOG', name='等級記錄')
@@ -97,35 +118,46 @@ class LevelLogImporter(DataImporter):
     to_datetime = Field('等級到期時間', group=group_level_log)
     attributions = Field('等級記錄屬性', group=group_level_log, is_attributions=True)
 
+    @instrumented
     def process_raw_records(self):
 
-        level_name_map = {}
-        level_map = {}
-        for external_id, name, level_id in self.team.memberlevelbase_set.values_list('external_id', 'name', 'id'):
-            level_map[external_id] = level_id
-            level_name_map[name] = level_id
-
-        clientbase_map = {}
-        for clientbase_id, external_id in self.team.clientbase_set.filter(removed=False).values_list('id', 'external_id'):
-            clientbase_map[external_id] = clientbase_id
+        level_resolver = Resolver('level', self.team.id, self.team.memberlevelbase_set)
+        level_name_resolver = Resolver('level_name', self.team.id, self.team.memberlevelbase_set, key='name')
+        clientbase_resolver = Resolver('clientbase', self.team.id, self.team.clientbase_set.filter(removed=False))
 
-        logs = self.datalist.levellog_set.values(
-            'from_level_id', 'to_level_id', 'datetime',
+        for logs in iter_chunks(self.datalist.levellog_set.values(
+            'external_id', 'from_level_id', 'to_level_id', 'datetime',
             'clientbase_external_id', 'attributions', 'from_datetime', 'to_datetime'
-        )
-        logs_to_create = []
-        for log in logs:
-            from_level_id = log.pop('from_level_id')
-            to_level_id = log.pop('to_level_id')
-            clientbase_external_id = log.pop('clientbase_external_id')
-            log['from_level_id'] = level_map.get(from_level_id, level_name_map.get(from_level_id))
-            log['to_level_id'] = level_map.get(to_level_id, level_name_map.get(to_level_id))
-            clientbase_id = clientbase_map.get(clientbase_external_id)
-            if not clientbase_id or not log['from_level_id'] or not log['to_level_id']:
-                continue
-            logs_to_create.append(LevelLogBase(**log, clientbase_id=clientbase_id, team_id=self.team.id))
+        )):
+            level_ids = set(log['from_level_id'] for log in logs) | set(log['to_level_id'] for log in logs)
+            level_map = level_resolver.resolve(level_ids)
+            level_name_map = level_name_resolver.resolve(level_ids - set(level_map))
+            clientbase_map = clientbase_resolver.resolve(log['clientbase_external_id'] for log in logs)
+            logs_to_upsert = []
+            for log in logs:
+                from_level_id = log.pop('from_level_id')
+                to_level_id = log.pop('to_level_id')
+                clientbase_external_id = log.pop('clientbase_external_id')
+                if log['external_id'] in (None, '', 'None'):
+                    log['external_id'] = level_log_key(
+                        clientbase_external_id, from_level_id, to_level_id,
+                        log['datetime'], log['from_datetime'], log['to_datetime']
+                    )
+                log['from_level_id'] = level_map.get(from_level_id, level_name_map.get(from_level_id))
+                log['to_level_id'] = level_map.get(to_level_id, level_name_map.get(to_level_id))
+                log['clientbase_id'] = clientbase_map.get(clientbase_external_id)
+                log['removed'] = False
+                if not log['clientbase_id'] or not log['from_level_id'] or not log['to_level_id']:
+                    continue
+                logs_to_upsert.append(log)
 
-        LevelLogBase.objects.bulk_create(logs_to_create, batch_size=settings.BATCH_SIZE_M)
+            # replayed logs hit the (team, external_id) key instead of adding rows
+            upsert(
+                LevelLogBase, self.team.id, logs_to_upsert,
+                update_fields=['from_level_id', 'to_level_id', 'clientbase_id', 'datetime', 'from_datetime', 'to_datetime', 'removed'],
+                merge_fields=['attributions'],
+                resolve_unchanged=False,
+            )
 
 
 class EventImporter(DataImporter):
@@ -159,33 +191,17 @@ class EventImporter(DataImporter):
     cost_type = ChoiceField('免費/點數/兌換碼', group=group_event, choices=COST_TYPE_CHOICES)
     attributions = Field('活動屬性', group=group_event, is_attributions=True)
 
+    @instrumented
     def process_raw_records(self):
 
-        event_map = {}
-        for event in self.team.eventbase_set.values('id', 'external_id', 'ticket_type', 'name', 'cost_type', 'attributions', 'ticket_name'):
-            event_map[event['external_id']] = EventBase(**event)
-
-        events = self.datalist.event_set.values('external_id', 'ticket_type', 'name', 'attributions', 'cost_type', 'ticket_name')
-        events_to_create = []
-        events_to_update = set()
-        for event in events:
-            external_id = event['external_id']
-            if external_id in event_map:
-                eventbase = event_map[external_id]
-                if eventbase.id:
-                    events_to_update.add(eventbase)
-                eventbase.attributions.update(event['attributions'])
-                eventbase.ticket_type = event['ticket_type']
-                eventbase.ticket_name = event['ticket_name']
-                eventbase.name = event['name']
-                eventbase.cost_type = event['cost_type']
-            else:
-                event = EventBase(**event, team_id=self.team.id)
-                events_to_create.append(event)
-                event_map[external_id] = event
-        update_fields = ['ticket_type', 'name', 'attributions', 'cost_type', 'ticket_name']
-        EventBase.objects.bulk_create(events_to_create, batch_size=settings.BATCH_SIZE_M)
-        EventBase.objects.bulk_update(events_to_update, update_fields, batch_size=settings.BATCH_SIZE_M)
+        resolver = Resolver('event', self.team.id, self.team.eventbase_set)
+        for events in iter_chunks(self.datalist.event_set.values('external_id', 'ticket_type', 'name', 'attributions', 'cost_type', 'ticket_name')):
+            event_map = upsert(
+                EventBase, self.team.id, [dict(event, removed=False) for event in events],
+                update_fields=['ticket_type', 'name', 'cost_type', 'ticket_name', 'removed'],
+                merge_fields=['attributions'],
+            )
+            resolver.add(event_map)
 
 
 class EventLogImporter(DataImporter):
@@ -201,7 +217,7 @@ class EventLogImporter(DataImporter):
             event_external_id = Formatted(str, 'event_id')
             clientbase_external_id = Formatted(str, 'member_id')
             action = Formatted(str, 'action')
-            datetime = Formatted(format_datetime, 'datetime')
+            datetime = Formatted(DatetimeFormatter(), 'datetime')
             attributions = Formatted(dict, 'attributions')
 
     group_event_log = FieldGroup(key='EVENTLOG', name='活動記錄')
@@ -219,35 +235,35 @@ class EventLogImporter(DataImporter):
     action = ChoiceField('領取/使用', group=group_event_log, choices=ACTION_CHOIES)
     attributions = Field('活動記錄屬性', group=group_event_log, is_attributions=True)
 
+    @instrumented
     def process_raw_records(self):
 
-        event_map = {}
-        for external_id, event_id in self.team.eventbase_set.values_list('external_id', 'id'):
-            event_map[external_id] = event_id
+        event_resolver = Resolver('event', self.team.id, self.team.eventbase_set)
+        clientbase_resolver = Resolver('clientbase', self.team.id, self.team.clientbase_set.filter(removed=False))
 
-        clientbase_map = {}
-        for clientbase_id, external_id in self.team.clientbase_set.filter(removed=False).values_list('id', 'external_id'):
-            clientbase_map[external_id] = clientbase_id
-
-        logs = self.datalist.eventlog_set.values(
+        for logs in iter_chunks(self.datalist.eventlog_set.values(
             'event_external_id', 'action', 'datetime',
             'clientbase_external_id', 'attributions', 'external_id'
-        )
-        logs_to_create = []
-        for log in logs:
-            event_id = log.pop('event_external_id')
-            clientbase_external_id = log.pop('clientbase_external_id')
-            log['event_id'] = event_map.get(event_id)
-            if not log['external_id']:
-                del log['external_id']
-            clientbase_id = clientbase_map.get(clientbase_external_id)
-            print(event_map, event_id, log['event_id'])
+        )):
+            event_map = event_resolver.resolve(log['event_external_id'] for log in logs)
+            clientbase_map = clientbase_resolver.resolve(log['clientbase_external_id'] for log in logs)
+            logs_to_create = []
+            for log in logs:
+                event_id = log.pop('event_external_id')
+                clientbase_external_id = log.pop('clientbase_external_id')
+                log['event_id'] = event_map.get(event_id)
+                if log['external_id']:
+                    log['dedup_key'] = event_log_key(self.team.id, log['external_id'])
+                else:
+                    del log['external_id']
+                clientbase_id = clientbase_map.get(clientbase_external_id)
 
-            if not clientbase_id or not log['event_id']:
-                continue
-            logs_to_create.append(EventLogBase(**log, clientbase_id=clientbase_id, team_id=self.team.id))
+                if not clientbase_id or not log['event_id']:
+                    continue
+                logs_to_create.append(EventLogBase(**log, clientbase_id=clientbase_id, team_id=self.team.id))
 
-        EventLogBase.objects.bulk_create(logs_to_create, batch_size=settings.BATCH_SIZE_M, ignore_conflicts=True)
+            # append only, replayed logs conflict on (team, dedup_key) and are skipped
+            EventLogBase.objects.bulk_create(logs_to_create, batch_size=settings.BATCH_SIZE_M, ignore_conflicts=True)
 
 
 class PointLogImporter(DataImporter):
@@ -264,7 +280,7 @@ class PointLogImporter(DataImporter):
             clientbase_external_id = Formatted(str, 'member_id')
             amount = Formatted(format_int, 'amount')
             is_transaction = Formatted(format_bool, 'is_transaction')
-            datetime = Formatted(format_datetime, 'datetime')
+            datetime = Formatted(DatetimeFormatter(), 'datetime')
             attributions = Formatted(dict, 'attributions')
 
     group_event_log = FieldGroup(key='POINTLOG', name='點數記錄')
@@ -278,44 +294,47 @@ class PointLogImporter(DataImporter):
 
     is_transaction = Field('交易/非交易', group=group_event_log)
 
-    def process_raw_records(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard = None
 
-        pointlog_map = {}
-        for log in self.team.pointlogbase_set.values(
-            'id', 'external_id', 'point_name',
-            'datetime', 'amount', 'attributions', 'is_transaction'
-        ):
-            pointlog_map[log['external_id']] = PointLogBase(**log)
+    def get_pointlogs(self):
+        logs = self.datalist.pointlog_set.order_by('id')
+        if self.shard is not None:
+            logs = logs.filter(shard=self.shard)
+        return logs
 
-        clientbase_map = {}
-        for clientbase_id, external_id in self.team.clientbase_set.filter(removed=False).values_list('id', 'external_id'):
-            clientbase_map[external_id] = clientbase_id
+    @instrumented
+    def process_raw_records(self):
+        '''
+        memory is bounded by the chunk size: staged logs are read in chunks and only the point logs
+        and clients of each chunk are looked up, never the whole PointLogBase of the team
+        '''
+        clientbase_resolver = Resolver('clientbase', self.team.id, self.team.clientbase_set.filter(removed=False))
 
-        logs = self.datalist.pointlog_set.values(
+        for logs in iter_chunks(self.get_pointlogs().values(
             'external_id', 'point_name', 'clientbase_external_id', 'datetime',
             'amount', 'attributions', 'is_transaction'
-        )
-        logs_to_create = []
-        logs_to_update = set()
-        for log in logs:
-            external_id = log['external_id']
-            clientbase_external_id = log.pop('clientbase_external_id')
-            if external_id in pointlog_map:
-                logbase = pointlog_map[external_id]
-                if logbase.id:
-                    logs_to_update.add(logbase)
-                logbase.attributions.update(log['attributions'])
-                logbase.point_name = log['point_name']
-                logbase.datetime = log['datetime']
-                logbase.is_transaction = log['is_transaction']
-                logbase.amount = log['amount']
-            else:
-                clientbase_id = clientbase_map.get(clientbase_external_id)
-                if not clientbase_id:
-                    continue
-                log = PointLogBase(**log, team_id=self.team.id, clientbase_id=clientbase_id)
-                logs_to_create.append(log)
-                pointlog_map[external_id] = log
-        update_fields = ['point_name', 'attributions', 'amount', 'is_transaction', 'datetime']
-        PointLogBase.objects.bulk_create(logs_to_create, batch_size=settings.BATCH_SIZE_M)
-        PointLogBase.objects.bulk_update(logs_to_update, update_fields, batch_size=settings.BATCH_SIZE_M)
+        )):
+            clientbase_map = clientbase_resolver.resolve(log['clientbase_external_id'] for log in logs)
+            for log in logs:
+                log['clientbase_id'] = clientbase_map.get(log.pop('clientbase_external_id'))
+                log['removed'] = False
+            upsert(
+                PointLogBase, self.team.id, logs,
+                update_fields=['point_name', 'amount', 'is_transaction', 'datetime', 'removed'],
+                merge_fields=['attributions'],
+                required_fields=['clientbase_id'],
+                resolve_unchanged=False,
+            )
+
+    @instrumented
+    def prepare_shards(self, shard_count):
+        assign_shards(PointLog, self.datalist.pointlog_set.values_list('id', 'clientbase_external_id'), shard_count)
+
+    def process_shard(self, shard):
+        self.shard = shard
+        self.process_raw_records()
+
+    def finish_shards(self):
+        pass
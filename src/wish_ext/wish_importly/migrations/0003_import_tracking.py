@@ -0,0 +1,142 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:18
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datahub', '0006_datasource_website'),
+        ('team', '0001_initial'),
+        ('wish_importly', '0002_auto_20221021_1545'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pointlog',
+            name='shard',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StreamingImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('file_importer', models.CharField(max_length=128)),
+                ('path', models.TextField()),
+                ('rows_done', models.IntegerField(default=0)),
+                ('chunks_done', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('running', '匯入中'), ('done', '完成'), ('failed', '失敗')], default='running', max_length=64)),
+                ('error', models.TextField(blank=True, default=str)),
+                ('leased_until', models.DateTimeField(null=True)),
+                ('datalist', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='importly.DataList')),
+                ('datasource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='datahub.DataSource')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='streamingimport',
+            index=models.Index(fields=['status', 'u_at'], name='wish_import_status_8f41d1_idx'),
+        ),
+        migrations.CreateModel(
+            name='ImportBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('key', models.CharField(max_length=64)),
+                ('datalist', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='importly.DataList')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+            options={
+                'unique_together': {('team', 'key')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('data', models.BinaryField()),
+                ('size', models.IntegerField(default=0)),
+                ('batch', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='wish_importly.ImportBatch')),
+                ('datalist', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='importly.DataList')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='team.Team')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('importer', models.CharField(max_length=128)),
+                ('name', models.CharField(max_length=128)),
+                ('shard', models.SmallIntegerField(null=True)),
+                ('seconds', models.FloatField(default=0)),
+                ('queries', models.IntegerField(default=0)),
+                ('rows_read', models.IntegerField(default=0)),
+                ('rows_written', models.IntegerField(default=0)),
+                ('rows_inserted', models.IntegerField(default=0)),
+                ('rows_updated', models.IntegerField(default=0)),
+                ('rows_unchanged', models.IntegerField(default=0)),
+                ('peak_memory_kb', models.BigIntegerField(default=0)),
+                ('memory_growth_kb', models.BigIntegerField(default=0)),
+                ('datalist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_stages', to='importly.DataList')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='importstage',
+            index=models.Index(fields=['importer', 'name'], name='wish_import_importe_dd0f3c_idx'),
+        ),
+        migrations.CreateModel(
+            name='DataListTimeBounds',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('datetime_min', models.DateTimeField(null=True)),
+                ('datetime_max', models.DateTimeField(null=True)),
+                ('datalist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='time_bounds', to='importly.DataList')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DataListFailure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('error', models.TextField(blank=True, default=str)),
+                ('datalist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='failure', to='importly.DataList')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CompactedDataList',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('rows_deleted', models.IntegerField(default=0)),
+                ('archive_path', models.TextField(blank=True, default=str)),
+                ('done', models.BooleanField(default=False)),
+                ('datalist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='compaction', to='importly.DataList')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CompactedLineage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('c_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('u_at', models.DateTimeField(auto_now=True)),
+                ('staging_model', models.CharField(max_length=64)),
+                ('base_model', models.CharField(max_length=64)),
+                ('base_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('compaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lineage', to='wish_importly.CompactedDataList')),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.18 on 2026-10-19 09:50
+
+from django.conf import settings
+from django.db import migrations
+
+STAGING_MODELS = ['Event', 'EventLog', 'Level', 'LevelLog', 'PointLog']
+
+
+def set_persistence(apps, schema_editor, persistence):
+    with schema_editor.connection.cursor() as cursor:
+        for name in STAGING_MODELS:
+            cursor.execute(f'ALTER TABLE {apps.get_model("wish_importly", name)._meta.db_table} SET {persistence}')
+
+
+def unlogged_staging(apps, schema_editor):
+    '''
+    staging tables are UNLOGGED when settings.WISH_UNLOGGED_STAGING is set: no WAL for the raw rows,
+    they are emptied on crash recovery and not replicated. changing the setting later takes migrating back and forth
+    '''
+    if getattr(settings, 'WISH_UNLOGGED_STAGING', False):
+        set_persistence(apps, schema_editor, 'UNLOGGED')
+
+
+def logged_staging(apps, schema_editor):
+    set_persistence(apps, schema_editor, 'LOGGED')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wish_importly', '0003_import_tracking'),
+    ]
+
+    operations = [
+        migrations.RunPython(unlogged_staging, logged_staging),
+    ]
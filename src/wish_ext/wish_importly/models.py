@@ -1,13 +1,17 @@
+import datetime
 from uuid import uuid4
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.postgres.fields import JSONField, ArrayField
 
 from datahub.models import DataSource
 from team.models import Team
 
 from core.models import BaseModel, ValueTaggable
-from importly.models import RawModel
+from importly.models import DataList, RawModel
+
+from ..staging import StagingQuerySet
 
 
 class Event(RawModel):
@@ -47,6 +51,8 @@ class Event(RawModel):
 
     datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class EventLog(RawModel):
 
@@ -76,6 +82,8 @@ class EventLog(RawModel):
 
     datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class Level(RawModel):
     class Meta:
@@ -98,6 +106,8 @@ class Level(RawModel):
 
     datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class LevelLog(RawModel):
 
@@ -115,6 +125,8 @@ class LevelLog(RawModel):
 
     datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
 
+    objects = StagingQuerySet.as_manager()
+
 
 class PointLog(RawModel):
 
@@ -128,3 +140,165 @@ class PointLog(RawModel):
     is_transaction = models.BooleanField(default=False)
 
     attributions = JSONField(blank=True, null=True)
+
+    shard = models.SmallIntegerField(blank=True, null=True)  # see sharding.assign_shards
+
+    objects = StagingQuerySet.as_manager()
+
+
+class StreamingImport(BaseModel):
+    '''
+    progress of a file imported chunk by chunk, see datasources.streaming
+    '''
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'u_at']),
+        ]
+
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, '匯入中'),
+        (STATUS_DONE, '完成'),
+        (STATUS_FAILED, '失敗'),
+    )
+
+    team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
+    datasource = models.ForeignKey(DataSource, blank=False, on_delete=models.CASCADE)
+    file_importer = models.CharField(max_length=128)  # class name in datasources.standards
+    path = models.TextField()  # name of the file in default_storage
+
+    rows_done = models.IntegerField(default=0)     # rows of the file already imported, resumed from here
+    chunks_done = models.IntegerField(default=0)
+    datalist = models.ForeignKey(DataList, null=True, on_delete=models.SET_NULL)  # datalist of the last chunk
+
+    status = models.CharField(choices=STATUS_CHOICES, default=STATUS_RUNNING, max_length=64)
+    error = models.TextField(blank=True, default=str)
+    leased_until = models.DateTimeField(null=True)  # a task is streaming the file until then, see claim()
+
+    @classmethod
+    def claim(cls, streaming_import_id, seconds):
+        '''
+        lease the import to the calling task for seconds, False if it is done or another task holds the lease
+        '''
+        now = timezone.now()
+        return bool(cls.objects.filter(
+            models.Q(leased_until__isnull=True) | models.Q(leased_until__lt=now), id=streaming_import_id,
+        ).exclude(status=cls.STATUS_DONE).update(
+            status=cls.STATUS_RUNNING, leased_until=now + datetime.timedelta(seconds=seconds)
+        ))
+
+    def release(self):
+        StreamingImport.objects.filter(id=self.id).update(leased_until=None)
+
+
+class ImportBatch(BaseModel):
+    '''
+    idempotency key of an import api call, replays of an applied batch are skipped, see payloads.claim_batch
+    '''
+    class Meta:
+        unique_together = [['team', 'key']]
+
+    team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)  # sha256 of the Idempotency-Key header, or of the body
+    datalist = models.ForeignKey(DataList, null=True, on_delete=models.SET_NULL)
+
+
+class ImportPayload(BaseModel):
+    '''
+    body of an import api call, stored compressed so only its id goes through the broker, see payloads
+    '''
+    team = models.ForeignKey(Team, blank=False, on_delete=models.CASCADE)
+    data = models.BinaryField()  # zlib compressed json
+    size = models.IntegerField(default=0)  # bytes before compression
+    batch = models.ForeignKey(ImportBatch, null=True, on_delete=models.SET_NULL)
+    datalist = models.ForeignKey(DataList, null=True, on_delete=models.SET_NULL)
+
+
+class ImportStage(BaseModel):
+    '''
+    one stage of an importer run on a datalist, see instrumentation.import_stage
+    '''
+    class Meta:
+        indexes = [
+            models.Index(fields=['importer', 'name']),
+        ]
+
+    datalist = models.ForeignKey(DataList, related_name='import_stages', on_delete=models.CASCADE)
+    importer = models.CharField(max_length=128)
+    name = models.CharField(max_length=128)
+    shard = models.SmallIntegerField(null=True)
+
+    seconds = models.FloatField(default=0)
+    queries = models.IntegerField(default=0)
+    rows_read = models.IntegerField(default=0)
+    rows_written = models.IntegerField(default=0)
+    rows_inserted = models.IntegerField(default=0)   # of upserts
+    rows_updated = models.IntegerField(default=0)
+    rows_unchanged = models.IntegerField(default=0)  # matched an existing row with the same values, not written
+    peak_memory_kb = models.BigIntegerField(default=0)    # of the process when the stage ended
+    memory_growth_kb = models.BigIntegerField(default=0)  # how much the stage raised that peak
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return None
+        return round(max(self.rows_read, self.rows_written) / self.seconds, 1)
+
+
+class DataListTimeBounds(BaseModel):
+    '''
+    earliest / latest datetime of the rows of a datalist, computed once at import time instead of on every page view
+    '''
+    datalist = models.OneToOneField(DataList, related_name='time_bounds', on_delete=models.CASCADE)
+    datetime_min = models.DateTimeField(null=True)
+    datetime_max = models.DateTimeField(null=True)
+
+    @classmethod
+    def store(cls, datalist, queryset):
+        '''
+        queryset: the staged rows of datalist with a datetime field
+        '''
+        aggregation = queryset.aggregate(datetime_min=models.Min('datetime'), datetime_max=models.Max('datetime'))
+        bounds, created = cls.objects.update_or_create(datalist=datalist, defaults=aggregation)
+        return bounds
+
+    @classmethod
+    def get(cls, datalist, queryset):
+        '''
+        the stored bounds, datalists imported before they were stored get them computed now
+        '''
+        bounds = cls.objects.filter(datalist=datalist).first()
+        if bounds is None:
+            bounds = cls.store(datalist, queryset)
+        return bounds
+
+
+class DataListFailure(BaseModel):
+    '''
+    a datalist whose processing failed and will not reach STEP_DONE, e.g. a shard of sharding.process_in_shards
+    '''
+    datalist = models.OneToOneField(DataList, related_name='failure', on_delete=models.CASCADE)
+    error = models.TextField(blank=True, default=str)
+
+
+class CompactedDataList(BaseModel):
+    '''
+    staging rows of a processed datalist deleted by retention.compact_staging, which base rows they touched is in lineage
+    '''
+    datalist = models.OneToOneField(DataList, related_name='compaction', on_delete=models.CASCADE)
+    rows_deleted = models.IntegerField(default=0)
+    archive_path = models.TextField(blank=True, default=str)  # directory of the gzipped ndjson archives, if any
+    done = models.BooleanField(default=False)
+
+
+class CompactedLineage(BaseModel):
+    '''
+    ids of the base rows one deleted batch of staging rows was imported into
+    '''
+    compaction = models.ForeignKey(CompactedDataList, related_name='lineage', on_delete=models.CASCADE)
+    staging_model = models.CharField(max_length=64)
+    base_model = models.CharField(max_length=64)
+    base_ids = ArrayField(models.IntegerField(), default=list)
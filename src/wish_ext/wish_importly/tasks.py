@@ -1,5 +1,10 @@
+import datetime
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import timezone
 
 from datahub.models import DataSource
 from importly.exceptions import EssentialDataMissing
@@ -7,11 +12,26 @@ from importly.models import DataList
 
 from config.celery import app
 from team.models import Team
-
+from core.utils import run
+
+from ..consumer import MicroBatchConsumer, get_broker
+from ..datasources import standards
+from ..extension import wish_ext
+from ..instrumentation import log_slow_import
+from ..payloads import attach_datalist, collect_payloads, delete_payload, load_payload
+from ..retention import compact_staging
+from ..segments import invalidate_segments
+from ..sharding import default_shard_count, process_in_shards
+from ..staging import stage_rows
 from .importers import LevelImporter, LevelLogImporter, EventImporter, EventLogImporter, PointLogImporter
+from .models import StreamingImport
 
 
-def process_datalist(team_slug, data, importer_cls):
+def process_datalist(team_slug, data, importer_cls, shard_count=None, payload_id=None):
+    '''
+    payload_id: the ImportPayload data was loaded from, deleted once the datalist is done.
+    shard_count: see sharding.default_shard_count when not given
+    '''
     team = Team.objects.get(slug=team_slug)
 
     datasource = data.get('datasource')
@@ -28,37 +48,135 @@ def process_datalist(team_slug, data, importer_cls):
 
     importer = importer_cls(team, datasource)
 
-    datalist = importer.create_datalist(rows)
-    datalist.set_step(DataList.STEP_CREATE_RAW_RECORDS)
+    datalist = stage_rows(importer, rows)
+    if payload_id:
+        attach_datalist(payload_id, datalist)
 
-    importer.data_to_raw_records()
-    datalist.set_step(DataList.STEP_PROCESS_RAW_RECORDS)
+    if shard_count is None:
+        shard_count = default_shard_count(importer, len(rows))
+    if shard_count:
+        # STEP_DONE is set by finish_datalist_shards once every shard is done
+        process_in_shards(importer, datasource, shard_count)
+        return
 
     importer.process_raw_records()
     datalist.set_step(DataList.STEP_DONE)
+    log_slow_import(datalist)
+    invalidate_segments(team.id)
+    if payload_id:
+        delete_payload(payload_id)
+
 
 
+@app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
+def process_levellist(team_slug, data=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
+    process_datalist(team_slug, data, LevelImporter, payload_id=payload_id)
+
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_levellist(team_slug, data):
-    process_datalist(team_slug, data, LevelImporter)
+def process_levelloglist(team_slug, data=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
+    process_datalist(team_slug, data, LevelLogImporter, payload_id=payload_id)
 
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_levelloglist(team_slug, data):
-    process_datalist(team_slug, data, LevelLogImporter)
+def process_eventlist(team_slug, data=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
+    process_datalist(team_slug, data, EventImporter, payload_id=payload_id)
 
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_eventlist(team_slug, data):
-    process_datalist(team_slug, data, EventImporter)
+def process_eventloglist(team_slug, data=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
+    process_datalist(team_slug, data, EventLogImporter, payload_id=payload_id)
 
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_eventloglist(team_slug, data):
-    process_datalist(team_slug, data, EventLogImporter)
+def process_pointloglist(team_slug, data=None, shard_count=None, payload_id=None):
+    if payload_id:
+        data = load_payload(payload_id)
+    process_datalist(team_slug, data, PointLogImporter, shard_count, payload_id=payload_id)
+
+
+def start_streaming_import(team, datasource, file_importer, path):
+    '''
+    file_importer: a StreamingFileImporter of datasources.standards, path: the file in default_storage
+    '''
+    streaming_import = StreamingImport.objects.create(
+        team=team, datasource=datasource, file_importer=file_importer.__name__, path=path
+    )
+    run(process_streaming_import, streaming_import.id)
+    return streaming_import
 
 
 @app.task(time_limit=settings.APP_TASK_TIME_LIMIT_SM)
-def process_pointloglist(team_slug, data):
-    process_datalist(team_slug, data, PointLogImporter)
+def process_streaming_import(streaming_import_id):
+    # the lease outlives a worker killed at the time limit, resume_streaming_imports picks the import up after it
+    if not StreamingImport.claim(streaming_import_id, settings.APP_TASK_TIME_LIMIT_SM):
+        return
+    streaming_import = StreamingImport.objects.select_related('team', 'datasource').get(id=streaming_import_id)
+
+    file_importer = getattr(standards, streaming_import.file_importer)
+    try:
+        # leave room for the chunk in progress, the next task goes on from the checkpoint
+        done = file_importer.stream(streaming_import, time_budget=settings.APP_TASK_TIME_LIMIT_SM / 2)
+    finally:
+        streaming_import.release()
+    if not done:
+        run(process_streaming_import, streaming_import.id)
+
+
+@wish_ext.periodic_task()
+def resume_streaming_imports():
+    '''
+    imports whose worker died in the middle go on from their last checkpoint
+    '''
+    now = timezone.now()
+    stale_at = now - datetime.timedelta(seconds=settings.APP_TASK_TIME_LIMIT_SM * 2)
+    for streaming_import_id in StreamingImport.objects.filter(
+        Q(leased_until__isnull=True) | Q(leased_until__lt=now), status=StreamingImport.STATUS_RUNNING, u_at__lt=stale_at
+    ).values_list('id', flat=True):
+        run(process_streaming_import, streaming_import_id)
+
+
+@wish_ext.periodic_task()
+def collect_import_payloads():
+    '''
+    payloads of sharded imports are only done once their last shard is, see payloads.collect_payloads
+    '''
+    collect_payloads()
+
+
+@wish_ext.periodic_task()
+def consume_import_stream():
+    '''
+    order / level log / event log / point log messages of settings.WISH_STREAM_TOPICS, imported in micro batches.
+    runs for half a task time limit, the next run picks up from the committed offsets.
+    '''
+    # one consumer at a time, a run which overlaps the previous one would read the same uncommitted messages
+    lock = 'wish_ext:consume_import_stream'
+    if not cache.add(lock, True, timeout=settings.APP_TASK_TIME_LIMIT_SM):
+        return
+    try:
+        broker = get_broker()
+        if broker is None:
+            return
+        try:
+            return MicroBatchConsumer(broker).run(time_budget=settings.APP_TASK_TIME_LIMIT_SM / 2)
+        finally:
+            broker.close()
+    finally:
+        cache.delete(lock)
+
+
+@wish_ext.periodic_task()
+def compact_staging_tables():
+    '''
+    staging rows of old processed datalists, see retention.compact_staging
+    '''
+    compact_staging(time_budget=settings.APP_TASK_TIME_LIMIT_SM / 2)
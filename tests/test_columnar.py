@@ -0,0 +1,63 @@
+import datetime
+import threading
+
+import pytest
+
+hypothesis = pytest.importorskip('hypothesis')
+pytest.importorskip('pandas')
+pytest.importorskip('importly')
+
+from hypothesis import given, settings, strategies as st
+
+from importly.formatters import format_datetime
+
+from wish_ext.columnar import DATETIME_FORMATS, DatetimeFormatter, datetime_formats
+
+
+def cells(fmt):
+    rendered = st.datetimes(
+        min_value=datetime.datetime(1970, 1, 1), max_value=datetime.datetime(2100, 1, 1)
+    ).map(lambda value: value.strftime(fmt))
+    # cells in another format, empty, or not a date at all show up in the middle of real files
+    return st.lists(st.one_of(rendered, rendered, rendered, st.sampled_from(DATETIME_FORMATS).flatmap(
+        lambda other: st.datetimes().map(lambda value: value.strftime(other))
+    ), st.just(''), st.none(), st.text(max_size=12)), max_size=40)
+
+
+runs = st.lists(st.sampled_from(DATETIME_FORMATS).flatmap(cells), min_size=1, max_size=4)
+
+
+@settings(max_examples=300, deadline=None)
+@given(runs)
+def test_same_result_as_format_datetime(runs):
+    formatter = DatetimeFormatter()
+    for values in runs:
+        # one formatter shared by consecutive runs, like the class level Formatted fields of the importers
+        with datetime_formats():
+            assert [formatter(value) for value in values] == [format_datetime(value) for value in values]
+
+
+def test_format_is_not_shared_between_threads():
+    formatter = DatetimeFormatter()
+    results = {}
+
+    def run(name, fmt):
+        values = [datetime.datetime(2022, 1, day, 10, 30).strftime(fmt) for day in range(1, 29)]
+        with datetime_formats():
+            results[name] = ([formatter(value) for value in values], [format_datetime(value) for value in values])
+
+    threads = [
+        threading.Thread(target=run, args=(fmt, fmt)) for fmt in DATETIME_FORMATS
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for formatted, expected in results.values():
+        assert formatted == expected
+
+
+def test_no_fast_path_outside_of_a_run():
+    formatter = DatetimeFormatter(scalar=lambda value: ('scalar', value))
+    assert [formatter('2022-01-01 10:00:00') for _ in range(10)] == [('scalar', '2022-01-01 10:00:00')] * 10
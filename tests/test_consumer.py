@@ -0,0 +1,63 @@
+import types
+
+import pytest
+
+pytest.importorskip('datahub')
+pytest.importorskip('team')
+
+from wish_ext import consumer
+
+
+class NoDeadLetters(consumer.LocalBroker):
+
+    def dead_letter(self, messages, error):
+        return False
+
+
+def order(order_id):
+    return {'type': 'order', 'team': 'shop', 'datasource': None, 'data': {'id': order_id, 'items': [{'id': 'p'}]}}
+
+
+@pytest.fixture
+def imported(monkeypatch):
+    imported = []
+    monkeypatch.setattr(consumer.Team.objects, 'get', lambda **kwargs: types.SimpleNamespace(slug=kwargs['slug']))
+    monkeypatch.setattr(consumer.DataSource.objects, 'filter', lambda **kwargs: types.SimpleNamespace(
+        only=lambda *fields: types.SimpleNamespace(first=lambda: None)
+    ))
+    monkeypatch.setattr(consumer, 'import_rows', lambda importer, team, datasource, rows: imported.extend(rows))
+    return imported
+
+
+def test_bad_messages_are_dead_lettered(imported):
+    broker = consumer.LocalBroker()
+    broker.publish(order('a'))
+    broker.partitions['default'].append(b'not json')
+    broker.publish(['not', 'an', 'object'])
+    broker.publish(order('b'))
+
+    metrics = consumer.MicroBatchConsumer(broker, max_size=10).run(time_budget=0.01, poll_timeout=0)
+
+    assert [row['id'] for row in imported] == ['a', 'b']
+    assert [message.offset for message, error in broker.dead_letters] == [1, 2]
+    assert metrics['rejected_messages'] == 2
+    assert broker.committed['default'] == 4
+
+
+def test_failed_batch_without_dead_letters_is_not_committed(imported, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(consumer.time, 'sleep', sleeps.append)
+
+    def fail(importer, team, datasource, rows):
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(consumer, 'import_rows', fail)
+    broker = NoDeadLetters()
+    broker.publish(order('a'))
+
+    batch_consumer = consumer.MicroBatchConsumer(broker, max_size=1, max_attempts=3, retry_backoff=1)
+    with pytest.raises(RuntimeError):
+        batch_consumer.add(broker.poll(1, 0)[0])
+
+    assert sleeps == [1, 2]
+    assert broker.committed['default'] == 0
@@ -0,0 +1,147 @@
+'''
+peak memory of PointLogImporter.process_raw_records re-importing the logs of a team which already has all of them,
+the case which ran out of memory. the staged logs go through the real Resolver (in-process LocalResolverBackend) and
+the real upsert, logs of clients which are not found are completed from the team's existing PointLogBase rows.
+only the database round trips are replaced: the querysets answer from the synthetic team without holding it in
+memory, and the INSERT ... ON CONFLICT of upsert reports every row as an updated existing one.
+not covered: memory of the database driver and server, the server-side cursor of iter_chunks (staged rows are generated).
+'''
+import functools
+import re
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('importly')
+pytest.importorskip('datahub')
+
+from wish_ext import resolvers, staging
+from wish_ext import upsert as upsert_module
+from wish_ext.wish_importly import importers
+
+CHUNK_SIZE = 1000
+TEAM_SIZE = 1000000  # existing clients and point logs of the team
+
+
+class StagedPointLogs:
+    '''
+    staged point logs of the datalist, generated row by row like the server-side cursor of iter_chunks,
+    every 10th log is of a client the team does not have
+    '''
+
+    def __init__(self, count):
+        self.count = count
+
+    def values(self, *fields):
+        return self
+
+    def iterator(self, chunk_size):
+        for i in range(self.count):
+            client = f'ghost-{i}' if i % 10 == 0 else f'member-{i * 7 % TEAM_SIZE}'
+            yield {
+                'external_id': f'log-{i}', 'point_name': 'points', 'clientbase_external_id': client,
+                'datetime': None, 'amount': i % 100, 'attributions': {'channel': 'pos'}, 'is_transaction': True,
+            }
+
+
+class ExistingRows:
+    '''
+    rows of the team with external ids f'{prefix}-0' ... f'{prefix}-{TEAM_SIZE - 1}', looked up like the database does
+    '''
+
+    def __init__(self, prefix, external_ids=None):
+        self.prefix = prefix
+        self.external_ids = external_ids
+
+    def filter(self, **lookups):
+        external_ids = lookups.get('external_id__in')
+        if external_ids is None:
+            return self
+        return ExistingRows(self.prefix, external_ids)
+
+    def matches(self):
+        for external_id in self.external_ids:
+            prefix, _, number = external_id.rpartition('-')
+            if prefix == self.prefix and int(number) < TEAM_SIZE:
+                yield external_id, int(number) + 1
+
+    def values_list(self, key, field):
+        return list(self.matches())
+
+    def values(self, key, *fields):
+        return [{key: external_id, **{field: id for field in fields}} for external_id, id in self.matches()]
+
+
+class UpdatingCursor:
+    '''
+    every row of the INSERT ... ON CONFLICT already exists and changed, the rows are dropped once "written"
+    '''
+
+    def __init__(self, written):
+        self.written = written
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, params):
+        columns = [column.strip() for column in re.search(r'\(([^)]*)\)\s*VALUES', sql).group(1).split(',')]
+        key = columns.index('external_id')
+        rows = [params[start:start + len(columns)] for start in range(0, len(params), len(columns))]
+        self.rows = [(row[key], index + 1, False) for index, row in enumerate(rows)]
+        self.written.append(len(rows))
+
+    def fetchall(self):
+        return self.rows
+
+
+class Connection:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.written = []
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self):
+        return UpdatingCursor(self.written)
+
+
+def peak_memory(monkeypatch, count):
+    connection = Connection(upsert_module.connection)
+    monkeypatch.setattr(importers, 'iter_chunks', functools.partial(staging.iter_chunks, chunk_size=CHUNK_SIZE))
+    monkeypatch.setattr(upsert_module, 'connection', connection)
+    monkeypatch.setattr(importers.PointLogBase, 'objects', ExistingRows('log'))
+    # a fresh process, the cache of the resolver is bounded by its size
+    monkeypatch.setattr(resolvers, '_backend', resolvers.LocalResolverBackend(5 * CHUNK_SIZE))
+
+    class Team:
+        id = 1
+        clientbase_set = ExistingRows('member')
+
+    importer = object.__new__(importers.PointLogImporter)
+    importer.team = Team
+    importer.get_pointlogs = lambda: StagedPointLogs(count)
+
+    tracemalloc.start()
+    try:
+        # without instrumented, which records an ImportStage
+        importers.PointLogImporter.process_raw_records.__wrapped__(importer)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # every log updated an existing one, the ghost clients' logs with the client of the existing log
+    assert sum(connection.written) == count
+    return peak
+
+
+def test_memory_is_bounded_by_chunk_size(monkeypatch):
+    # scaled down from a 50M row team, the peak must not grow with the row count at all
+    small = peak_memory(monkeypatch, 10 * CHUNK_SIZE)
+    large = peak_memory(monkeypatch, 200 * CHUNK_SIZE)
+    assert large < small * 1.5
@@ -0,0 +1,66 @@
+import types
+
+import pytest
+
+pytest.importorskip('importly')
+
+from wish_ext.datasources import streaming
+
+
+def order_lines(*orders):
+    # the flat order format, one row per line item, the lines of an order one after the other
+    return [{'id': order_id, 'product_id': f'{order_id}-{line}'} for order_id, lines in orders for line in range(lines)]
+
+
+class OrderLines(streaming.StreamingFileImporter):
+    data_importer = object
+    chunk_key = 'id'
+    rows = []
+
+    @classmethod
+    def read_rows(cls, path):
+        return iter(cls.rows)
+
+
+def streaming_import():
+    return types.SimpleNamespace(
+        path='orders.csv', team=None, datasource=None, rows_done=0, chunks_done=0, datalist=None, status=None,
+        save=lambda update_fields: None,
+    )
+
+
+def test_chunks_are_cut_between_orders():
+    rows = order_lines(('a', 2), ('b', 3), ('c', 1))
+    chunks = list(streaming.iter_row_chunks(rows, 3, key='id'))
+    assert [[row['id'] for row in chunk] for chunk in chunks] == [['a', 'a', 'b', 'b', 'b'], ['c']]
+    assert list(streaming.iter_row_chunks(rows, 3)) == [rows[:3], rows[3:]]
+
+
+def test_order_straddling_a_chunk_is_imported_in_one_chunk(monkeypatch):
+    imported = []
+    monkeypatch.setattr(streaming, 'import_rows', lambda importer, team, datasource, rows: imported.append(rows))
+    monkeypatch.setattr(streaming, 'format_columns', lambda chunk, formatters: None)
+    OrderLines.rows = order_lines(('a', 3), ('b', 4), ('c', 2))
+
+    progress = streaming_import()
+    assert OrderLines.stream(progress, chunk_size=5)
+
+    # b starts in the first 5 rows and ends after them, all its lines are in the first chunk
+    assert [[row['product_id'] for row in chunk if row['id'] == 'b'] for chunk in imported] == [
+        ['b-0', 'b-1', 'b-2', 'b-3'], []
+    ]
+    assert progress.rows_done == 9
+    assert progress.chunks_done == 2
+
+
+def test_resume_starts_at_an_order_boundary(monkeypatch):
+    imported = []
+    monkeypatch.setattr(streaming, 'import_rows', lambda importer, team, datasource, rows: imported.append(rows))
+    monkeypatch.setattr(streaming, 'format_columns', lambda chunk, formatters: None)
+    OrderLines.rows = order_lines(('a', 3), ('b', 4), ('c', 2))
+
+    # a worker stopped after the first chunk of test_order_straddling_a_chunk_is_imported_in_one_chunk
+    progress = streaming_import()
+    progress.rows_done = 7
+    assert OrderLines.stream(progress, chunk_size=5)
+    assert imported == [order_lines(('c', 2))]